@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks for trunksync
+
+Usage: python bench.py [benchmark ...]
+
+Runs every benchmark if none are named. Each benchmark prints one
+line per measurement, with times in milliseconds.
+"""
+
+import sys
+import os
+import time
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS = []
+
+def benchmark(func):
+    """
+    Register func as a benchmark, named after the function
+    """
+    BENCHMARKS.append(func)
+    return func
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def report(name, value, unit='ms'):
+    print '%-40s %10.2f %s' % (name, value, unit)
+
+def time_command(args, repeat=10):
+    """
+    @return: Median wall time, in milliseconds, of running args
+    """
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            start = time.time()
+            subprocess.call(args, cwd=HERE, stdout=devnull, stderr=devnull)
+            timings.append((time.time() - start) * 1000.0)
+    return median(timings)
+
+
+@benchmark
+def startup():
+    """
+    Interpreter start and trunksync import, as paid by every cron run
+    """
+    report('python (no imports)', time_command([sys.executable, '-c', 'pass']))
+    report('import trunksync', time_command([sys.executable, '-c', 'import trunksync']))
+    report('trunksync --help', time_command([sys.executable, 'trunksync.py', '--help']))
+    # What the eager imports used to cost on top (skipped if unavailable)
+    for module in ('pybonjour', 'easygui'):
+        if subprocess.call([sys.executable, '-c', 'import %s' % (module, )], cwd=HERE,
+                           stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT) == 0:
+            report('import trunksync, %s' % (module, ),
+                   time_command([sys.executable, '-c', 'import trunksync, %s' % (module, )]))
+        else:
+            print '%-40s %10s' % ('import trunksync, %s' % (module, ), 'unavailable')
+
+
+# Run in a child process, so its peak memory is the variant's alone
+STAMP_CHILD = r"""
+import sys, os, time, resource
+sys.path.insert(0, %(here)r)
+import trunksync
+
+def stamp_by_lines(contents, last_modified):
+    # How hydrate_from_local rewrote the Timestamp line before
+    new_contents = []
+    substituted_timestamp = False
+    for line in contents.splitlines():
+        if not substituted_timestamp and line.startswith('Timestamp: '):
+            line = u'Timestamp: %%s' %% (time.strftime('%%Y-%%m-%%d %%H:%%M:%%S +0000', last_modified), )
+            substituted_timestamp = True
+        new_contents.append(line + os.linesep)
+    return u''.join(new_contents)
+
+line = u'A line of a long reference note, with an accent: \xe9\n'
+contents = u'Title: Big\nTimestamp: 2011-01-31 12:00:00 +0000\n\n' + line * (%(megabytes)d * 1024 * 1024 // len(line))
+stamp = {'lines': stamp_by_lines, 'header': trunksync.stamp_contents}[%(variant)r]
+
+def status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+
+if os.path.exists('/proc/self/clear_refs'):
+    # Linux: reset the high water mark, so building contents isn't counted
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    before = status_kb('VmRSS:')
+    peak = lambda: status_kb('VmHWM:')
+else:
+    # ru_maxrss is in bytes on OS X
+    scale = 1024 if sys.platform == 'darwin' else 1
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale
+    peak = lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale
+start = time.time()
+stamped = stamp(contents, time.gmtime())
+elapsed = (time.time() - start) * 1000.0
+print elapsed, peak() - before
+"""
+
+@benchmark
+def stamp():
+    """
+    Timestamp rewrite of multi-megabyte notes, as hydrate_from_local does
+    """
+    for megabytes in (1, 8, 32):
+        for variant in ('lines', 'header'):
+            timings, peaks = [], []
+            for i in range(3):
+                output = subprocess.Popen([sys.executable, '-c', STAMP_CHILD % {'here': HERE, 'megabytes': megabytes,
+                                                                               'variant': variant}],
+                                          stdout=subprocess.PIPE).communicate()[0]
+                elapsed, peak = output.split()
+                timings.append(float(elapsed))
+                peaks.append(int(peak))
+            name = 'stamp %dMB note (%s)' % (megabytes, variant)
+            report(name, median(timings))
+            report(name + ' extra peak', median(peaks) / 1024.0, 'MB')
+
+
+@benchmark
+def pipeline():
+    """
+    get_note requests over a 20ms round trip, one at a time and pipelined
+    """
+    import urllib
+    import httplib2
+    import trunkstub
+    stub = trunkstub.TrunkStub()
+    for i in range(100):
+        stub.save_note(u'Title: Note%d\nTimestamp: 2011-01-31 12:00:00 +0000\n\n%s' % (i, u'A short note.\n' * 20))
+    headers = {'Content-type': 'application/x-www-form-urlencoded'}
+    requests = [('POST', urllib.urlencode({'submit': 'sync-get_note', 'title': 'Note%d' % (i, )}), headers)
+                for i in range(100)]
+    for protocol_version in ('HTTP/1.1', 'HTTP/1.0'):
+        server = trunkstub.serve_in_background(stub, protocol_version=protocol_version)
+        proxy = trunkstub.delay_in_background(server, 0.02)
+        uri = 'http://127.0.0.1:%d/' % (proxy.server_address[1], )
+        for depth in (1, 4, 8, 16):
+            timings = []
+            for i in range(3):
+                http = httplib2.Http()
+                http.socket_options = httplib2.socket_options(nodelay=True)
+                start = time.time()
+                results = http.pipeline(uri, requests, depth=depth)
+                timings.append((time.time() - start) * 1000.0)
+                assert [content for response, content in results] == \
+                    [stub.notes[u'Note%d' % (i, )][1].encode('utf-8') for i in range(100)]
+            report('100 get_note, %s, depth %d' % (protocol_version, depth), median(timings))
+        server.shutdown()
+
+
+@benchmark
+def upload():
+    """
+    Client CPU time to upload large files, read whole or memory-mapped
+    """
+    import socket
+    import resource
+    import tempfile
+    import httplib2
+    def cpu():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    # The stub runs in a child process, so only the client's CPU counts
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    with open(os.devnull, 'w') as devnull:
+        stub = subprocess.Popen([sys.executable, 'trunkstub.py', '-p', str(port)], cwd=HERE,
+                                stdout=devnull, stderr=devnull)
+    try:
+        for i in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+        uri = 'http://127.0.0.1:%d/' % (port, )
+        boundary = '----------ThIs_Is_tHe_bouNdaRY_$'
+        preamble = '--%s\r\nContent-disposition: form-data; filename="big.jpg"\r\n' \
+                   'Content-type: application/octet-stream\r\n\r\n' % (boundary, )
+        epilogue = '\r\n--%s--\r\n' % (boundary, )
+        for megabytes in (16, 64):
+            with tempfile.NamedTemporaryFile() as f:
+                f.write(os.urandom(1024 * 1024) * megabytes)
+                f.flush()
+                for variant in ('read', 'mmap'):
+                    timings = []
+                    for i in range(3):
+                        http = httplib2.Http()
+                        before = cpu()
+                        f.seek(0)
+                        if variant == 'read':
+                            # As iphone_upload_file used to
+                            body = ''.join([preamble, f.read(), epilogue])
+                        else:
+                            body = httplib2.FileBody([preamble, f, epilogue])
+                        headers = {'Content-type': 'multipart/form-data; boundary=%s' % (boundary, ),
+                                   'Content-length': str(len(body))}
+                        response, content = http.request(uri, 'POST', headers=headers, body=body)
+                        assert response.status == 200
+                        timings.append((cpu() - before) * 1000.0)
+                    report('upload %dMB file (%s) CPU' % (megabytes, variant), median(timings))
+    finally:
+        stub.terminate()
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    names = [func.__name__ for func in BENCHMARKS]
+    for name in args:
+        if name not in names:
+            raise SystemExit('Unknown benchmark %s, choose from: %s' % (name, ', '.join(names)))
+    for func in BENCHMARKS:
+        if not args or func.__name__ in args:
+            print '--- %s: %s' % (func.__name__, func.__doc__.strip())
+            func()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Adaptive limit on requests in flight to the device
+
+Trunk Notes runs on a phone, so how many requests it can usefully take
+at once depends on the device and on the Wi-Fi, and changes during a
+sync. AimdLimit finds out as it goes, the way TCP finds a window size:
+the limit grows by one request for every limit's worth of requests
+answered without the latency rising (additive increase), and is halved
+on a timeout, an error or a latency spike (multiplicative decrease).
+
+Latency is judged against a baseline per kind of request (a get_note
+is not expected to take as long as a file upload, nor a 1MB note as a
+1KB one - see size_class): the fastest seen. Requests made with nothing
+else in flight also move the baseline slowly up towards their latency,
+so it follows a link which has become slower for good; requests made
+alongside others don't, as their latency rising is what shows the
+device is being given more than it can take.
+"""
+
+import time
+import socket
+import threading
+import contextlib
+
+# Latency this many times the baseline counts as a spike
+SPIKE_FACTOR = 2.0
+# Weight of each request made alone in the baseline, when slower than it
+BASELINE_DRIFT = 0.05
+
+
+def size_class(nbytes):
+    """
+    >>> size_class(1000), size_class(300 * 1024), size_class(50 * 1024 * 1024)
+    ('<64K', '<1024K', '<65536K')
+
+    @param nbytes: Bytes sent and received by a request
+    @return: Label shared by requests of about that size
+    """
+    bound = 64
+    while nbytes >= bound * 1024 and bound < 65536:
+        bound *= 4
+    return '<%dK' % (bound, )
+
+
+class AimdLimit(object):
+
+    def __init__(self, initial=2, minimum=1, maximum=8, backoff=0.5, clock=time.time):
+        """
+        @param initial: Requests allowed in flight to begin with
+        @param minimum: Fewest allowed, however many have failed
+        @param maximum: Most allowed, however well the device copes
+        @param backoff: Factor the limit is cut by on a failure or spike
+        @param clock: Function returning the time in seconds
+        """
+        assert 1 <= minimum <= maximum, 'Invalid concurrency limits'
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.clock = clock
+        self.limit = float(min(initial, maximum))
+        self.in_flight = 0
+        # kind of request -> baseline latency
+        self.baselines = {}
+        self.peak = self.limit
+        self.requests = 0
+        self.increases = 0
+        self.decreases = {'timeout': 0, 'error': 0, 'latency': 0}
+        # No further decrease until this time, so that requests which
+        # were already in flight when the limit was cut don't cut it
+        # again for the same congestion
+        self._recovering_until = 0
+        self._condition = threading.Condition()
+
+    def allowed(self):
+        """
+        @return: Number of requests allowed in flight now
+        """
+        return max(self.minimum, int(self.limit))
+
+    def acquire(self, count=1):
+        """
+        Wait until count more requests may be sent
+
+        @return: Token to give to release
+        """
+        with self._condition:
+            # A batch bigger than the limit waits for everything else,
+            # and then takes the whole limit
+            slots = min(count, self.allowed())
+            while self.in_flight and self.in_flight + slots > self.allowed():
+                self._condition.wait()
+            self.in_flight += slots
+        return (self.clock(), slots, count, self.in_flight > 1)
+
+    def release(self, token, kind='', outcome='ok', rounds=1):
+        """
+        Record the end of requests let through by acquire
+
+        @param token: As returned by acquire
+        @param kind: Kind of request, for the latency baseline
+        @param outcome: 'ok', 'timeout' or 'error'
+        @param rounds: Round trips the requests took between them, so
+            each one's latency is the elapsed time over rounds
+        @return: Latency of the requests, in seconds
+        """
+        started, slots, count, contended = token
+        latency = (self.clock() - started) / rounds
+        with self._condition:
+            contended = contended or self.in_flight > slots
+            self.in_flight -= slots
+            self._observe(kind, latency, count, outcome, contended)
+            self._condition.notify_all()
+        return latency
+
+    def _observe(self, kind, latency, count, outcome, contended=False):
+        """
+        >>> limit = AimdLimit(initial=2, clock=lambda: 0)
+        >>> for i in range(4):
+        ...     limit._observe('get_note', 0.01, 1, 'ok')
+        >>> limit.allowed()
+        3
+        >>> limit._observe('get_note', 0.1, 1, 'ok')
+        >>> limit.allowed(), limit.decreases['latency']
+        (1, 1)
+        """
+        self.requests += count
+        baseline = self.baselines.get(kind)
+        if outcome == 'ok' and baseline is not None and latency > baseline * SPIKE_FACTOR:
+            outcome = 'latency'
+        if baseline is None or latency < baseline:
+            self.baselines[kind] = latency
+        elif outcome == 'ok' and not contended:
+            self.baselines[kind] = baseline + (latency - baseline) * BASELINE_DRIFT
+        now = self.clock()
+        if outcome == 'ok':
+            before = int(self.limit)
+            # One more request per limit's worth answered
+            self.limit = min(self.maximum, self.limit + float(count) / self.limit)
+            if int(self.limit) > before:
+                self.increases += 1
+            self.peak = max(self.peak, self.limit)
+        elif now >= self._recovering_until:
+            self.decreases[outcome] += 1
+            self.limit = max(self.minimum, self.limit * self.backoff)
+            self._recovering_until = now + latency
+
+    @contextlib.contextmanager
+    def request(self, kind='', count=1, rounds=1):
+        """
+        Let requests through, waiting for room if need be:
+
+            with limit.request('get_note') as outcome:
+                ...
+                if overloaded:
+                    outcome.error()
+                outcome.kind = 'get_note ' + size_class(len(content))
+
+        A socket timeout raised within counts as a timeout, and any other
+        exception as an error.
+        """
+        outcome = _Outcome(kind)
+        token = self.acquire(count)
+        try:
+            yield outcome
+        except socket.timeout:
+            outcome.value = 'timeout'
+            raise
+        except Exception:
+            outcome.value = 'error'
+            raise
+        finally:
+            self.release(token, outcome.kind, outcome.value, rounds)
+
+    def state(self):
+        """
+        @return: Dictionary describing the limit, for the sync report
+        """
+        with self._condition:
+            return {'limit': self.allowed(), 'peak': int(self.peak), 'maximum': self.maximum,
+                    'requests': self.requests, 'increases': self.increases,
+                    'decreases': dict(self.decreases),
+                    'baselines_ms': dict((kind, round(latency * 1000, 1))
+                                         for kind, latency in self.baselines.iteritems())}
+
+    def describe(self):
+        """
+        >>> AimdLimit(initial=2).describe()
+        'limit 2 (peak 2, maximum 8) after 0 requests; backed off 0 times'
+        """
+        state = self.state()
+        backoffs = sum(state['decreases'].values())
+        text = 'limit %d (peak %d, maximum %d) after %d requests; backed off %d times' % (
+            state['limit'], state['peak'], state['maximum'], state['requests'], backoffs)
+        if backoffs:
+            text += ' (%s)' % (', '.join('%d on %s' % (n, why) for why, n in sorted(state['decreases'].items()) if n), )
+        return text
+
+
+class _Outcome(object):
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.value = 'ok'
+
+    def error(self):
+        self.value = 'error'
+
+    def timeout(self):
+        self.value = 'timeout'
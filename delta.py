@@ -0,0 +1,109 @@
+"""
+Line based edit scripts between note bodies
+
+An edit script turns one body (the base both sides share) into another,
+so a small change to a long note can be sent as a few bytes rather than
+the whole note. Scripts work on UTF-8 bytes, with lines ending after
+each '\\n', and are made of commands each on a line of their own:
+
+    =N      copy the next N lines of the base
+    -N      skip the next N lines of the base
+    +N      insert the N bytes which follow the command's newline
+
+Lines are matched with merge3.matching_lines.
+"""
+
+import merge3
+
+
+class DeltaError(Exception):
+    """
+    An edit script doesn't apply to the base it was given
+    """
+    pass
+
+
+def split_lines(data):
+    """
+    >>> split_lines('one\\ntwo\\n\\nthree')
+    ['one\\n', 'two\\n', '\\n', 'three']
+
+    @param data: Bytes
+    @return: Lines, each keeping its '\\n'
+    """
+    lines = data.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def make_delta(base, new):
+    """
+    >>> make_delta(u'one\\ntwo\\nthree\\n', u'one\\n2\\nthree\\n')
+    '=1\\n-1\\n+2\\n2\\n=1\\n'
+
+    @param base: Body the script applies to (unicode)
+    @param new: Body the script produces (unicode)
+    @return: Edit script
+    """
+    base_lines = split_lines(base.encode('utf-8'))
+    new_lines = split_lines(new.encode('utf-8'))
+    script = []
+    i = j = 0
+    for mi, mj in merge3.matching_lines(base_lines, new_lines) + [(len(base_lines), len(new_lines))]:
+        if mi > i:
+            script.append('-%d\n' % (mi - i, ))
+        if mj > j:
+            inserted = ''.join(new_lines[j:mj])
+            script.append('+%d\n%s' % (len(inserted), inserted))
+        if mi < len(base_lines):
+            # Merge runs of copied lines into one command
+            if script and script[-1].startswith('='):
+                script[-1] = '=%d\n' % (int(script[-1][1:]) + 1, )
+            else:
+                script.append('=1\n')
+        i, j = mi + 1, mj + 1
+    return ''.join(script)
+
+
+def apply_delta(base, script):
+    """
+    >>> apply_delta(u'one\\ntwo\\nthree\\n', '=1\\n-1\\n+2\\n2\\n=1\\n')
+    u'one\\n2\\nthree\\n'
+
+    @param base: Body the script was made against (unicode)
+    @param script: Edit script, from make_delta
+    @return: The new body (unicode)
+    """
+    base_lines = split_lines(base.encode('utf-8'))
+    result = []
+    i = 0
+    pos = 0
+    while pos < len(script):
+        end = script.find('\n', pos)
+        if end < 0:
+            raise DeltaError('Truncated edit script')
+        command, pos = script[pos:end], end + 1
+        try:
+            op, count = command[0], int(command[1:])
+        except (IndexError, ValueError):
+            raise DeltaError('Invalid edit script command: %r' % (command, ))
+        if op == '=':
+            if i + count > len(base_lines):
+                raise DeltaError('Edit script runs past the end of the base')
+            result.extend(base_lines[i:i + count])
+            i += count
+        elif op == '-':
+            i += count
+        elif op == '+':
+            if pos + count > len(script):
+                raise DeltaError('Truncated edit script')
+            result.append(script[pos:pos + count])
+            pos += count
+        else:
+            raise DeltaError('Invalid edit script command: %r' % (command, ))
+    if i != len(base_lines):
+        raise DeltaError('Edit script does not cover the whole base')
+    return ''.join(result).decode('utf-8')
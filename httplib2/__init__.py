@@ -40,6 +40,7 @@ import os
 import copy
 import calendar
 import time
+import mmap
 import random
 # remove depracated warning in python2.6
 try:
@@ -49,9 +50,10 @@ except ImportError:
     import md5
     _sha = sha.new
     _md5 = md5.new
-import hmac
 from gettext import gettext as _
 import socket
+import threading
+from collections import OrderedDict
 
 try:
     import socks
@@ -358,6 +360,64 @@ def _decompressContent(response, new_content):
         raise FailedToDecompressContent(_("Content purported to be compressed with %s but failed to decompress.") % response.get('content-encoding'), response, content)
     return content
 
+def _iterDecompressContent(response, raw, chunk_size=64*1024):
+    """Like _decompressContent, but reads the body from the file-like
+    'raw' a chunk at a time and returns an iterator over the decoded
+    chunks, so neither copy of the body is ever held in full."""
+    encoding = response.get('content-encoding', None)
+    decompressor = None
+    if encoding == 'gzip':
+        # 16 + MAX_WBITS: expect and skip the gzip header and trailer
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        decompressor = zlib.decompressobj()
+    if decompressor:
+        # Decoded length isn't known until the body has been read
+        if response.has_key('content-length'):
+            del response['content-length']
+        response['-content-encoding'] = response['content-encoding']
+        del response['content-encoding']
+
+    def _chunks():
+        try:
+            while True:
+                chunk = raw.read(chunk_size)
+                if not chunk:
+                    if raw.length:
+                        # The connection closed part way through the body,
+                        # which read() doesn't itself complain about
+                        raise httplib.IncompleteRead('', raw.length)
+                    break
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+            if decompressor:
+                chunk = decompressor.flush()
+                if chunk:
+                    yield chunk
+        except zlib.error:
+            raise FailedToDecompressContent(_("Content purported to be compressed with %s but failed to decompress.") % encoding, response, "")
+    return _chunks()
+
+def _compressContent(headers, content, encoding):
+    """Compress a request entity body with 'gzip' or 'deflate' and
+    mark it with the matching Content-Encoding header."""
+    if encoding == 'gzip':
+        buf = StringIO.StringIO()
+        gz = gzip.GzipFile(fileobj=buf, mode='wb')
+        gz.write(content)
+        gz.close()
+        content = buf.getvalue()
+    elif encoding == 'deflate':
+        content = zlib.compress(content)
+    else:
+        return content
+    headers['content-encoding'] = encoding
+    if headers.has_key('content-length'):
+        headers['content-length'] = str(len(content))
+    return content
+
 def _updateCache(request_headers, response_headers, content, cache, cachekey):
     if cachekey:
         cc = _parse_cache_control(request_headers)
@@ -406,6 +466,10 @@ class Authentication(object):
         self.host = host
         self.credentials = credentials
         self.http = http
+        # The challenge this was created from, and its scheme (set by
+        # Http._auth_from_challenge), so it can be saved and re-created
+        self.www_authenticate = response.get('www-authenticate', '')
+        self.scheme = None
 
     def depth(self, request_uri):
         (scheme, authority, path, query, fragment) = parse_uri(request_uri)
@@ -431,6 +495,16 @@ class Authentication(object):
         """
         return False
 
+    def state(self):
+        """Anything negotiated since the challenge which must be
+        kept to re-create this authorization, as a dictionary.
+        Over-ride this in sub-classes if necessary."""
+        return {}
+
+    def restore(self, state):
+        """Put back state, as returned by state()"""
+        pass
+
 
 
 class BasicAuthentication(Authentication):
@@ -459,46 +533,65 @@ class DigestAuthentication(Authentication):
             raise UnimplementedDigestAuthOptionError( _("Unsupported value for algorithm: %s." % self.challenge['algorithm']))
         self.A1 = "".join([self.credentials[0], ":", self.challenge['realm'], ":", self.credentials[1]])   
         self.challenge['nc'] = 1
+        # Http objects in several threads may share this authorization,
+        # and every request must get its own nc
+        self.lock = threading.Lock()
 
     def request(self, method, request_uri, headers, content, cnonce = None):
         """Modify the request headers"""
         H = lambda x: _md5(x).hexdigest()
         KD = lambda s, d: H("%s:%s" % (s, d))
         A2 = "".join([method, ":", request_uri])
-        self.challenge['cnonce'] = cnonce or _cnonce() 
-        request_digest  = '"%s"' % KD(H(self.A1), "%s:%s:%s:%s:%s" % (self.challenge['nonce'], 
-                    '%08x' % self.challenge['nc'], 
-                    self.challenge['cnonce'], 
+        with self.lock:
+            nonce = self.challenge['nonce']
+            nc = self.challenge['nc']
+            self.challenge['nc'] += 1
+        cnonce = cnonce or _cnonce()
+        self.challenge['cnonce'] = cnonce
+        request_digest  = '"%s"' % KD(H(self.A1), "%s:%s:%s:%s:%s" % (nonce, 
+                    '%08x' % nc, 
+                    cnonce, 
                     self.challenge['qop'], H(A2)
                     )) 
         headers['Authorization'] = 'Digest username="%s", realm="%s", nonce="%s", uri="%s", algorithm=%s, response=%s, qop=%s, nc=%08x, cnonce="%s"' % (
                 self.credentials[0], 
                 self.challenge['realm'],
-                self.challenge['nonce'],
+                nonce,
                 request_uri, 
                 self.challenge['algorithm'],
                 request_digest,
                 self.challenge['qop'],
-                self.challenge['nc'],
-                self.challenge['cnonce'],
+                nc,
+                cnonce,
                 )
-        self.challenge['nc'] += 1
+        if self.challenge.get('opaque'):
+            headers['Authorization'] += ', opaque="%s"' % self.challenge['opaque']
 
     def response(self, response, content):
         if not response.has_key('authentication-info'):
             challenge = _parse_www_authenticate(response, 'www-authenticate').get('digest', {})
             if 'true' == challenge.get('stale'):
-                self.challenge['nonce'] = challenge['nonce']
-                self.challenge['nc'] = 1 
+                with self.lock:
+                    self.challenge['nonce'] = challenge['nonce']
+                    self.challenge['nc'] = 1 
                 return True
         else:
             updated_challenge = _parse_www_authenticate(response, 'authentication-info').get('digest', {})
 
             if updated_challenge.has_key('nextnonce'):
-                self.challenge['nonce'] = updated_challenge['nextnonce']
-                self.challenge['nc'] = 1 
+                with self.lock:
+                    self.challenge['nonce'] = updated_challenge['nextnonce']
+                    self.challenge['nc'] = 1 
         return False
 
+    def state(self):
+        with self.lock:
+            return {'nonce': self.challenge['nonce'], 'nc': self.challenge['nc']}
+
+    def restore(self, state):
+        with self.lock:
+            self.challenge.update(state)
+
 
 class HmacDigestAuthentication(Authentication):
     """Adapted from Robert Sayre's code and DigestAuthentication above."""
@@ -543,6 +636,7 @@ class HmacDigestAuthentication(Authentication):
         created = time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime())
         cnonce = _cnonce()
         request_digest = "%s:%s:%s:%s:%s" % (method, request_uri, cnonce, self.challenge['snonce'], headers_val)
+        import hmac
         request_digest  = hmac.new(self.key, request_digest, self.hashmod).hexdigest().lower()
         headers['Authorization'] = 'HMACDigest username="%s", realm="%s", snonce="%s", cnonce="%s", uri="%s", created="%s", response="%s", headers="%s"' % (
                 self.credentials[0], 
@@ -625,6 +719,10 @@ AUTH_SCHEME_CLASSES = {
 
 AUTH_SCHEME_ORDER = ["hmacdigest", "googlelogin", "digest", "wsse", "basic"]
 
+# Schemes which Http.load_authorizations can re-create without
+# talking to the server
+PREEMPTIVE_SCHEMES = ["hmacdigest", "digest", "wsse", "basic"]
+
 class FileCache(object):
     """Uses a local directory as a store for cached files.
     Not really safe to use if multiple threads or processes are going to 
@@ -658,6 +756,162 @@ class FileCache(object):
         if os.path.exists(cacheFullPath):
             os.remove(cacheFullPath)
 
+class MemoryCache(object):
+    """Keeps cached responses in process memory, evicting the least
+    recently used entries once 'max_bytes' is exceeded. Entries older
+    than 'ttl' seconds (if given) are treated as absent.
+
+    The counters 'hits', 'misses' and 'evictions' can be inspected
+    at any time, or collected with stats().
+    """
+    def __init__(self, max_bytes=8*1024*1024, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (stored_at, value), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                self.size -= len(entry[1])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Re-insert to mark as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(value) > self.max_bytes:
+                # Would evict everything else and still not fit
+                return
+            self._entries[key] = (time.time(), value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                oldkey, (stored_at, oldvalue) = self._entries.popitem(last=False)
+                self.size -= len(oldvalue)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'bytes': self.size}
+
+class AddressCache(object):
+    """Remembers what socket.getaddrinfo returned for each host and
+    port for 'ttl' seconds, so that a connection which is re-opened (or
+    opened alongside others) doesn't resolve the name again. Resolving
+    can be slow, e.g. '.local' names on some mDNS resolvers.
+
+    The counters 'hits' and 'misses' can be inspected at any time, or
+    collected with stats().
+    """
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # (host, port) -> (resolved_at, getaddrinfo results)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, host, port):
+        """Return getaddrinfo results for a TCP connection to host:port,
+        and whether they came from the cache. Raises socket.gaierror
+        like getaddrinfo."""
+        key = (host, port)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl:
+                self.hits += 1
+                return entry[1], True
+            self.misses += 1
+        finally:
+            self._lock.release()
+        # Not under the lock, as this can take seconds
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        self._lock.acquire()
+        try:
+            self._entries[key] = (time.time(), addresses)
+        finally:
+            self._lock.release()
+        return addresses, False
+
+    def forget(self, host, port):
+        """Drop host:port, e.g. after none of its addresses could
+        be connected to."""
+        self._lock.acquire()
+        try:
+            self._entries.pop((host, port), None)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+def socket_options(nodelay=False, keepalive=False, sndbuf=None, rcvbuf=None):
+    """Return a list of (level, option, value) to set on each new
+    socket, for Http.socket_options.
+
+    'nodelay' disables Nagle's algorithm, which otherwise holds back
+    the body of a small request until the headers are acknowledged.
+    'sndbuf' and 'rcvbuf' are buffer sizes in bytes."""
+    options = []
+    if nodelay:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+    if keepalive:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if sndbuf:
+        options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf))
+    if rcvbuf:
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf))
+    return options
+
+def _set_socket_options(sock, options):
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except socket.error:
+            # An option the platform doesn't support is not worth
+            # failing the connection over
+            pass
+
+
 class Credentials(object):
     def __init__(self):
         self.credentials = []
@@ -697,20 +951,156 @@ p = ProxyInfo(proxy_type=socks.PROXY_TYPE_HTTP, proxy_host='localhost', proxy_po
     return socks and (self.proxy_host != None) and (self.proxy_port != None)
 
 
+class _TimedSocket(object):
+    """A connected socket which gives up once 'deadline' (a time.time()
+value, or None for no limit) has passed, however the time is being
+spent: each send or receive waits no longer than what is left, nor
+than the socket's own timeout. Otherwise as the socket it wraps."""
+
+    def __init__(self, sock, deadline=None, owner=None):
+        self._sock = sock
+        # The _TimedSocket whose deadline and timeout apply
+        self._owner = owner or self
+        if owner is None:
+            self._timeout = sock.gettimeout()
+            self._limited = False
+            self.deadline = deadline
+
+    def settimeout(self, timeout):
+        self._owner._timeout = timeout
+        self._sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self._owner._timeout
+
+    def _wait(self):
+        owner = self._owner
+        if owner.deadline is None:
+            if owner._limited:
+                self._sock.settimeout(owner._timeout)
+                owner._limited = False
+            return
+        remaining = owner.deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("timed out")
+        if owner._timeout is not None:
+            remaining = min(remaining, owner._timeout)
+        self._sock.settimeout(remaining)
+        owner._limited = True
+
+    def recv(self, *args):
+        self._wait()
+        return self._sock.recv(*args)
+
+    def recv_into(self, *args):
+        self._wait()
+        return self._sock.recv_into(*args)
+
+    def send(self, *args):
+        self._wait()
+        return self._sock.send(*args)
+
+    def sendall(self, *args):
+        self._wait()
+        return self._sock.sendall(*args)
+
+    def makefile(self, mode='r', bufsize=-1):
+        # Like socket.makefile, the file has a duplicate of the socket,
+        # so it can still be read once the socket is closed (as httplib
+        # does with a response which closes the connection)
+        return socket._fileobject(_TimedSocket(self._sock.dup(), owner=self), mode, bufsize)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+def _connect_timeout(connect_timeout, timeout, deadline):
+    """Return the timeout for connecting: 'connect_timeout' if given,
+else 'timeout', cut short by 'deadline'."""
+    if connect_timeout is None:
+        connect_timeout = timeout
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("timed out")
+        if has_timeout(connect_timeout):
+            remaining = min(remaining, connect_timeout)
+        connect_timeout = remaining
+    return connect_timeout
+
 class HTTPConnectionWithTimeout(httplib.HTTPConnection):
-    """HTTPConnection subclass that supports timeouts"""
+    """HTTPConnection subclass that supports timeouts
+
+'timeout' limits each wait for the socket once connected, and
+'connect_timeout' (if not None) the wait to connect. 'deadline' (a
+time.time() value, or None) limits the whole of a request, from
+connecting to the last of the response - see set_timeouts(). Over
+HTTPS, 'deadline' only limits connecting.
+
+Http sets these after creating the connection:
+
+'address_cache' - an AddressCache to resolve the host through, or None
+to resolve it on every connect.
+
+'socket_options' - (level, option, value) to set on each socket,
+see socket_options().
+
+'connect_hook' - None, or called as connect_hook(connection, timings)
+after each successful connect, where 'timings' is a dictionary of
+'resolve' and 'connect' (seconds taken by each), 'cached' (whether
+the address came from the cache) and 'address'. The last timings are
+also kept in 'connect_timings'.
+"""
+
+    address_cache = None
+    socket_options = ()
+    connect_hook = None
+    connect_timeout = None
+    deadline = None
 
     def __init__(self, host, port=None, strict=None, timeout=None, proxy_info=None):
         httplib.HTTPConnection.__init__(self, host, port, strict)
         self.timeout = timeout
         self.proxy_info = proxy_info
+        self.connect_timings = None
+
+    def set_timeouts(self, connect_timeout, timeout, deadline):
+        """Set the timeouts for the next request, applying them to the
+socket too if already connected."""
+        _set_timeouts(self, connect_timeout, timeout, deadline)
+
+    def send(self, data):
+        """Send a string, or a FileBody."""
+        _send(self, data)
+
+    def _resolve(self):
+        if self.address_cache is None:
+            return socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM), False
+        return self.address_cache.lookup(self.host, self.port)
 
     def connect(self):
         """Connect to the host and port specified in __init__."""
+        started = time.time()
+        addresses, cached = self._resolve()
+        resolved = time.time()
+        try:
+            self._connect_to(addresses)
+        except socket.error:
+            if not cached:
+                raise
+            # The host may have moved since it was resolved
+            self.address_cache.forget(self.host, self.port)
+            addresses, cached = self._resolve()
+            resolved = time.time()
+            self._connect_to(addresses)
+        self.connect_timings = {'resolve': resolved - started, 'connect': time.time() - resolved,
+                                'cached': cached, 'address': self.sock.getpeername()}
+        if self.connect_hook is not None:
+            self.connect_hook(self, self.connect_timings)
+
+    def _connect_to(self, addresses):
         # Mostly verbatim from httplib.py.
         msg = "getaddrinfo returns an empty list"
-        for res in socket.getaddrinfo(self.host, self.port, 0,
-                socket.SOCK_STREAM):
+        for res in addresses:
             af, socktype, proto, canonname, sa = res
             try:
                 if self.proxy_info and self.proxy_info.isgood():
@@ -718,14 +1108,19 @@ class HTTPConnectionWithTimeout(httplib.HTTPConnection):
                     self.sock.setproxy(*self.proxy_info.astuple())
                 else:
                     self.sock = socket.socket(af, socktype, proto)
-                # Different from httplib: support timeouts.
-                if has_timeout(self.timeout):
-                    self.sock.settimeout(self.timeout)
-                    # End of difference from httplib.
+                # Different from httplib: support timeouts and options.
+                connect_timeout = _connect_timeout(self.connect_timeout, self.timeout, self.deadline)
+                if has_timeout(connect_timeout):
+                    self.sock.settimeout(connect_timeout)
+                _set_socket_options(self.sock, self.socket_options)
+                # End of difference from httplib.
                 if self.debuglevel > 0:
                     print "connect: (%s, %s)" % (self.host, self.port)
 
                 self.sock.connect(sa)
+                if has_timeout(self.timeout) or has_timeout(connect_timeout):
+                    self.sock.settimeout(has_timeout(self.timeout) and self.timeout or socket.getdefaulttimeout())
+                self.sock = _TimedSocket(self.sock, self.deadline)
             except socket.error, msg:
                 if self.debuglevel > 0:
                     print 'connect fail:', (self.host, self.port)
@@ -737,15 +1132,125 @@ class HTTPConnectionWithTimeout(httplib.HTTPConnection):
         if not self.sock:
             raise socket.error, msg
 
+class FileBody(object):
+    """A request body made of strings and open files, to give request()
+in place of a string. Each file is memory-mapped while it is sent, so
+the socket is written straight from the mapped pages, rather than the
+file being read into (and copied between) Python strings. A file is
+sent whole, or given as a (file, offset, length) tuple to send just
+that part of it. The files are sent each time the body is sent, so
+must stay open and unchanged until the request is done."""
+
+    # Most bytes of a file handed to the socket at once, so that the
+    # connection's timeouts are checked between them
+    chunk_size = 1024*1024
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def _span(self, part):
+        if isinstance(part, tuple):
+            return part
+        return part, 0, os.fstat(part.fileno()).st_size
+
+    def __len__(self):
+        length = 0
+        for part in self.parts:
+            if isinstance(part, str):
+                length += len(part)
+            else:
+                length += self._span(part)[2]
+        return length
+
+    def send(self, sock):
+        for part in self.parts:
+            if isinstance(part, str):
+                sock.sendall(part)
+                continue
+            f, start, length = self._span(part)
+            if not length:
+                # Empty files can't be mapped
+                continue
+            # Mapped whole, as a mapping's offset has to be a multiple of
+            # mmap.ALLOCATIONGRANULARITY
+            mapped = mmap.mmap(f.fileno(), os.fstat(f.fileno()).st_size, access=mmap.ACCESS_READ)
+            try:
+                end = start + length
+                for offset in xrange(start, end, self.chunk_size):
+                    sock.sendall(buffer(mapped, offset, min(self.chunk_size, end - offset)))
+            finally:
+                mapped.close()
+
+def _send(conn, data):
+    if isinstance(data, FileBody):
+        if conn.sock is None:
+            conn.connect()
+        data.send(conn.sock)
+    else:
+        httplib.HTTPConnection.send(conn, data)
+
+class _PipelineFile(object):
+    """The read side of a socket, buffered once for all the responses
+to pipelined requests. httplib.HTTPResponse takes it as its socket and
+would otherwise make (and throw away) a buffer of its own each time."""
+
+    def __init__(self, sock):
+        self.fp = sock.makefile('rb')
+
+    def makefile(self, *args):
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def close(self):
+        # Called by each response when it is done with the connection
+        pass
+
+def _format_request(conn, method, request_uri, body, headers):
+    """Return the bytes httplib would send to make the request on conn,
+without sending them."""
+    chunks = []
+    formatter = httplib.HTTPConnection(conn.host, conn.port)
+    formatter.default_port = conn.default_port
+    formatter.send = chunks.append
+    formatter.request(method, request_uri, body, headers)
+    return "".join(chunks)
+
+def _set_timeouts(conn, connect_timeout, timeout, deadline):
+    conn.connect_timeout = connect_timeout
+    conn.deadline = deadline
+    if timeout != conn.timeout:
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(has_timeout(timeout) and timeout or socket.getdefaulttimeout())
+    if isinstance(conn.sock, _TimedSocket):
+        conn.sock.deadline = deadline
+
 class HTTPSConnectionWithTimeout(httplib.HTTPSConnection):
     "This class allows communication via SSL."
 
+    # The host is resolved by socket.connect, so address_cache is
+    # unused and the 'resolve' timing is included in 'connect'
+    address_cache = None
+    socket_options = ()
+    connect_hook = None
+    connect_timeout = None
+    deadline = None
+
     def __init__(self, host, port=None, key_file=None, cert_file=None,
                  strict=None, timeout=None, proxy_info=None):
         httplib.HTTPSConnection.__init__(self, host, port=port, key_file=key_file,
                 cert_file=cert_file, strict=strict)
         self.timeout = timeout
         self.proxy_info = proxy_info
+        self.connect_timings = None
+
+    def set_timeouts(self, connect_timeout, timeout, deadline):
+        _set_timeouts(self, connect_timeout, timeout, deadline)
+
+    def send(self, data):
+        _send(self, data)
 
     def connect(self):
         "Connect to a host on a given (SSL) port."
@@ -756,10 +1261,21 @@ class HTTPSConnectionWithTimeout(httplib.HTTPSConnection):
         else:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         
-        if has_timeout(self.timeout):
-            sock.settimeout(self.timeout)
+        connect_timeout = _connect_timeout(self.connect_timeout, self.timeout, self.deadline)
+        if has_timeout(connect_timeout):
+            sock.settimeout(connect_timeout)
+        _set_socket_options(sock, self.socket_options)
+        started = time.time()
         sock.connect((self.host, self.port))
+        if has_timeout(self.timeout) or has_timeout(connect_timeout):
+            sock.settimeout(has_timeout(self.timeout) and self.timeout or socket.getdefaulttimeout())
+        # SSL sockets can't be duplicated for _TimedSocket.makefile, so
+        # the deadline only limits connecting
         self.sock =_ssl_wrap_socket(sock, self.key_file, self.cert_file)
+        self.connect_timings = {'resolve': 0.0, 'connect': time.time() - started,
+                                'cached': False, 'address': sock.getpeername()}
+        if self.connect_hook is not None:
+            self.connect_hook(self, self.connect_timings)
 
 
 
@@ -781,7 +1297,7 @@ and more.
 
 If 'cache' is a string then it is used as a directory name
 for a disk cache. Otherwise it must be an object that supports
-the same interface as FileCache."""
+the same interface as FileCache, such as MemoryCache."""
         self.proxy_info = proxy_info
         # Map domain name to an httplib connection
         self.connections = {}
@@ -818,6 +1334,34 @@ the same interface as FileCache."""
 
         self.timeout = timeout
 
+        # Also limit each wait to connect to 'connect_timeout' seconds
+        # (None to use 'timeout'), and each request as a whole - from
+        # connecting to the last of the response, including reading a
+        # response from request_stream() - to 'total_timeout' seconds
+        # (None for no limit).
+        self.connect_timeout = None
+        self.total_timeout = None
+
+        # Compress request bodies with this encoding ('gzip' or 'deflate'),
+        # only for servers known to accept it. Bodies shorter than
+        # 'request_compression_threshold' bytes are sent as-is.
+        self.request_encoding = None
+        self.request_compression_threshold = 1024
+
+        # Resolve hosts through this AddressCache (None to resolve on
+        # every connect), and set these options on every socket - see
+        # HTTPConnectionWithTimeout. Http objects may share a cache.
+        self.address_cache = AddressCache()
+        self.socket_options = []
+        self.connect_hook = None
+
+        # Whether each scheme:authority has been seen to answer pipelined
+        # requests (True), not to (False), or is yet to be tried (None),
+        # and how long to wait for it to answer them the first time -
+        # see pipeline().
+        self.pipeline_support = {}
+        self.pipeline_timeout = 5
+
     def _auth_from_challenge(self, host, request_uri, headers, response, content):
         """A generator that creates Authorization objects
            that can be applied to requests.
@@ -826,7 +1370,48 @@ the same interface as FileCache."""
         for cred in self.credentials.iter(host):
             for scheme in AUTH_SCHEME_ORDER:
                 if challenges.has_key(scheme):
-                    yield AUTH_SCHEME_CLASSES[scheme](cred, host, request_uri, headers, response, content, self)
+                    authorization = AUTH_SCHEME_CLASSES[scheme](cred, host, request_uri, headers, response, content, self)
+                    authorization.scheme = scheme
+                    yield authorization
+
+    def _add_authorization(self, authorization, replaces=None):
+        """Keep an authorization which has worked, dropping the one
+        (if any) the server has just refused in its place"""
+        if replaces is not None and replaces in self.authorizations:
+            self.authorizations.remove(replaces)
+        self.authorizations.append(authorization)
+
+    def save_authorizations(self):
+        """Return the authorizations negotiated so far, as a list of
+        dictionaries (of strings and numbers) which can be stored and
+        given to load_authorizations later. Credentials are not
+        included."""
+        saved = []
+        for auth in self.authorizations:
+            if auth.scheme in PREEMPTIVE_SCHEMES:
+                saved.append({'scheme': auth.scheme, 'host': auth.host, 'path': auth.path,
+                              'www-authenticate': auth.www_authenticate, 'state': auth.state()})
+        return saved
+
+    def load_authorizations(self, saved):
+        """Re-create authorizations saved by save_authorizations, for
+        hosts this object has credentials for, so that requests to them
+        carry credentials from the first attempt rather than after a
+        401. Authorizations which can't be re-created are skipped."""
+        for entry in saved:
+            if entry.get('scheme') not in PREEMPTIVE_SCHEMES:
+                continue
+            response = Response({'status': '401', 'www-authenticate': entry['www-authenticate']})
+            for cred in self.credentials.iter(entry['host']):
+                try:
+                    authorization = AUTH_SCHEME_CLASSES[entry['scheme']](cred, entry['host'], entry['path'],
+                                                                         {}, response, '', self)
+                except (HttpLib2Error, KeyError, ValueError):
+                    break
+                authorization.scheme = entry['scheme']
+                authorization.restore(entry.get('state', {}))
+                self.authorizations.append(authorization)
+                break
 
     def add_credentials(self, name, password, domain=""):
         """Add a name and password that will be used
@@ -844,6 +1429,37 @@ the same interface as FileCache."""
         self.credentials.clear()
         self.authorizations = []
 
+    def _get_connection(self, scheme, authority, connection_type=None):
+        """Return the cached connection for scheme:authority,
+        creating it if necessary, with the timeouts set for a new
+        request."""
+        conn_key = scheme+":"+authority
+        if conn_key in self.connections:
+            conn = self.connections[conn_key]
+            self._set_timeouts(conn)
+            return conn
+        if not connection_type:
+            connection_type = (scheme == 'https') and HTTPSConnectionWithTimeout or HTTPConnectionWithTimeout
+        certs = list(self.certificates.iter(authority))
+        if scheme == 'https' and certs:
+            conn = self.connections[conn_key] = connection_type(authority, key_file=certs[0][0],
+                cert_file=certs[0][1], timeout=self.timeout, proxy_info=self.proxy_info)
+        else:
+            conn = self.connections[conn_key] = connection_type(authority, timeout=self.timeout, proxy_info=self.proxy_info)
+        conn.set_debuglevel(debuglevel)
+        conn.address_cache = self.address_cache
+        conn.socket_options = self.socket_options
+        conn.connect_hook = self.connect_hook
+        self._set_timeouts(conn)
+        return conn
+
+    def _set_timeouts(self, conn):
+        deadline = None
+        if self.total_timeout is not None:
+            deadline = time.time() + self.total_timeout
+        if hasattr(conn, 'set_timeouts'):
+            conn.set_timeouts(self.connect_timeout, self.timeout, deadline)
+
     def _conn_request(self, conn, request_uri, method, body, headers):
         for i in range(2):
             try:
@@ -863,6 +1479,8 @@ the same interface as FileCache."""
                     conn.connect()
                     continue
                 else:
+                    # Leave the connection ready for the next request
+                    conn.close()
                     raise
             else:
                 content = ""
@@ -875,6 +1493,198 @@ the same interface as FileCache."""
         return (response, content)
 
 
+    def _conn_request_stream(self, conn, request_uri, method, body, headers):
+        """Send the request and return the Response along with the
+        unread httplib response to take the body from."""
+        conn.connect()
+        try:
+            conn.request(method, request_uri, body, headers)
+        except socket.gaierror:
+            conn.close()
+            raise ServerNotFoundError("Unable to find the server at %s" % conn.host)
+        raw = conn.getresponse()
+        return (Response(raw), raw)
+
+    def request_stream(self, uri, method="GET", body=None, headers=None, chunk_size=64*1024, connection_type=None):
+        """Performs a single HTTP request without reading the response
+body up front.
+
+Takes the same arguments as request(). Returns a tuple of (response,
+chunks), where 'chunks' is an iterator over the decompressed entity
+body, 'chunk_size' bytes of the raw body being read at a time.
+
+Authorization is handled as in request(), but redirects are not
+followed and nothing is cached. The iterator must be exhausted before
+the next request is made on the same connection.
+        """
+        if headers is None:
+            headers = {}
+        else:
+            headers = _normalize_headers(headers)
+        if not headers.has_key('user-agent'):
+            headers['user-agent'] = "Python-httplib2/%s" % __version__
+        uri = iri2uri(uri)
+        (scheme, authority, request_uri, defrag_uri) = urlnorm(uri)
+        conn = self._get_connection(scheme, authority, connection_type)
+        if method in ["GET", "HEAD"] and 'range' not in headers and 'accept-encoding' not in headers:
+            headers['accept-encoding'] = 'deflate, gzip'
+
+        auths = [(auth.depth(request_uri), auth) for auth in self.authorizations if auth.inscope(authority, request_uri)]
+        auth = auths and sorted(auths)[0][1] or None
+        if auth:
+            auth.request(method, request_uri, headers, body)
+
+        (response, raw) = self._conn_request_stream(conn, request_uri, method, body, headers)
+
+        if auth and response.status == 401:
+            if auth.response(response, body):
+                # e.g. a stale Digest nonce, which has now been updated
+                raw.read()
+                auth.request(method, request_uri, headers, body)
+                (response, raw) = self._conn_request_stream(conn, request_uri, method, body, headers)
+
+        if response.status == 401:
+            content = raw.read()
+            for authorization in self._auth_from_challenge(authority, request_uri, headers, response, content):
+                authorization.request(method, request_uri, headers, body)
+                (response, raw) = self._conn_request_stream(conn, request_uri, method, body, headers)
+                if response.status != 401:
+                    self._add_authorization(authorization, auth)
+                    authorization.response(response, body)
+                    break
+                raw.read()
+
+        if method == "HEAD":
+            raw.read()
+            return (response, iter([]))
+        return (response, _iterDecompressContent(response, raw, chunk_size))
+
+    def pipeline(self, uri, requests, depth=8, connection_type=None):
+        """Performs several requests to the same 'uri', sending up to
+'depth' of them before waiting for the response to the first (HTTP/1.1
+pipelining), so that a round trip to the server is paid once for many
+small requests rather than once for each.
+
+'requests' is a list of (method, body, headers) tuples, as would be
+given to request(). Returns a list of (response, content) tuples, in
+the same order.
+
+The first request made to a server is made with request(), and only if
+the server answers it with HTTP/1.1 and leaves the connection open are
+the rest pipelined. If those go unanswered for 'pipeline_timeout'
+seconds, or the connection is closed, the server is taken not to
+support pipelining and the requests left are made one at a time - now
+and for the rest of this object's life. The same goes when 'depth' is
+below 2 or a proxy is used. Requests answered with 401 are repeated
+with request(), so credentials are negotiated as usual.
+
+Redirects are not followed and nothing is cached. Requests which were
+sent but not answered before a connection failed are sent again, so
+only pipeline requests which are safe to repeat, and whose bodies are
+small.
+        """
+        results = []
+        remaining = list(requests)
+        uri = iri2uri(uri)
+        (scheme, authority, request_uri, defrag_uri) = urlnorm(uri)
+        conn_key = scheme + ":" + authority
+        retried = False
+        while len(remaining) > 1 and depth > 1 and not self.proxy_info:
+            if conn_key not in self.pipeline_support:
+                # Find out whether the server keeps connections open
+                (method, body, headers) = remaining.pop(0)
+                (response, content) = self.request(uri, method, body, headers, connection_type=connection_type)
+                results.append((response, content))
+                if not response.fromcache:
+                    if response.version >= 11 and response.get('connection', '').lower() != 'close':
+                        self.pipeline_support[conn_key] = None
+                    else:
+                        self.pipeline_support[conn_key] = False
+                continue
+            supported = self.pipeline_support[conn_key]
+            if supported is False:
+                break
+            conn = self._get_connection(scheme, authority, connection_type)
+            answered = self._conn_pipeline(conn, authority, request_uri, remaining, depth,
+                                           supported is None and self.pipeline_timeout or None)
+            if not answered and not retried:
+                # The server may have closed the connection while it was
+                # idle, which says nothing about pipelining
+                retried = True
+                continue
+            if len(answered) > 1:
+                self.pipeline_support[conn_key] = True
+            elif supported is None:
+                self.pipeline_support[conn_key] = False
+            if not answered:
+                break
+            for i, (response, content) in enumerate(answered):
+                if response.status == 401:
+                    (method, body, headers) = remaining[i]
+                    answered[i] = self.request(uri, method, body, headers, connection_type=connection_type)
+            results.extend(answered)
+            remaining = remaining[len(answered):]
+        for (method, body, headers) in remaining:
+            results.append(self.request(uri, method, body, headers, connection_type=connection_type))
+        return results
+
+    def _conn_pipeline(self, conn, authority, request_uri, requests, depth, timeout=None):
+        """Pipeline requests on conn, and return the (response, content)
+of as many as were answered before the connection closed or failed."""
+        answered = []
+        sent = 0
+        try:
+            if conn.sock is None:
+                conn.connect()
+            sock = conn.sock
+            if timeout is not None:
+                sock.settimeout(timeout)
+            fp = _PipelineFile(sock)
+            while len(answered) < len(requests):
+                while sent < len(requests) and sent - len(answered) < depth:
+                    (method, body, headers) = requests[sent]
+                    sock.sendall(self._prepare_pipelined(conn, authority, request_uri, method, body, headers))
+                    sent += 1
+                method = requests[len(answered)][0]
+                raw = httplib.HTTPResponse(fp, strict=conn.strict, method=method)
+                raw.begin()
+                content = ""
+                if method != "HEAD":
+                    content = raw.read()
+                response = Response(raw)
+                if method != "HEAD":
+                    content = _decompressContent(response, content)
+                answered.append((response, content))
+                if raw.will_close:
+                    # Whatever else was sent won't be answered
+                    conn.close()
+                    break
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+        if timeout is not None and conn.sock is not None:
+            conn.sock.settimeout(has_timeout(conn.timeout) and conn.timeout or socket.getdefaulttimeout())
+        return answered
+
+    def _prepare_pipelined(self, conn, authority, request_uri, method, body, headers):
+        """Return the bytes to send for one pipelined request, with
+headers and body prepared as request() would."""
+        if headers is None:
+            headers = {}
+        else:
+            headers = _normalize_headers(headers)
+        if not headers.has_key('user-agent'):
+            headers['user-agent'] = "Python-httplib2/%s" % __version__
+        if method in ["GET", "HEAD"] and 'range' not in headers and 'accept-encoding' not in headers:
+            headers['accept-encoding'] = 'deflate, gzip'
+        if (self.request_encoding and isinstance(body, str) and body and 'content-encoding' not in headers
+                and len(body) >= self.request_compression_threshold):
+            body = _compressContent(headers, body, self.request_encoding)
+        auths = [(auth.depth(request_uri), auth) for auth in self.authorizations if auth.inscope(authority, request_uri)]
+        auth = auths and sorted(auths)[0][1] or None
+        if auth:
+            auth.request(method, request_uri, headers, body)
+        return _format_request(conn, method, request_uri, body, headers)
+
     def _request(self, conn, host, absolute_uri, request_uri, method, body, headers, redirections, cachekey):
         """Do the actual request using the connection object
         and also follow one level of redirects if necessary"""
@@ -898,7 +1708,7 @@ the same interface as FileCache."""
                 authorization.request(method, request_uri, headers, body) 
                 (response, content) = self._conn_request(conn, request_uri, method, body, headers, )
                 if response.status != 401:
-                    self.authorizations.append(authorization)
+                    self._add_authorization(authorization, auth)
                     authorization.response(response, body)
                     break
 
@@ -957,7 +1767,8 @@ The 'method' is the HTTP method to perform, such as GET, POST, DELETE, etc.
 There is no restriction on the methods allowed.
 
 The 'body' is the entity body to be sent with the request. It is a string
-object.
+object, or a FileBody to send files without reading them into memory
+(a FileBody is never compressed).
 
 Any extra headers that are to be sent with the request should be provided in the
 'headers' dictionary.
@@ -986,23 +1797,15 @@ a string that contains the response entity body.
                 scheme = 'https'
                 authority = domain_port[0]
 
-            conn_key = scheme+":"+authority
-            if conn_key in self.connections:
-                conn = self.connections[conn_key]
-            else:
-                if not connection_type:
-                    connection_type = (scheme == 'https') and HTTPSConnectionWithTimeout or HTTPConnectionWithTimeout
-                certs = list(self.certificates.iter(authority))
-                if scheme == 'https' and certs:
-                    conn = self.connections[conn_key] = connection_type(authority, key_file=certs[0][0],
-                        cert_file=certs[0][1], timeout=self.timeout, proxy_info=self.proxy_info)
-                else:
-                    conn = self.connections[conn_key] = connection_type(authority, timeout=self.timeout, proxy_info=self.proxy_info)
-                conn.set_debuglevel(debuglevel)
+            conn = self._get_connection(scheme, authority, connection_type)
 
             if method in ["GET", "HEAD"] and 'range' not in headers and 'accept-encoding' not in headers:
                 headers['accept-encoding'] = 'deflate, gzip'
 
+            if (self.request_encoding and isinstance(body, str) and body and 'content-encoding' not in headers
+                    and len(body) >= self.request_compression_threshold):
+                body = _compressContent(headers, body, self.request_encoding)
+
             info = email.Message.Message()
             cached_value = None
             if self.cache:
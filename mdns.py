@@ -0,0 +1,450 @@
+"""
+Multicast DNS service discovery over plain UDP sockets
+
+An alternative to pybonjour for TrunkDeviceFinder, used when asked for
+or when the host has no DNS-SD library (e.g. Linux without
+libdns_sd.so.1). Queries are sent from an ephemeral port, so
+responders answer by unicast and no mDNS daemon or port 5353 binding
+is needed here.
+
+Records learnt are kept in a RecordCache until their TTL runs out.
+Every search still asks for the service's instances, as any responder
+may have one, but lists those already known (known-answer suppression,
+RFC 6762 7.1) so they aren't sent again, and only asks for the SRV,
+TXT and A records the cache doesn't have.
+Responder answers queries from a fixed set of records, and stands in
+for a device when run on loopback.
+"""
+
+import socket
+import struct
+import select
+import threading
+import time
+
+MDNS_ADDR = '224.0.0.251'
+MDNS_PORT = 5353
+
+TYPE_A = 1
+TYPE_PTR = 12
+TYPE_TXT = 16
+TYPE_SRV = 33
+CLASS_IN = 1
+
+
+class MdnsError(Exception):
+    """
+    Raise if a DNS message can not be parsed
+    """
+    pass
+
+
+def encode_name(name):
+    """
+    >>> encode_name('_http._tcp.local.')
+    '\\x05_http\\x04_tcp\\x05local\\x00'
+
+    @param name: Dotted domain name
+    @return: Name in DNS wire format (uncompressed)
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    parts = []
+    for label in name.rstrip('.').split('.'):
+        if label:
+            parts.append(chr(len(label)) + label)
+    parts.append('\x00')
+    return ''.join(parts)
+
+
+def decode_name(data, offset):
+    """
+    @param data: Complete DNS message
+    @param offset: Where the name starts
+    @return: (dotted name, offset just past the name)
+    """
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        if offset >= len(data):
+            raise MdnsError('name runs past end of message')
+        length = ord(data[offset])
+        if length & 0xc0 == 0xc0:
+            # Compression pointer to an earlier name
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise MdnsError('compression loop')
+            offset = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3fff
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length])
+        offset += length
+    if end is None:
+        end = offset
+    return '.'.join(labels).decode('utf-8', 'replace') + u'.', end
+
+
+def build_query(questions, query_id=0, known=()):
+    """
+    @param questions: List of (name, rrtype)
+    @param query_id: DNS message id
+    @param known: Answers already known, as (name, rrtype, ttl, rdata),
+        for responders not to send again
+    @return: Query message
+    """
+    message = [struct.pack('!HHHHHH', query_id, 0, len(questions), len(known), 0, 0)]
+    for name, rrtype in questions:
+        message.append(encode_name(name) + struct.pack('!HH', rrtype, CLASS_IN))
+    for record in known:
+        message.append(_encode_record(*record))
+    return ''.join(message)
+
+
+def _parse_rdata(data, rrtype, offset, length):
+    if rrtype == TYPE_PTR:
+        return decode_name(data, offset)[0]
+    elif rrtype == TYPE_SRV:
+        priority, weight, port = struct.unpack('!HHH', data[offset:offset + 6])
+        return (decode_name(data, offset + 6)[0], port)
+    elif rrtype == TYPE_A:
+        return socket.inet_ntoa(data[offset:offset + 4])
+    elif rrtype == TYPE_TXT:
+        strings = []
+        end = offset + length
+        while offset < end:
+            n = ord(data[offset])
+            strings.append(data[offset + 1:offset + 1 + n])
+            offset += 1 + n
+        return strings
+    return data[offset:offset + length]
+
+
+def _encode_rdata(rrtype, rdata):
+    if rrtype == TYPE_PTR:
+        return encode_name(rdata)
+    elif rrtype == TYPE_SRV:
+        target, port = rdata
+        return struct.pack('!HHH', 0, 0, port) + encode_name(target)
+    elif rrtype == TYPE_A:
+        return socket.inet_aton(rdata)
+    elif rrtype == TYPE_TXT:
+        return ''.join(chr(len(string)) + string for string in rdata) or '\x00'
+    return rdata
+
+
+def _encode_record(name, rrtype, ttl, rdata):
+    rdata = _encode_rdata(rrtype, rdata)
+    return encode_name(name) + struct.pack('!HHIH', rrtype, CLASS_IN, ttl, len(rdata)) + rdata
+
+
+def build_response(records, query_id=0):
+    """
+    @param records: List of (name, rrtype, ttl, rdata), as returned
+        by parse_message
+    @param query_id: DNS message id
+    @return: Authoritative response message
+    """
+    message = [struct.pack('!HHHHHH', query_id, 0x8400, 0, len(records), 0, 0)]
+    for record in records:
+        message.append(_encode_record(*record))
+    return ''.join(message)
+
+
+def parse_questions(data):
+    """
+    @param data: DNS message
+    @return: List of (name, rrtype) questions in the message
+    """
+    try:
+        qdcount = struct.unpack('!H', data[4:6])[0]
+        offset = 12
+        questions = []
+        for i in range(qdcount):
+            name, offset = decode_name(data, offset)
+            rrtype = struct.unpack('!H', data[offset:offset + 2])[0]
+            questions.append((name, rrtype))
+            offset += 4
+    except (struct.error, IndexError), e:
+        raise MdnsError('truncated message: %s' % (e, ))
+    return questions
+
+
+def parse_message(data):
+    """
+    Parse the resource records from every section of a DNS message
+
+    @param data: DNS message
+    @return: List of (name, rrtype, ttl, rdata) where rdata is a name
+        for PTR, (target, port) for SRV, a dotted quad for A, a list
+        of strings for TXT, and raw bytes otherwise.
+    """
+    try:
+        (query_id, flags, qdcount, ancount, nscount,
+         arcount) = struct.unpack('!HHHHHH', data[:12])
+        offset = 12
+        for i in range(qdcount):
+            offset = decode_name(data, offset)[1] + 4
+        records = []
+        for i in range(ancount + nscount + arcount):
+            name, offset = decode_name(data, offset)
+            rrtype, rrclass, ttl, length = struct.unpack('!HHIH', data[offset:offset + 10])
+            offset += 10
+            records.append((name, rrtype, ttl, _parse_rdata(data, rrtype, offset, length)))
+            offset += length
+    except (struct.error, IndexError), e:
+        raise MdnsError('truncated message: %s' % (e, ))
+    return records
+
+
+def parse_txt(strings):
+    """
+    >>> sorted(parse_txt(['path=/', 'txtvers=1', 'flag']).items())
+    [('flag', None), ('path', '/'), ('txtvers', '1')]
+
+    @param strings: TXT record strings
+    @return: Dictionary of key/value pairs (None for bare keys)
+    """
+    txt = {}
+    for string in strings:
+        if '=' in string:
+            key, value = string.split('=', 1)
+            txt[key] = value
+        elif string:
+            txt[string] = None
+    return txt
+
+
+class RecordCache(object):
+    """
+    Resource records, each kept until its TTL runs out
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        # (lower cased name, rrtype) -> {rdata: expiry time}
+        self._records = {}
+
+    def add(self, name, rrtype, ttl, rdata):
+        """
+        Record an answer. A TTL of zero is a goodbye, and removes it.
+        """
+        if isinstance(rdata, list):
+            rdata = tuple(rdata)
+        key = (name.lower(), rrtype)
+        if ttl == 0:
+            self._records.get(key, {}).pop(rdata, None)
+        else:
+            self._records.setdefault(key, {})[rdata] = self.clock() + ttl
+
+    def get(self, name, rrtype):
+        """
+        @return: List of unexpired rdata for name and rrtype
+        """
+        return [rdata for rdata, ttl in self.ttls(name, rrtype)]
+
+    def ttls(self, name, rrtype):
+        """
+        @return: List of (rdata, seconds left) for name and rrtype
+        """
+        key = (name.lower(), rrtype)
+        now = self.clock()
+        answers = self._records.get(key, {})
+        for rdata, expires in answers.items():
+            if expires <= now:
+                del answers[rdata]
+        return [(rdata, int(expires - now)) for rdata, expires in answers.items()]
+
+    def clear(self):
+        self._records.clear()
+
+
+class Browser(object):
+    """
+    Finds service instances with PTR, SRV, TXT and A queries
+
+    >>> responder = Responder([
+    ...     ('_http._tcp.local.', TYPE_PTR, 4500, 'TrunkNotes._http._tcp.local.'),
+    ...     ('TrunkNotes._http._tcp.local.', TYPE_SRV, 120, ('Fly.local.', 10000)),
+    ...     ('TrunkNotes._http._tcp.local.', TYPE_TXT, 4500, ['path=/']),
+    ...     ('Fly.local.', TYPE_A, 120, '127.0.0.1')])
+    >>> browser = Browser(address=responder.address)
+    >>> browser.cache.add('_http._tcp.local.', TYPE_PTR, 4500, u'Printer._http._tcp.local.')
+    >>> browser.cache.add('Printer._http._tcp.local.', TYPE_SRV, 120, (u'Printer.local.', 631))
+    >>> browser.cache.add('Printer.local.', TYPE_A, 120, '127.0.0.2')
+    >>> for result in browser.browse('_http._tcp.local.', timeout=0.5):
+    ...     print result
+    (u'Printer._http._tcp.local.', u'Printer.local.', 631, '127.0.0.2', {})
+    (u'TrunkNotes._http._tcp.local.', u'Fly.local.', 10000, '127.0.0.1', {'path': '/'})
+    >>> browser.browse('_http._tcp.local.', timeout=0.5)[1][0]
+    u'TrunkNotes._http._tcp.local.'
+    >>> responder.queries[-1] == [('_http._tcp.local.', TYPE_PTR), ('Printer._http._tcp.local.', TYPE_TXT)]
+    True
+    >>> responder.close()
+    """
+
+    def __init__(self, address=(MDNS_ADDR, MDNS_PORT), cache=None):
+        """
+        @param address: Where to send queries (the mDNS group by default)
+        @param cache: RecordCache to use, a new one if None
+        """
+        self.address = address
+        self.cache = cache or RecordCache()
+
+    def _missing(self, regtype):
+        """
+        @return: Questions about the known instances of regtype that
+            the cache can not yet answer
+        """
+        questions = []
+        for instance in self.cache.get(regtype, TYPE_PTR):
+            srvs = self.cache.get(instance, TYPE_SRV)
+            if not srvs:
+                questions.append((instance, TYPE_SRV))
+            if not self.cache.get(instance, TYPE_TXT):
+                questions.append((instance, TYPE_TXT))
+            for target, port in srvs:
+                if not self.cache.get(target, TYPE_A):
+                    questions.append((target, TYPE_A))
+        return questions
+
+    def _results(self, regtype):
+        results = []
+        for instance in sorted(self.cache.get(regtype, TYPE_PTR)):
+            for target, port in self.cache.get(instance, TYPE_SRV):
+                addresses = self.cache.get(target, TYPE_A)
+                txt = {}
+                for strings in self.cache.get(instance, TYPE_TXT):
+                    txt.update(parse_txt(strings))
+                results.append((instance, target, port, addresses and addresses[0] or None, txt))
+        return results
+
+    def browse(self, regtype='_http._tcp.local.', timeout=2):
+        """
+        Find instances of a service type, collecting answers for the
+        whole of timeout, as any number of responders may answer. The
+        instances are always asked for, listing those in the cache as
+        known answers; of their other records, only those missing from
+        the cache (or expired) are asked for.
+
+        @param regtype: Service type, e.g. _http._tcp.local.
+        @param timeout: Seconds to wait for answers
+
+        @return: List of (fullname, hosttarget, port, ip address or
+            None, TXT dictionary)
+        """
+        questions = [(regtype, TYPE_PTR)] + self._missing(regtype)
+        known = [(regtype, TYPE_PTR, ttl, instance) for instance, ttl in self.cache.ttls(regtype, TYPE_PTR)]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+        asked = set()
+        try:
+            deadline = time.time() + timeout
+            while True:
+                if questions:
+                    asked.update(questions)
+                    sock.sendto(build_query(questions, known=known), self.address)
+                    known = []
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                ready = select.select([sock], [], [], remaining)
+                if not ready[0]:
+                    break
+                try:
+                    records = parse_message(sock.recvfrom(9000)[0])
+                except MdnsError:
+                    continue
+                for name, rrtype, ttl, rdata in records:
+                    self.cache.add(name, rrtype, ttl, rdata)
+                # Ask for whatever the responders didn't volunteer
+                questions = [q for q in self._missing(regtype) if q not in asked]
+        finally:
+            sock.close()
+        return self._results(regtype)
+
+
+def browse(regtype='_http._tcp.local.', timeout=2, address=(MDNS_ADDR, MDNS_PORT)):
+    """
+    Find instances of a service type, with a fresh cache
+
+    @return: See Browser.browse
+    """
+    return Browser(address).browse(regtype, timeout)
+
+
+class Responder(object):
+    """
+    Answers unicast queries from a fixed set of records, in a
+    background thread. Bound to loopback, it stands in for a device
+    when trying out or testing discovery.
+    """
+
+    def __init__(self, records, address=('127.0.0.1', 0)):
+        """
+        @param records: List of (name, rrtype, ttl, rdata)
+        @param address: Where to listen; port 0 picks a free port
+        """
+        self.records = records
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        # Wake up now and then to notice close()
+        self.sock.settimeout(0.2)
+        self.address = self.sock.getsockname()
+        self.queries = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def answers(self, questions, known=()):
+        """
+        @param known: Known answers listed in the query, as (name,
+            rrtype, ttl, rdata)
+        @return: Records answering questions, with the SRV, TXT and A
+            records a real responder would add alongside a PTR answer,
+            less the known answers with at least half their TTL left
+        """
+        suppressed = [record for record in self.records
+                      for name, rrtype, ttl, rdata in known
+                      if (record[0].lower(), record[1], record[3]) == (name.lower(), rrtype, rdata)
+                      and ttl >= record[2] / 2]
+        wanted = list(questions)
+        answers = []
+        for name, rrtype in wanted:
+            for record in self.records:
+                if record in suppressed:
+                    continue
+                if record[0].lower() == name.lower() and record[1] == rrtype and record not in answers:
+                    answers.append(record)
+                    if rrtype == TYPE_PTR:
+                        wanted.extend([(record[3], TYPE_SRV), (record[3], TYPE_TXT)])
+                    elif rrtype == TYPE_SRV:
+                        wanted.append((record[3][0], TYPE_A))
+        return answers
+
+    def _serve(self):
+        while not self._closed:
+            try:
+                data, peer = self.sock.recvfrom(9000)
+            except socket.timeout:
+                continue
+            try:
+                questions = parse_questions(data)
+                known = parse_message(data)
+            except MdnsError:
+                continue
+            self.queries.append(questions)
+            answers = self.answers(questions, known)
+            if answers:
+                query_id = struct.unpack('!H', data[:2])[0]
+                self.sock.sendto(build_response(answers, query_id), peer)
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+        self.sock.close()
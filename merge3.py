@@ -0,0 +1,152 @@
+"""
+Line based three-way merge
+
+Used by SyncAnalyser to combine a note edited both on the device and
+locally, given the body both sides had at the last sync. Lines are
+matched with a patience diff (anchoring on lines which occur once on
+each side), which is close to linear in the length of the note rather
+than quadratic like difflib.
+"""
+
+import bisect
+
+
+def _longest_increasing(pairs):
+    """
+    >>> _longest_increasing([(0, 2), (1, 0), (2, 1), (3, 3)])
+    [(1, 0), (2, 1), (3, 3)]
+
+    @param pairs: (i, j) pairs, in increasing order of i
+    @return: Longest subsequence of pairs with j also increasing
+    """
+    tails = []        # j of the last pair of the best run of each length
+    tail_index = []   # index into pairs of that last pair
+    previous = [None] * len(pairs)
+    for n, (i, j) in enumerate(pairs):
+        k = bisect.bisect_left(tails, j)
+        if k:
+            previous[n] = tail_index[k - 1]
+        if k == len(tails):
+            tails.append(j)
+            tail_index.append(n)
+        else:
+            tails[k] = j
+            tail_index[k] = n
+    result = []
+    n = tail_index and tail_index[-1] or None
+    while n is not None:
+        result.append(pairs[n])
+        n = previous[n]
+    result.reverse()
+    return result
+
+
+def matching_lines(a, b):
+    """
+    >>> matching_lines(['x', 'a', 'b', 'c'], ['a', 'b', 'y', 'c'])
+    [(1, 0), (2, 1), (3, 3)]
+
+    @param a: List of lines
+    @param b: List of lines
+    @return: Increasing list of (i, j) where a[i] == b[j]
+    """
+    matches = []
+    ranges = [(0, len(a), 0, len(b))]
+    while ranges:
+        alo, ahi, blo, bhi = ranges.pop()
+        # Common prefix and suffix match outright
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        # Anchor on lines which occur exactly once on each side
+        counts = {}
+        for i in xrange(alo, ahi):
+            line = a[i]
+            if line in counts:
+                counts[line][0] = None
+            else:
+                counts[line] = [i, None, 0]
+        for j in xrange(blo, bhi):
+            entry = counts.get(b[j])
+            if entry is not None:
+                entry[1] = j
+                entry[2] += 1
+        unique = sorted((entry[0], entry[1]) for entry in counts.itervalues()
+                        if entry[0] is not None and entry[2] == 1)
+        anchors = _longest_increasing(unique)
+        if not anchors:
+            # Nothing to anchor on, so the range is a single change
+            continue
+        matches.extend(anchors)
+        # Match within the gaps between anchors
+        i, j = alo, blo
+        for ai, bj in anchors:
+            ranges.append((i, ai, j, bj))
+            i, j = ai + 1, bj + 1
+        ranges.append((i, ahi, j, bhi))
+    matches.sort()
+    return matches
+
+
+def merge3(base, a, b):
+    """
+    Merge two edited versions of base, line by line
+
+    >>> base = ['one\\n', 'two\\n', 'three\\n', 'four\\n']
+    >>> merge3(base, ['ONE\\n', 'two\\n', 'three\\n', 'four\\n'],
+    ...              ['one\\n', 'two\\n', 'three\\n', 'FOUR\\n'])
+    (['ONE\\n', 'two\\n', 'three\\n', 'FOUR\\n'], 0)
+    >>> merge3(base, ['ONE\\n', 'two\\n'], ['One\\n', 'two\\n'])
+    (None, 1)
+
+    @param base: Lines both versions started from
+    @param a: Lines of one edited version
+    @param b: Lines of the other edited version
+
+    @return: (merged lines, 0), or (None, number of overlapping
+        changes) if the edits could not be combined
+    """
+    in_a = dict(matching_lines(base, a))
+    in_b = dict(matching_lines(base, b))
+    merged = []
+    conflicts = 0
+    i = ia = ib = 0
+    # Base lines kept by both sides are fixed points, and the chunks
+    # between them are where either side (or both) made changes.
+    sync_points = [(n, in_a[n], in_b[n]) for n in xrange(len(base))
+                   if n in in_a and n in in_b]
+    sync_points.append((len(base), len(a), len(b)))
+    for n, na, nb in sync_points:
+        base_chunk, a_chunk, b_chunk = base[i:n], a[ia:na], b[ib:nb]
+        if a_chunk == base_chunk:
+            merged.extend(b_chunk)
+        elif b_chunk == base_chunk or a_chunk == b_chunk:
+            merged.extend(a_chunk)
+        else:
+            conflicts += 1
+        if n < len(base):
+            merged.append(base[n])
+        i, ia, ib = n + 1, na + 1, nb + 1
+    if conflicts:
+        return None, conflicts
+    return merged, 0
+
+
+def merge_text(base, a, b):
+    """
+    @param base: Text both versions started from
+    @param a: One edited version
+    @param b: The other edited version
+    @return: Merged text, or None if the edits overlap
+    """
+    merged, conflicts = merge3(base.splitlines(True), a.splitlines(True), b.splitlines(True))
+    if merged is None:
+        return None
+    return type(base)().join(merged)
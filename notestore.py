@@ -0,0 +1,286 @@
+"""
+Content-addressed store of note bodies
+
+Bodies are stored once each, zlib compressed and named by the SHA-1 of
+their UTF-8 encoding, so notes which share a body (or a body which
+comes back after being changed) cost nothing extra. Bodies are
+appended to pack files, which are never rewritten, and found through
+an index of where each one starts.
+
+On top of the bodies the store keeps:
+
+ - the base of each note: the body it had on both the device and
+   locally at the end of the last sync, which is what a three-way
+   merge needs when a note is then edited on both sides.
+ - a manifest per sync, listing every note with its device timestamp
+   and body, so any past version of a note is an index lookup away.
+
+Layout, under the store directory::
+
+    packs/pack-0001.pack   compressed bodies, appended to
+    packs/index            "<sha1> <pack> <offset> <length>" per body
+    manifests/<time>       "<sha1> <timestamp> <title>" per note, UTF-8
+    bases                  "<sha1> <title>" per note, UTF-8
+"""
+
+import os
+import zlib
+import time
+import codecs
+import hashlib
+import calendar
+
+# Start a new pack file once the current one reaches this size
+PACK_SIZE = 16 * 1024 * 1024
+
+MANIFEST_TIME_FORMAT = '%Y%m%dT%H%M%SZ'
+
+# Accepted by find_manifest, all UTC
+WHEN_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M',
+                '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+
+
+def blob_id(body):
+    """
+    >>> blob_id(u'Title: HomePage\\n')
+    '00fbd40ff1ba2cd2259c33c6272c09c9e6bb6897'
+
+    @param body: Note body (unicode)
+    @return: Hex SHA-1 naming the body in the store
+    """
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+def parse_when(when):
+    """
+    >>> parse_when('2011-01-31 12:30')
+    1296477000
+
+    @param when: UTC time in one of WHEN_FORMATS
+    @return: Seconds since the epoch, or None if when isn't a time
+    """
+    for format in WHEN_FORMATS:
+        try:
+            return calendar.timegm(time.strptime(when, format))
+        except ValueError:
+            pass
+    return None
+
+
+def manifest_time(name):
+    """
+    >>> manifest_time('20110131T123000Z-1')
+    1296477000
+
+    @return: Seconds since the epoch at which manifest name was taken
+    """
+    return calendar.timegm(time.strptime(name.split('-')[0], MANIFEST_TIME_FORMAT))
+
+
+def _replace(path, lines):
+    """
+    Write lines to path through a temporary file, so an interrupted
+    sync leaves either the old or the new file in place
+    """
+    with codecs.open(path + '.tmp', 'w', 'utf-8') as f:
+        f.writelines(lines)
+    if os.path.exists(path):
+        # os.rename will not replace a file on Windows
+        os.remove(path)
+    os.rename(path + '.tmp', path)
+
+
+class NoteStore(object):
+
+    def __init__(self, path, fold=None):
+        """
+        @param path: Directory holding the store, created when first written
+        @param fold: Function mapping a title to its comparison key,
+            so bases are found however the title's case has changed
+        """
+        self.path = path
+        self.fold = fold or (lambda name: name)
+        self._index = None
+        self._bases = None
+        self._dirty = False
+
+    def _pack_path(self, pack):
+        return os.path.join(self.path, 'packs', 'pack-%04d.pack' % (pack, ))
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = {}
+            path = os.path.join(self.path, 'packs', 'index')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    for line in f:
+                        atoms = line.split()
+                        if len(atoms) == 4:
+                            self._index[atoms[0]] = (int(atoms[1]), int(atoms[2]), int(atoms[3]))
+        return self._index
+
+    def _current_pack(self):
+        """
+        @return: Number of the pack to append to
+        """
+        pack = max([entry[0] for entry in self._load_index().itervalues()] or [1])
+        path = self._pack_path(pack)
+        if os.path.exists(path) and os.path.getsize(path) >= PACK_SIZE:
+            pack += 1
+        return pack
+
+    def put(self, body):
+        """
+        @param body: Note body (unicode)
+        @return: Its blob id
+        """
+        sha = blob_id(body)
+        index = self._load_index()
+        if sha in index:
+            return sha
+        packs_dir = os.path.join(self.path, 'packs')
+        if not os.path.isdir(packs_dir):
+            os.makedirs(packs_dir)
+        data = zlib.compress(body.encode('utf-8'))
+        pack = self._current_pack()
+        with open(self._pack_path(pack), 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+        # The body is only indexed once it is wholly in the pack, so an
+        # interrupted write just leaves unreachable bytes at the end
+        with open(os.path.join(packs_dir, 'index'), 'ab') as f:
+            f.write('%s %d %d %d\n' % (sha, pack, offset, len(data)))
+        index[sha] = (pack, offset, len(data))
+        return sha
+
+    def get(self, sha):
+        """
+        @return: Body stored under sha, or None if there is none
+        """
+        entry = self._load_index().get(sha)
+        if entry is None:
+            return None
+        pack, offset, length = entry
+        try:
+            with open(self._pack_path(pack), 'rb') as f:
+                f.seek(offset)
+                return zlib.decompress(f.read(length)).decode('utf-8')
+        except (IOError, zlib.error):
+            return None
+
+    def _load_bases(self):
+        if self._bases is None:
+            self._bases = {}
+            path = os.path.join(self.path, 'bases')
+            if os.path.exists(path):
+                with codecs.open(path, 'r', 'utf-8') as f:
+                    for line in f:
+                        sha, _, name = line.rstrip(u'\n').partition(u' ')
+                        if name:
+                            self._bases[self.fold(name)] = (name, str(sha))
+        return self._bases
+
+    def base_id(self, name):
+        """
+        @return: Blob id of the note's base, or None if unknown
+        """
+        entry = self._load_bases().get(self.fold(name))
+        return entry and entry[1]
+
+    def get_base(self, name):
+        """
+        @param name: Note title
+        @return: Body of the note at the last sync, or None if unknown
+        """
+        sha = self.base_id(name)
+        if sha is None:
+            return None
+        return self.get(sha)
+
+    def set_base(self, name, body):
+        """
+        Record body as the note's content on both sides
+
+        @return: Blob id of body
+        """
+        sha = self.put(body)
+        self._load_bases()[self.fold(name)] = (name, sha)
+        self._dirty = True
+        return sha
+
+    def forget_base(self, name):
+        if self._load_bases().pop(self.fold(name), None) is not None:
+            self._dirty = True
+
+    def save(self):
+        """
+        Write out the bases, if they have changed
+        """
+        if not self._dirty:
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        _replace(os.path.join(self.path, 'bases'),
+                 [u'%s %s\n' % (sha, name) for name, sha in sorted(self._bases.itervalues())])
+        self._dirty = False
+
+    def snapshot(self, entries, when=None):
+        """
+        Record a manifest of the notes as they are now
+
+        @param entries: List of (title, timestamp, blob id)
+        @param when: Time of the snapshot, seconds since the epoch
+        @return: Name of the manifest
+        """
+        manifests_dir = os.path.join(self.path, 'manifests')
+        if not os.path.isdir(manifests_dir):
+            os.makedirs(manifests_dir)
+        name = base_name = time.strftime(MANIFEST_TIME_FORMAT, time.gmtime(when))
+        suffix = 0
+        while os.path.exists(os.path.join(manifests_dir, name)):
+            suffix += 1
+            name = '%s-%d' % (base_name, suffix)
+        _replace(os.path.join(manifests_dir, name),
+                 [u'%s %d %s\n' % (sha, timestamp, title) for title, timestamp, sha in sorted(entries)])
+        return name
+
+    def manifests(self):
+        """
+        @return: Names of all manifests, oldest first
+        """
+        manifests_dir = os.path.join(self.path, 'manifests')
+        if not os.path.isdir(manifests_dir):
+            return []
+        return sorted(name for name in os.listdir(manifests_dir) if not name.endswith('.tmp'))
+
+    def find_manifest(self, when):
+        """
+        @param when: Manifest name, or a time accepted by parse_when
+        @return: Name of that manifest, or of the last one taken at or
+            before that time; None if there is no such manifest
+        """
+        names = self.manifests()
+        if when in names:
+            return when
+        seconds = parse_when(when)
+        if seconds is None:
+            return None
+        found = None
+        for name in names:
+            if manifest_time(name) > seconds:
+                break
+            found = name
+        return found
+
+    def read_manifest(self, name):
+        """
+        @return: List of (title, timestamp, blob id) recorded in manifest name
+        """
+        entries = []
+        with codecs.open(os.path.join(self.path, 'manifests', name), 'r', 'utf-8') as f:
+            for line in f:
+                atoms = line.rstrip(u'\n').split(u' ', 2)
+                if len(atoms) == 3:
+                    entries.append((atoms[2], int(atoms[1]), str(atoms[0])))
+        return entries
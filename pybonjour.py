@@ -80,18 +80,36 @@ class _DummyLock(object):
     def release():
         pass
 
-_global_lock = _DummyLock()
+# The lock actually held around library calls. Replaced with a real
+# RLock by _load_library() if libdns_sd turns out to be Avahi.
+_lock = _DummyLock()
 
+# Loaded on first use by _load_library()
+_libdnssd = None
+
+
+def _load_library():
+
+    """
+
+    Load the DNS-SD library, the first time it is needed, and return
+    it.  Raises OSError if no DNS-SD library is installed.
+
+    """
+
+    global _libdnssd, _lock
+
+    if _libdnssd is not None:
+        return _libdnssd
+
+    if sys.platform == 'win32':
+        _libdnssd = ctypes.windll.dnssd
+        return _libdnssd
 
-if sys.platform == 'win32':
-    # Need to use the stdcall variants
-    _libdnssd = ctypes.windll.dnssd
-    _CFunc = ctypes.WINFUNCTYPE
-else:
     if sys.platform == 'darwin':
-        _libdnssd = 'libSystem.B.dylib'
+        libname = 'libSystem.B.dylib'
     else:
-        _libdnssd = 'libdns_sd.so.1'
+        libname = 'libdns_sd.so.1'
 
         # If libdns_sd is actually Avahi's Bonjour compatibility
         # layer, silence its annoying warning messages, and use a real
@@ -104,9 +122,48 @@ else:
         else:
             os.environ['AVAHI_COMPAT_NOWARN'] = '1'
             import threading
-            _global_lock = threading.RLock()
+            _lock = threading.RLock()
+
+    _libdnssd = ctypes.cdll.LoadLibrary(libname)
+    return _libdnssd
 
-    _libdnssd = ctypes.cdll.LoadLibrary(_libdnssd)
+
+def library_available():
+
+    """
+
+    Return True if a DNS-SD library can be loaded on this host.
+
+    """
+
+    try:
+        _load_library()
+    except OSError:
+        return False
+    return True
+
+
+class _LibraryLock(object):
+
+    # Every call into the library is made holding _global_lock, so
+    # taking it is where the library gets loaded.
+
+    @staticmethod
+    def acquire():
+        _load_library()
+        _lock.acquire()
+
+    @staticmethod
+    def release():
+        _lock.release()
+
+_global_lock = _LibraryLock()
+
+
+if sys.platform == 'win32':
+    # Need to use the stdcall variants
+    _CFunc = ctypes.WINFUNCTYPE
+else:
     _CFunc = ctypes.CFUNCTYPE
 
 
@@ -576,7 +633,7 @@ _DNSServiceQueryRecordReply = _CFunc(
 
 
 
-def _create_function_bindings():
+def _function_specs():
 
     ERRCHECK    = True
     NO_ERRCHECK = False
@@ -803,26 +860,74 @@ def _create_function_bindings():
 
         }
 
+    return specs
+
+
+# Bound functions, by name. Each is only created (and its symbol
+# looked up) the first time it is called.
+_specs = None
+_functions = {}
+
+
+def _function(name):
+
+    """
+
+    Return the ctypes binding for the DNS-SD function 'name', creating
+    it on first use.
+
+    """
+
+    try:
+        return _functions[name]
+    except KeyError:
+        pass
+
+    global _specs
+    if _specs is None:
+        _specs = _function_specs()
+
+    restype, errcheck, outparam, argtypes = _specs[name]
+    prototype = _CFunc(restype, *argtypes)
+
+    paramflags = [1] * len(argtypes)
+    if outparam is not None:
+        paramflags[outparam] = 2
+    paramflags = tuple((val,) for val in paramflags)
+
+    func = prototype((name, _load_library()), paramflags)
+
+    if errcheck:
+        func.errcheck = BonjourError._errcheck
+
+    _functions[name] = func
+    return func
 
-    for name, (restype, errcheck, outparam, argtypes) in specs.iteritems():
-        prototype = _CFunc(restype, *argtypes)
 
-        paramflags = [1] * len(argtypes)
-        if outparam is not None:
-            paramflags[outparam] = 2
-        paramflags = tuple((val,) for val in paramflags)
+class _LazyFunction(object):
 
-        func = prototype((name, _libdnssd), paramflags)
+    # Stands in for the binding of a DNS-SD function until the first
+    # call, when it binds the real function and replaces itself.
 
-        if errcheck:
-            func.errcheck = BonjourError._errcheck
+    def __init__(self, name):
+        self.name = name
 
-        globals()['_' + name] = func
+    def __call__(self, *args):
+        func = _function(self.name)
+        globals()['_' + self.name] = func
+        return func(*args)
 
 
-# Only need to do this once
-_create_function_bindings()
-del _create_function_bindings
+for _name in ('DNSServiceRefSockFD', 'DNSServiceProcessResult',
+              'DNSServiceRefDeallocate', 'DNSServiceEnumerateDomains',
+              'DNSServiceRegister', 'DNSServiceAddRecord',
+              'DNSServiceUpdateRecord', 'DNSServiceRemoveRecord',
+              'DNSServiceBrowse', 'DNSServiceResolve',
+              'DNSServiceCreateConnection', 'DNSServiceRegisterRecord',
+              'DNSServiceQueryRecord', 'DNSServiceReconfirmRecord',
+              'DNSServiceConstructFullName'):
+    globals()['_' + _name] = _LazyFunction(_name)
+del _name
 
 
 
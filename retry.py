@@ -0,0 +1,231 @@
+"""
+Retrying requests to the device
+
+A sync makes hundreds of requests over Wi-Fi, so one of them failing
+shouldn't end it. RetryPolicy.call makes a request again after a
+failure, waiting longer each time (exponential backoff, with full
+jitter so that workers which failed together don't retry together).
+
+Whether a failed request may be made again depends on the request and
+the failure. A request which reads (get_note, notes_list) can always be
+repeated. One which changes something (update_note, remove_note) is
+only repeated when the failure shows it never reached the device, such
+as a refused connection or a 503, since otherwise it may have been
+carried out already. The caller classifies failures - see
+RetryPolicy.call.
+
+A CircuitBreaker stops requests for a while once several in a row have
+failed, e.g. while the phone is locked or out of range, and lets them
+go again after a pause. So a long outage pauses the sync rather than
+ending it, unless it lasts longer than max_pause, or than there is
+time for before RetryPolicy.deadline.
+"""
+
+import time
+import random
+import logging
+import threading
+
+# Failure classes, from RetryPolicy.call's classify
+UNSENT = 'unsent'   # the request never reached the device
+FAILED = 'failed'   # the request may or may not have been carried out
+
+
+class CircuitOpen(Exception):
+    """
+    Requests to the device have been failing for longer than max_pause
+    """
+    pass
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, threshold=3, cooldown=10.0, max_cooldown=60.0, max_pause=600.0,
+                 sleep=time.sleep, clock=time.time):
+        """
+        @param threshold: Failures in a row which stop requests
+        @param cooldown: Seconds requests are stopped for at first,
+            doubling each time the breaker trips again before a success
+        @param max_cooldown: Longest pause
+        @param max_pause: Seconds after which an outage is given up on
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_pause = max_pause
+        self.sleep = sleep
+        self.clock = clock
+        self.failures = 0
+        self.trips = 0
+        self.paused = 0.0
+        # Time requests may go again, while open
+        self._open_until = None
+        # Time of the first failure of the current outage
+        self._outage_started = None
+        self._next_cooldown = cooldown
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return self._open_until is not None
+
+    def before(self, deadline=None):
+        """
+        Wait, if the breaker is open, until requests may go again
+
+        @param deadline: Time (from clock) by which requests must be done,
+            or None
+        @raise CircuitOpen: If the outage has lasted more than max_pause,
+            or the pause would last past the deadline
+        """
+        with self._lock:
+            if self._open_until is None:
+                return
+            if self.clock() - self._outage_started > self.max_pause:
+                raise CircuitOpen('Device not responding for over %d seconds' % (self.max_pause, ))
+            if deadline is not None and self._open_until > deadline:
+                raise CircuitOpen('Device not responding, and out of time to wait for it')
+            wait = self._open_until - self.clock()
+        if wait > 0:
+            self.sleep(wait)
+            with self._lock:
+                self.paused += wait
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._open_until = None
+            self._outage_started = None
+            self._next_cooldown = self.cooldown
+
+    def failure(self):
+        """
+        >>> now = [0]
+        >>> breaker = CircuitBreaker(threshold=2, cooldown=5, clock=lambda: now[0])
+        >>> breaker.failure(); breaker.is_open()
+        False
+        >>> breaker.failure(); breaker.is_open(), breaker.trips
+        (True, 1)
+        """
+        with self._lock:
+            now = self.clock()
+            if self._outage_started is None:
+                self._outage_started = now
+            self.failures += 1
+            # Once open, a failure after the pause opens it again at once
+            if self.failures >= self.threshold or self._open_until is not None:
+                if self._open_until is None or now >= self._open_until:
+                    self.trips += 1
+                    cooldown = self._next_cooldown
+                    self._next_cooldown = min(self.max_cooldown, cooldown * 2)
+                    self._open_until = now + cooldown
+                    logging.warn('Device not responding, pausing for %g seconds' % (cooldown, ))
+
+
+class RetryPolicy(object):
+
+    def __init__(self, attempts=4, base_delay=0.5, max_delay=20.0, breaker=None,
+                 deadline=None, sleep=time.sleep, random=random.random, clock=time.time):
+        """
+        @param attempts: Tries at a request before giving up, while the
+            breaker (if any) is closed
+        @param base_delay: Most seconds to wait before the first retry,
+            doubling for each one after
+        @param max_delay: Most seconds to wait before any retry
+        @param breaker: CircuitBreaker shared by all requests, or None
+        @param deadline: Time (from clock) after which requests are no
+            longer retried, or None
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+        self.deadline = deadline
+        self.sleep = sleep
+        self.random = random
+        self.clock = clock
+        self.retries = 0
+
+    def delay(self, retry):
+        """
+        >>> RetryPolicy(random=lambda: 1.0).delay(3)
+        4.0
+
+        @param retry: Number of retries made so far
+        @return: Seconds to wait before the next, anywhere up to the
+            exponential backoff for that retry
+        """
+        return self.random() * min(self.max_delay, self.base_delay * 2 ** retry)
+
+    def call(self, func, idempotent, classify, name=''):
+        """
+        Call func until it succeeds, or fails in a way that can't be retried
+
+        >>> def flaky(failures=[IOError('timed out'), IOError('timed out')]):
+        ...     if failures:
+        ...         raise failures.pop()
+        ...     return 'OK'
+        >>> policy = RetryPolicy(sleep=lambda seconds: None)
+        >>> policy.call(flaky, True, lambda e: FAILED), policy.retries
+        ('OK', 2)
+
+        No retry is made which would start after the deadline:
+
+        >>> policy = RetryPolicy(deadline=0, sleep=lambda seconds: None, clock=lambda: 0)
+        >>> policy.call(lambda: flaky([IOError('timed out')]), True, lambda e: FAILED)
+        Traceback (most recent call last):
+        IOError: timed out
+
+        @param func: Function making the request
+        @param idempotent: Whether the request can safely be repeated
+            after it may have been carried out
+        @param classify: Function of an exception raised by func,
+            returning UNSENT, FAILED, or None if it isn't a failure of
+            the device or the network (and so not worth retrying)
+        @param name: What the request is, for logging
+        @return: What func returned
+        """
+        retry = 0
+        while True:
+            if self.breaker is not None:
+                self.breaker.before(self.deadline)
+            try:
+                result = func()
+            except Exception, e:
+                failure = classify(e)
+                if failure is None:
+                    raise
+                if self.breaker is not None:
+                    self.breaker.failure()
+                if failure != UNSENT and not idempotent:
+                    raise
+                # Past the attempts, keep going only while the breaker
+                # is pausing the requests, until it gives up
+                if retry + 1 >= self.attempts and not (self.breaker is not None and self.breaker.is_open()):
+                    raise
+                if self.breaker is not None and self.breaker.is_open():
+                    # The breaker's pause is the wait
+                    retry += 1
+                    self.retries += 1
+                    logging.info('%s failed (%s), retrying after the pause' % (name or 'Request', e))
+                    continue
+                delay = self.delay(retry)
+                if self.deadline is not None and self.clock() + delay >= self.deadline:
+                    raise
+                retry += 1
+                self.retries += 1
+                logging.info('%s failed (%s), retrying in %.1f seconds' % (name or 'Request', e, delay))
+                self.sleep(delay)
+                continue
+            if self.breaker is not None:
+                self.breaker.success()
+            return result
+
+    def describe(self):
+        """
+        >>> RetryPolicy(breaker=CircuitBreaker()).describe()
+        '0 retries, paused 0 times for 0 seconds'
+        """
+        text = '%d retries' % (self.retries, )
+        if self.breaker is not None:
+            text += ', paused %d times for %d seconds' % (self.breaker.trips, self.breaker.paused)
+        return text
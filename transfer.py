@@ -0,0 +1,248 @@
+"""
+Resumable file transfers with the device
+
+A download is written to PATH.part, with how far it has got (and what
+it is a download of) kept beside it in PATH.part.json, so a download
+which fails - in this run or an earlier one - carries on from there
+with a Range request rather than starting again. If-Range makes sure
+what is added to the .part file is from the same version of the file.
+Once complete, the file is checked against its size and (if the device
+sent one) its digest, and only then moved to PATH.
+
+Uploads are resumable where the device supports 'upload_file_range'.
+The file is sent in chunks, each a PUT /files/NAME with a Content-Range
+header saying where it goes ('bytes 0-4194303/10485760'), as in
+Google's resumable upload protocol. Until the last byte has arrived
+the device answers 308 with a Range header of what it has so far
+('bytes=0-4194303'); a PUT with no body and 'bytes */10485760' asks for
+that, to find where to carry on from. Once the file is complete the
+device checks it against the Digest header sent with each chunk, and
+answers 200, or 409 if it doesn't match (starting again from nothing).
+
+Digests are RFC 3230 instance digests of the whole file: 'SHA=' and
+the base64 encoded SHA-1.
+"""
+
+import os
+import json
+import base64
+import hashlib
+
+# Bytes of a download between updates of its .part.json file
+CHECKPOINT_BYTES = 1024 * 1024
+
+
+class TransferError(Exception):
+    """
+    A transferred file isn't the size or digest it should be
+    """
+    pass
+
+
+def sha_digest(f):
+    """
+    >>> import StringIO
+    >>> sha_digest(StringIO.StringIO('abc'))
+    'SHA=qZk+NkcGgWq6PiVxeFDCbJzQ2J0='
+
+    @param f: File object, read from the start to the end
+    @return: Digest header value for the contents of f
+    """
+    sha = hashlib.sha1()
+    f.seek(0)
+    while True:
+        data = f.read(64 * 1024)
+        if not data:
+            break
+        sha.update(data)
+    return 'SHA=' + base64.b64encode(sha.digest())
+
+
+def parse_digest(value):
+    """
+    >>> parse_digest('MD5=HUXZLQLMuI/KZ5KDcJPcOA==, SHA=qZk+NkcGgWq6PiVxeFDCbJzQ2J0=')
+    'SHA=qZk+NkcGgWq6PiVxeFDCbJzQ2J0='
+    >>> parse_digest(None) is None
+    True
+
+    @param value: Digest header, or None
+    @return: The SHA digest it lists, as from sha_digest, or None
+    """
+    for digest in (value or '').split(','):
+        algorithm, sep, encoded = digest.strip().partition('=')
+        if sep and algorithm.upper() == 'SHA':
+            return 'SHA=' + encoded
+    return None
+
+
+def parse_content_range(value):
+    """
+    >>> parse_content_range('bytes 100-199/1000')
+    (100, 199, 1000)
+    >>> parse_content_range('bytes */1000')
+    (None, None, 1000)
+
+    @return: (first byte, last byte, total size) from a Content-Range
+        header, where the total may be None if unknown
+    @raise ValueError: If the header can't be parsed
+    """
+    unit, sep, spec = (value or '').strip().partition(' ')
+    if unit != 'bytes' or not sep:
+        raise ValueError('Invalid Content-Range: %r' % (value, ))
+    span, sep, total = spec.partition('/')
+    total = total != '*' and int(total) or None
+    if span == '*':
+        return None, None, total
+    first, sep, last = span.partition('-')
+    return int(first), int(last), total
+
+
+def received_bytes(range_header):
+    """
+    >>> received_bytes('bytes=0-4194303'), received_bytes(None)
+    (4194304, 0)
+
+    @param range_header: Range header of a 308 answer to an upload
+    @return: Number of bytes the device has from the start of the file
+    """
+    if not range_header:
+        return 0
+    spec = range_header.strip()
+    if not spec.startswith('bytes=0-'):
+        raise ValueError('Invalid upload Range: %r' % (range_header, ))
+    return int(spec[len('bytes=0-'):]) + 1
+
+
+class PartialDownload(object):
+    """
+    A download to path, kept in path.part until it is complete:
+
+        download = PartialDownload(path)
+        headers = download.resume_headers()
+        ... make the request with headers ...
+        with download.start(status, response headers) as f:
+            for chunk in chunks:
+                download.write(chunk)
+        download.finish()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.part_path = path + '.part'
+        self.state_path = self.part_path + '.json'
+        self.state = self._load()
+        self.file = None
+
+    def _load(self):
+        """
+        @return: What is known about the download from an earlier attempt
+        """
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = json.load(f)
+            offset = min(int(state['offset']), os.path.getsize(self.part_path))
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return {'offset': 0}
+        state['offset'] = offset
+        return state
+
+    def _save(self):
+        with open(self.state_path + '.tmp', 'wb') as f:
+            json.dump(self.state, f)
+        if os.path.exists(self.state_path):
+            # os.rename will not replace a file on Windows
+            os.remove(self.state_path)
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    @property
+    def offset(self):
+        return self.state['offset']
+
+    def resume_headers(self):
+        """
+        @return: Headers for the request, asking for the rest of the file
+            if some of it has been downloaded already
+        """
+        # Offsets are into the file as it is, not as it may be encoded
+        headers = {'accept-encoding': 'identity'}
+        if self.offset:
+            headers['range'] = 'bytes=%d-' % (self.offset, )
+            if self.state.get('validator'):
+                headers['if-range'] = self.state['validator']
+        return headers
+
+    def start(self, status, headers):
+        """
+        Open the .part file to write the response to, after what it has
+        already if the response carries on from there
+
+        @param status: HTTP status of the response, 200 or 206
+        @param headers: Response headers (lower case names)
+        @return: The .part file
+        """
+        offset = 0
+        size = headers.get('content-length') and int(headers['content-length'])
+        if status == 206:
+            first, last, size = parse_content_range(headers.get('content-range'))
+            if first != self.offset:
+                self.discard()
+                raise TransferError('Device sent bytes from %s, asked for %d' % (first, self.offset))
+            offset = first
+        self.state = {'offset': offset, 'size': size,
+                      'validator': headers.get('etag') or headers.get('last-modified'),
+                      'digest': parse_digest(headers.get('digest'))}
+        self.file = open(self.part_path, offset and 'r+b' or 'wb')
+        self.file.seek(offset)
+        self.file.truncate()
+        self._save()
+        self._checkpointed = offset
+        return self.file
+
+    def write(self, data):
+        self.file.write(data)
+        self.state['offset'] += len(data)
+        if self.state['offset'] - self._checkpointed >= CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Record how much of the file has been written, for resuming later
+        """
+        if self.file is not None and not self.file.closed:
+            self.file.flush()
+        self._save()
+        self._checkpointed = self.state['offset']
+
+    def finish(self):
+        """
+        Check the completed download and move it into place
+
+        @raise TransferError: If it isn't the size or digest it should be,
+            in which case it is discarded
+        """
+        self.file.close()
+        size, digest = self.state.get('size'), self.state.get('digest')
+        actual = os.path.getsize(self.part_path)
+        if size is not None and actual != size:
+            self.discard()
+            raise TransferError('Downloaded %s is %d bytes, expected %d' %
+                                (os.path.basename(self.path), actual, size))
+        if digest is not None:
+            with open(self.part_path, 'rb') as f:
+                actual = sha_digest(f)
+            if actual != digest:
+                self.discard()
+                raise TransferError('Downloaded %s has digest %s, expected %s' %
+                                    (os.path.basename(self.path), actual, digest))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.part_path, self.path)
+        os.remove(self.state_path)
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.state = {'offset': 0}
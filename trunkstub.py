@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+
+"""
+Stand-in for the Trunk Notes Wi-Fi sharing server
+
+Answers the same sync-* requests as the device, from notes held in
+memory, so trunksync can be run and debugged without a device:
+
+    python trunkstub.py [-p PORT] [NOTES_DIR]
+    python trunksync.py -c -i 127.0.0.1 -p PORT
+
+Notes are loaded from the .md files in NOTES_DIR if given. Changes are
+kept in memory only. The stub also implements the optional requests a
+device may advertise through sync-capabilities (see CAPABILITIES), so
+trunksync's handling of them can be checked.
+
+Files are served with Range requests and an RFC 3230 Digest header,
+and can be uploaded in chunks (see the transfer module), so that
+transfers can carry on from where they failed.
+
+Like the device, the stub answers pipelined requests in order. With
+--http10 it closes the connection after every response instead, like
+servers which don't keep connections open. --latency holds back
+everything sent each way, so round trips cost what they do over Wi-Fi.
+"""
+
+import os
+import sys
+import time
+import zlib
+import cgi
+import socket
+import Queue
+import StringIO
+import hashlib
+import urlparse
+import threading
+import collections
+import optparse
+import BaseHTTPServer
+import SocketServer
+
+import delta
+import transfer
+
+# Optional requests this stub supports, as listed by sync-capabilities
+CAPABILITIES = ['update_note_delta', 'upload_file_range', 'form_data', 'reply_title', 'notes_list_since']
+
+# Notes lists given out with a cursor which are kept, to list the changes
+# since: older cursors are answered 410, for a full listing
+KEPT_LISTINGS = 16
+
+
+def note_title(contents, filename=''):
+    """
+    >>> note_title(u'Title: HomePage\\nTimestamp: x\\n')
+    u'HomePage'
+    >>> note_title(u'No metadata', 'Ideas.md')
+    u'Ideas'
+
+    @return: Title from the note's metadata, else from filename
+    """
+    for line in contents.splitlines():
+        if line.startswith(u'Title: '):
+            return line.split(u':', 1)[1].strip()
+    return os.path.splitext(filename.decode('utf-8'))[0]
+
+
+class TrunkStub(object):
+
+    def __init__(self, uuid='TRUNKSTUB', capabilities=None):
+        """
+        @param uuid: Device UUID to report
+        @param capabilities: Optional requests to support, default CAPABILITIES
+        """
+        self.uuid = uuid
+        if capabilities is None:
+            capabilities = CAPABILITIES
+        self.capabilities = list(capabilities)
+        # title -> (timestamp, unicode contents)
+        self.notes = {}
+        # filename -> bytes
+        self.files = {}
+        # filename -> (size, digest, bytes so far) of chunked uploads
+        self.uploads = {}
+        # cursor -> {title: timestamp} as listed with it. Cursors are
+        # only good for this instance, as a device's are until it restarts
+        self.listings = collections.OrderedDict()
+        self.instance = os.urandom(4).encode('hex')
+        # Request types in the order received
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def load(self, notes_dir):
+        """
+        Add the notes from the .md files in notes_dir
+        """
+        for filename in sorted(os.listdir(notes_dir)):
+            path = os.path.join(notes_dir, filename)
+            if filename.endswith('.md') and os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    contents = f.read().decode('utf-8')
+                self.notes[note_title(contents, filename)] = (int(os.stat(path).st_mtime), contents)
+
+    def save_note(self, contents, filename='', reply=''):
+        """
+        @param reply: 'title' to answer with just the note's title, where
+            the reply_title capability is supported
+        @return: Note as saved, or its title
+        """
+        title = note_title(contents, filename)
+        self.notes[title] = (int(time.time()), contents)
+        if reply == 'title' and 'reply_title' in self.capabilities:
+            return title
+        return contents
+
+    def handle(self, request_type, fields):
+        """
+        @param request_type: e.g. 'notes_list', from submit=sync-notes_list
+        @param fields: Dictionary of the other form fields (bytes)
+        @return: (HTTP status, response body)
+        """
+        with self.lock:
+            self.requests.append(request_type)
+            if request_type == 'uuid':
+                return 200, self.uuid
+            elif request_type == 'capabilities':
+                return 200, '\n'.join(self.capabilities)
+            elif request_type == 'notes_list' and 'since' in fields and 'notes_list_since' in self.capabilities:
+                return self.notes_since(fields['since'])
+            elif request_type == 'notes_list':
+                return 200, ''.join(u'%d:%s\n' % (timestamp, title)
+                                    for title, (timestamp, contents) in sorted(self.notes.items())).encode('utf-8')
+            elif request_type == 'get_note':
+                note = self.notes.get(fields.get('title', '').decode('utf-8'))
+                if note is None:
+                    return 404, ''
+                return 200, note[1].encode('utf-8')
+            elif request_type == 'update_note':
+                contents = fields.get('contents', '').decode('utf-8')
+                return 200, self.save_note(contents, fields.get('filename', ''), fields.get('reply')).encode('utf-8')
+            elif request_type == 'update_note_delta' and request_type in self.capabilities:
+                note = self.notes.get(fields.get('title', '').decode('utf-8'))
+                if note is None or hashlib.sha1(note[1].encode('utf-8')).hexdigest() != fields.get('base'):
+                    # The device's copy isn't the base the delta was made from
+                    return 409, 'ERROR: base mismatch'
+                try:
+                    contents = delta.apply_delta(note[1], fields.get('delta', ''))
+                except delta.DeltaError, e:
+                    return 400, 'ERROR: %s' % (e, )
+                return 200, self.save_note(contents, reply=fields.get('reply')).encode('utf-8')
+            elif request_type == 'remove_note':
+                if self.notes.pop(fields.get('title', '').decode('utf-8'), None) is None:
+                    return 404, ''
+                return 200, 'OK'
+            return 404, ''
+
+    def notes_since(self, since):
+        """
+        List the notes created or changed since the listing given with
+        the cursor since, and those deleted since, with a new cursor.
+        Worked out from the listing rather than kept as a log of changes,
+        so notes changed directly in self.notes are listed too.
+
+        @param since: Cursor, or '' to list every note
+        @return: (HTTP status, response body)
+        """
+        before = {}
+        if since:
+            before = self.listings.get(since)
+            if before is None:
+                return 410, ''
+        current = dict((title, timestamp) for title, (timestamp, contents) in self.notes.items())
+        cursor = '%s-%d' % (self.instance, len(self.requests))
+        self.listings[cursor] = current
+        while len(self.listings) > KEPT_LISTINGS:
+            self.listings.popitem(last=False)
+        lines = [u'cursor:%s\n' % (cursor, )]
+        lines.extend(u'%d:%s\n' % (current[title], title) for title in sorted(current)
+                     if before.get(title) != current[title])
+        lines.extend(u'deleted:%s\n' % (title, ) for title in sorted(before) if title not in current)
+        return 200, u''.join(lines).encode('utf-8')
+
+    def upload_file(self, filename, data):
+        with self.lock:
+            self.requests.append('upload_file')
+            self.files[filename] = data
+        return 200, 'OK'
+
+    def upload_range(self, filename, content_range, digest, data):
+        """
+        Take a chunk of a file, from a PUT with content_range saying
+        where it goes - see the transfer module
+
+        @return: (HTTP status, response body, response headers)
+        """
+        with self.lock:
+            self.requests.append('upload_file')
+            try:
+                first, last, size = transfer.parse_content_range(content_range)
+            except ValueError:
+                return 400, 'ERROR: bad Content-Range', {}
+            upload = self.uploads.get(filename)
+            if upload is None or upload[:2] != (size, digest):
+                # Not carrying on from an upload of the same file
+                upload = self.uploads[filename] = (size, digest, '')
+            received = upload[2]
+            if first == len(received) and last - first + 1 == len(data):
+                received += data
+                self.uploads[filename] = (size, digest, received)
+            if len(received) < size:
+                headers = {}
+                if received:
+                    headers['Range'] = 'bytes=0-%d' % (len(received) - 1, )
+                return 308, '', headers
+            del self.uploads[filename]
+            if transfer.sha_digest(StringIO.StringIO(received)) != digest:
+                return 409, 'ERROR: digest mismatch', {}
+            self.files[filename] = received
+            return 200, 'OK', {}
+
+    def get_file(self, filename, range_header=None, if_range=None):
+        """
+        @param range_header: Range header of the request, if any
+        @param if_range: If-Range header of the request, if any
+        @return: (HTTP status, response body, response headers)
+        """
+        with self.lock:
+            self.requests.append('get_file')
+            if filename not in self.files:
+                return 404, '', {}
+            data = self.files[filename]
+            headers = {'Accept-Ranges': 'bytes',
+                       'ETag': '"%s"' % (hashlib.sha1(data).hexdigest(), ),
+                       'Digest': transfer.sha_digest(StringIO.StringIO(data))}
+            if not range_header or (if_range and if_range != headers['ETag']):
+                return 200, data, headers
+            first, sep, last = range_header.strip()[len('bytes='):].partition('-')
+            first = int(first)
+            last = min(int(last or len(data) - 1), len(data) - 1)
+            if first >= len(data):
+                headers['Content-Range'] = 'bytes */%d' % (len(data), )
+                return 416, '', headers
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, len(data))
+            return 206, data[first:last + 1], headers
+
+
+class StubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.protocol_version = self.server.protocol_version
+
+    def send_body(self, status, body, headers={}):
+        # Buffered, so the response goes out in one write as the device's
+        # does, rather than a write per header line
+        wfile, self.wfile = self.wfile, StringIO.StringIO()
+        try:
+            self.send_response(status)
+            for name, value in sorted(headers.items()):
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            wfile.write(self.wfile.getvalue())
+            self.wfile = wfile
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        if path.startswith('/files/'):
+            self.send_body(*self.server.stub.get_file(urlparse.unquote(path[len('/files/'):]),
+                                                      self.headers.get('Range'), self.headers.get('If-Range')))
+        else:
+            self.send_body(404, '')
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlparse.urlparse(self.path).path
+        if path.startswith('/files/') and 'upload_file_range' in self.server.stub.capabilities:
+            self.send_body(*self.server.stub.upload_range(urlparse.unquote(path[len('/files/'):]),
+                                                          self.headers.get('Content-Range'),
+                                                          self.headers.get('Digest'), body))
+        else:
+            self.send_body(404, '')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        encoding = self.headers.get('Content-Encoding')
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        content_type, params = cgi.parse_header(self.headers.get('Content-Type', ''))
+        if content_type == 'multipart/form-data':
+            fields = {}
+            for part in body.split('--' + params['boundary'])[1:-1]:
+                headers, data = part.split('\r\n\r\n', 1)
+                disposition = cgi.parse_header(headers.strip().split('\r\n')[0])[1]
+                if 'filename' in disposition:
+                    # A file upload, as made by SyncSettings.iphone_upload_file
+                    self.send_body(*self.server.stub.upload_file(disposition['filename'], data[:-len('\r\n')]))
+                    return
+                fields[disposition.get('name', '')] = data[:-len('\r\n')]
+            if 'form_data' not in self.server.stub.capabilities:
+                self.send_body(404, '')
+                return
+        else:
+            fields = dict(urlparse.parse_qsl(body, keep_blank_values=True))
+        submit = fields.pop('submit', '')
+        if not submit.startswith('sync-'):
+            self.send_body(404, '')
+            return
+        self.send_body(*self.server.stub.handle(submit[len('sync-'):], fields))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, stub, address=('127.0.0.1', 0), verbose=False, protocol_version='HTTP/1.1'):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StubRequestHandler)
+        self.stub = stub
+        self.verbose = verbose
+        self.protocol_version = protocol_version
+
+
+class LatencyProxy(object):
+    """
+    Forwards connections to another address, delivering everything sent
+    each way latency / 2 seconds after it was sent, as a slow network
+    would. Requests sent back-to-back are delayed together, so the proxy
+    shows what pipelining saves.
+    """
+
+    def __init__(self, target, latency, address=('127.0.0.1', 0)):
+        """
+        @param target: (host, port) to forward to
+        @param latency: Round trip time to add, in seconds
+        """
+        self.target = target
+        self.delay = latency / 2.0
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(16)
+        self.server_address = self.listener.getsockname()
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def serve_forever(self):
+        while True:
+            client, address = self.listener.accept()
+            try:
+                upstream = socket.create_connection(self.target)
+            except socket.error:
+                client.close()
+                continue
+            for source, destination in ((client, upstream), (upstream, client)):
+                source.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                queue = Queue.Queue()
+                self._start(self._receive, source, queue)
+                self._start(self._deliver, queue, destination)
+
+    def _receive(self, source, queue):
+        while True:
+            try:
+                data = source.recv(65536)
+            except socket.error:
+                data = ''
+            queue.put((time.time() + self.delay, data))
+            if not data:
+                break
+
+    def _deliver(self, queue, destination):
+        while True:
+            due, data = queue.get()
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if not data:
+                    destination.shutdown(socket.SHUT_WR)
+                    break
+                destination.sendall(data)
+            except socket.error:
+                break
+
+
+def serve_in_background(stub, port=0, protocol_version='HTTP/1.1'):
+    """
+    @return: StubServer, serving stub from a daemon thread on
+        127.0.0.1 (use server.server_address[1] for the port and
+        server.shutdown() to stop)
+    """
+    server = StubServer(stub, ('127.0.0.1', port), protocol_version=protocol_version)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def delay_in_background(server, latency, port=0):
+    """
+    @param server: StubServer to put a LatencyProxy in front of
+    @param latency: Round trip time to add, in seconds
+    @return: LatencyProxy, forwarding from a daemon thread on 127.0.0.1
+        (use proxy.server_address[1] for the port)
+    """
+    proxy = LatencyProxy(server.server_address, latency, ('127.0.0.1', port))
+    thread = threading.Thread(target=proxy.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return proxy
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options] [NOTES_DIR]')
+    parser.add_option("-p", "--port", dest="port", type=int, default=10000,
+        help="Port to listen on [10000]")
+    parser.add_option("--no-capabilities", dest="capabilities", action="store_const", const=[],
+        help="Advertise no optional requests, like an older Trunk Notes")
+    parser.add_option("--http10", dest="protocol_version", action="store_const", const='HTTP/1.0',
+        default='HTTP/1.1', help="Close the connection after every response")
+    parser.add_option("--latency", dest="latency", type=float, default=0,
+        help="Round trip time to add, in milliseconds [0]")
+    options, args = parser.parse_args(args)
+    stub = TrunkStub(capabilities=options.capabilities)
+    if args:
+        stub.load(args[0])
+    address = ('127.0.0.1', options.port)
+    if options.latency:
+        # The proxy takes the port, and the stub listens behind it
+        address = ('127.0.0.1', 0)
+    server = StubServer(stub, address, verbose=True, protocol_version=options.protocol_version)
+    if options.latency:
+        proxy = delay_in_background(server, options.latency / 1000.0, options.port)
+        print 'Adding %gms round trips on 127.0.0.1:%d' % (options.latency, proxy.server_address[1])
+    print 'Serving %d notes on 127.0.0.1:%d' % (len(stub.notes), server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
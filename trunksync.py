@@ -126,13 +126,36 @@ import codecs
 import optparse
 import shlex
 import shutil
+import fnmatch
 import textwrap
+import socket
+import errno
+import httplib
+import threading
+import Queue
+import array
+import itertools
+import json
+import hashlib
 from getpass import getpass
 
-import pybonjour
 import httplib2
+import delta
+import merge3
+import notestore
+import concurrency
+import retry
+import transfer
+# pybonjour (ctypes) and easygui (Tk) are slow to load, so they are
+# only imported by TrunkDeviceFinder and TrunkSyncEasyUi respectively
+pybonjour = None
 # stu 100919 - need to fix my tk installation
-import easygui
+easygui = None
+# NumPy, if installed, speeds up SyncAnalyser on large notes lists; it
+# is only imported for lists of at least NUMPY_THRESHOLD notes (False
+# once found to be missing)
+numpy = None
+NUMPY_THRESHOLD = 20000
 
 FILE_EXTENSION = 'md'
 FILE_EXTENSION = FILE_EXTENSION.lstrip('.')
@@ -145,13 +168,46 @@ IMAGE_EXTENSIONS  = ['jpg', 'jpeg', 'gif', 'png', 'tiff', 'bmp']
 
 VALID_FILENAME_CHARS = "-_.() %s%s" % (string.ascii_letters, string.digits)
 
-logging.basicConfig(level=logging.DEBUG)
-
 # This is the global settings object.
 # XXX: Should probably make SyncSettings a singleton
 # and use that
 settings = None
 
+# Notes shorter than this (in characters) are always sent whole
+DELTA_THRESHOLD = 8 * 1024
+
+# Seconds to keep the device's resolved address for
+ADDRESS_TTL = 300
+# Socket send and receive buffer size for device connections
+SOCKET_BUFFER_SIZE = 256 * 1024
+
+# Notes fetched or deleted per batch of pipelined requests, which are
+# sent settings.concurrency.allowed() deep - see httplib2.Http.pipeline
+PIPELINE_BATCH = 64
+
+# Seconds allowed for each kind of device request: (connect, read,
+# total), where read limits each wait for data once connected and total
+# one attempt at the request as a whole, from connecting to the end of
+# the response. Retries (see retry.py) get the same again.
+DEFAULT_TIMEOUTS = (10, 30, 60)
+REQUEST_TIMEOUTS = {
+    'uuid':              (5, 10, 20),
+    'capabilities':      (5, 10, 20),
+    'notes_list':        (10, 60, 300),
+    'get_note':          (10, 30, 60),
+    'update_note':       (10, 60, 120),
+    'update_note_delta': (10, 60, 120),
+    'remove_note':       (10, 30, 60),
+    # Files may be large, so only a stalled transfer is cut short
+    'get_file':          (10, 60, 3600),
+    'upload_file':       (10, 60, 3600),
+}
+
+# The Timestamp: metadata line of a note
+TIMESTAMP_LINE = re.compile(r'^Timestamp: [^\r\n]*', re.M)
+# The blank line ending the metadata at the top of a note
+HEADER_END = re.compile(r'^\r?$', re.M)
+
 MODE_CHECK_PRESENT  = 40001
 MODE_FIND_NOTE      = 40002
 MODE_FIND_OR_CREATE = 40003
@@ -164,6 +220,56 @@ class IphoneConnectError(Exception):
     """
     pass
 
+
+# Requests which only read, so can be repeated whatever happened to them
+IDEMPOTENT_REQUESTS = frozenset(['uuid', 'capabilities', 'notes_list', 'get_note', 'get_file'])
+
+# Most bytes of a file sent in one request, where the device supports
+# resumable uploads: a failure loses at most this much of the upload
+UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+
+# Socket errors which mean a request never reached the device
+UNSENT_ERRNOS = frozenset(getattr(errno, name) for name in
+                          ('ECONNREFUSED', 'EHOSTUNREACH', 'ENETUNREACH', 'ENETDOWN', 'EHOSTDOWN')
+                          if hasattr(errno, name))
+
+
+def classify_failure(e):
+    """
+    Classify an exception from a device request, for retry.RetryPolicy
+
+    >>> classify_failure(IphoneConnectError({'status': '503'}))
+    'unsent'
+    >>> classify_failure(socket.timeout('timed out'))
+    'failed'
+    >>> classify_failure(IphoneConnectError({'status': '401'})) is None
+    True
+    >>> classify_failure(transfer.TransferError('Downloaded a.png is 10 bytes, expected 20'))
+    'failed'
+
+    @return: retry.UNSENT, retry.FAILED, or None if not worth retrying
+    """
+    if isinstance(e, IphoneConnectError):
+        status = e[0].get('status')
+        if status == '503':
+            # The device turned the request away
+            return retry.UNSENT
+        elif status in ('500', '502', '504'):
+            return retry.FAILED
+        return None
+    elif isinstance(e, httplib2.ServerNotFoundError):
+        return retry.UNSENT
+    elif isinstance(e, socket.error):
+        if not isinstance(e, socket.timeout) and e.errno in UNSENT_ERRNOS:
+            return retry.UNSENT
+        return retry.FAILED
+    elif isinstance(e, httplib.HTTPException):
+        return retry.FAILED
+    elif isinstance(e, transfer.TransferError):
+        # Damaged on the way, and discarded: worth transferring again
+        return retry.FAILED
+    return None
+
 class SyncError(Exception):
     """
     Raise if there is an issue synchronising notes
@@ -171,12 +277,299 @@ class SyncError(Exception):
     pass
 
 
+def iter_notes_list(chunks):
+    """
+    Parse a notes list (as returned by sync-notes_list, and as stored
+    in the last sync file) without holding all of it in memory
+
+    >>> list(iter_notes_list(['12:Note', 'One\\n34:Caf\\xc3', '\\xa9\\r\\n\\n56:Last']))
+    [(12, u'NoteOne'), (34, u'Caf\\xe9'), (56, u'Last')]
+
+    @param chunks: Iterable of UTF-8 encoded strings, split anywhere
+    @return: Generator of (seconds since epoch, title) tuples
+    """
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for line in iter_lines(chunks):
+        timestamp, title = line.decode('utf-8').split(u':', 1)
+        if debug:
+            logging.debug(u'%s - %s' % (timestamp, title))
+        yield int(timestamp), title
+
+
+def iter_notes_changes(chunks, cursor):
+    """
+    Parse the answer to sync-notes_list with since (see
+    TrunkSync.list_iphone_notes), as iter_notes_list does a notes list
+
+    >>> cursor = [None]
+    >>> list(iter_notes_changes(['cursor:a-7\\n12:Note', 'One\\ndel', 'eted:Old\\n'], cursor)), cursor
+    ([(12, u'NoteOne'), (None, u'Old')], ['a-7'])
+
+    @param chunks: Iterable of UTF-8 encoded strings, split anywhere
+    @param cursor: List, whose first item is set to the cursor given
+    @return: Generator of (seconds since epoch, title) tuples for notes
+        created or changed, and (None, title) for notes deleted
+    """
+    for line in iter_lines(chunks):
+        kind, value = line.decode('utf-8').split(u':', 1)
+        if kind == u'cursor':
+            cursor[0] = value.encode('utf-8')
+        elif kind == u'deleted':
+            yield None, value
+        else:
+            yield int(kind), value
+
+
+def iter_lines(chunks):
+    """
+    >>> list(iter_lines(['a\\nb', 'c\\r\\n\\n', 'd']))
+    ['a', 'bc', 'd']
+
+    @param chunks: Iterable of strings, split anywhere
+    @return: Generator of the stripped, non-blank lines of their concatenation
+    """
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield line
+    pending = pending.strip()
+    if pending:
+        yield pending
+
+
+def encode_multipart(fields, boundary=None):
+    """
+    Encode form fields as multipart/form-data, which sends each value
+    as it is, where urlencoding sends a space, newline or non-ASCII
+    byte as three
+
+    >>> encode_multipart({'submit': 'sync-update_note', 'contents': 'Caf\\xc3\\xa9\\n'}, 'XX')[1]
+    '--XX\\r\\nContent-Disposition: form-data; name="contents"\\r\\n\\r\\nCaf\\xc3\\xa9\\n\\r\\n--XX\\r\\nContent-Disposition: form-data; name="submit"\\r\\n\\r\\nsync-update_note\\r\\n--XX--\\r\\n'
+    >>> encode_multipart({'filename': u'Caf\\xe9.png', 'offset': 0}, 'XX')[1]
+    '--XX\\r\\nContent-Disposition: form-data; name="filename"\\r\\n\\r\\nCaf\\xc3\\xa9.png\\r\\n--XX\\r\\nContent-Disposition: form-data; name="offset"\\r\\n\\r\\n0\\r\\n--XX--\\r\\n'
+
+    @param fields: Dictionary of field names to values - byte strings,
+        unicode (sent as UTF-8) or anything else (sent as str() of it)
+    @param boundary: Boundary between the fields, by default a random
+        one which isn't in any of the values
+    @return: (boundary, body)
+    """
+    values = {}
+    for name, value in fields.items():
+        if isinstance(value, unicode):
+            values[name] = value.encode('utf-8')
+        else:
+            values[name] = str(value)
+    while boundary is None or [value for value in values.values() if boundary in value]:
+        boundary = '----------TrunkSync%s' % (os.urandom(8).encode('hex'), )
+    crlf = '\r\n'
+    lines = []
+    for name, value in sorted(values.items()):
+        lines.extend(['--' + boundary,
+                      'Content-Disposition: form-data; name="%s"' % (name, ),
+                      '',
+                      value])
+    lines.extend(['--' + boundary + '--', ''])
+    return boundary, crlf.join(lines)
+
+
+def stamp_contents(contents, last_modified):
+    """
+    Set the Timestamp metadata of a note. Only the metadata block at
+    the top of the note (up to the first blank line) is searched, and
+    the rest of the note is left as it is, line endings included.
+
+    >>> stamp_contents(u'Title: A\\r\\nTimestamp: x\\r\\n\\r\\nTimestamp: y', time.gmtime(0))
+    u'Title: A\\r\\nTimestamp: 1970-01-01 00:00:00 +0000\\r\\n\\r\\nTimestamp: y'
+
+    @param contents: Note body
+    @param last_modified: UTC time.struct_time to stamp it with
+    @return: Note body with its Timestamp: line replaced
+    """
+    header_end = HEADER_END.search(contents)
+    match = TIMESTAMP_LINE.search(contents, 0, header_end.start() if header_end else len(contents))
+    if match is None:
+        return contents
+    # Substitute this line with the actual timestamp
+    line = u'Timestamp: %s' % (time.strftime('%Y-%m-%d %H:%M:%S +0000', last_modified), )
+    if contents.find(match.group(0)) == match.start():
+        # Copies the note once, where slicing and joining would copy
+        # it twice
+        return contents.replace(match.group(0), line, 1)
+    return contents[:match.start()] + line + contents[match.end():]
+
+
+# Timestamps are held in C longs where those are 64 bit, else doubles
+# (which hold any timestamp exactly)
+_TIME_TYPECODE = 'l' if array.array('l').itemsize >= 8 else 'd'
+
+
+def _load_numpy():
+    """
+    @return: The numpy module, or None if it isn't installed
+    """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy or None
+
+
+def classify_notes(notes, lastsync_notes, use_numpy=None):
+    """
+    Sort notes into new and updated since the last sync, and find the
+    notes deleted since, working on columns of keys, positions and
+    timestamps rather than on Note objects
+
+    >>> notes = [Note('NoteTwo', 1), Note('NoteThree', 3), Note('NoteFive', 5)]
+    >>> lastsync_notes = [Note('NoteOne', 1), Note('NoteTwo', 1), Note('NoteThree', 2)]
+    >>> new, updated, deleted = classify_notes(notes, lastsync_notes, use_numpy=False)
+    >>> [n.name for n in new], [n.name for n in updated], [n.name for n in deleted]
+    (['NoteFive'], ['NoteThree'], ['NoteOne'])
+
+    @param notes: List of notes on one side (device or local), or
+        NoteColumns
+    @param lastsync_notes: List of notes (or NoteColumns) as at the
+        last sync. Where keys repeat, the first note is used.
+    @param use_numpy: Whether to use numpy - default is to use it if
+        installed and there are NUMPY_THRESHOLD or more notes
+    @return: (new, updated, deleted) - lists of notes, in the order of
+        notes (new, updated) and lastsync_notes (deleted)
+    """
+    if use_numpy is None:
+        use_numpy = len(notes) + len(lastsync_notes) >= NUMPY_THRESHOLD and _load_numpy() is not None
+    columns = NoteColumns.of(notes)
+    last_columns = NoteColumns.of(lastsync_notes)
+    keys, last_keys = columns.keys, last_columns.keys
+    # Position in lastsync_notes of the first note with each key (built
+    # backwards, so the first note's position is the one left standing)
+    first = dict(itertools.izip(reversed(last_keys), xrange(len(last_keys) - 1, -1, -1)))
+    current = set(keys)
+    if use_numpy:
+        np = _load_numpy()
+        positions = np.fromiter((first.get(key, -1) for key in keys), dtype=np.int64, count=len(keys))
+        mtimes = np.fromiter(columns.mtimes, dtype=np.int64, count=len(keys))
+        # A sentinel at the end, for notes with no position
+        last_mtimes = np.fromiter(last_columns.mtimes, dtype=np.int64, count=len(last_keys))
+        last_mtimes = np.append(last_mtimes, 0)
+        was_present = positions >= 0
+        new = np.flatnonzero(~was_present)
+        updated = np.flatnonzero(was_present & (mtimes > last_mtimes[positions]))
+        deleted = np.flatnonzero(np.fromiter((key not in current for key in last_keys), dtype=bool,
+                                             count=len(last_keys)))
+    else:
+        positions = map(first.get, keys)
+        mtimes, last_mtimes = columns.mtimes, last_columns.mtimes
+        new = [n for n, position in enumerate(positions) if position is None]
+        updated = [n for n, position in enumerate(positions)
+                   if position is not None and mtimes[n] > last_mtimes[position]]
+        deleted = [n for n, key in enumerate(last_keys) if key not in current]
+    return ([notes[n] for n in new], [notes[n] for n in updated],
+            [lastsync_notes[n] for n in deleted])
+
+
+# Interned fold keys, so that equal keys are usually the same object
+# and compare by identity
+_fold_keys = {}
+
+def fold_title(name):
+    """
+    Key used to compare note titles. TrunkSync is case insensitive
+    even though Trunk Notes is not.
+
+    >>> fold_title(u'Caf\\xe9 Notes') == fold_title(u'CAFE\\u0301 NOTES')
+    True
+
+    @param name: Note title
+    @return: Normalised, lower cased title
+    """
+    key = unicodedata.normalize('NFC', unicode(name).lower())
+    return _fold_keys.setdefault(key, key)
+
+def find_case_collisions(notes):
+    """
+    Find notes whose titles differ only in case. These are treated as
+    the same note, so only one of each group will be synced.
+
+    >>> find_case_collisions([Note(u'Todo', 1), Note(u'TODO', 2), Note(u'Other', 3)])
+    [[u'Todo', u'TODO']]
+
+    @param notes: List of Note instances (or NoteColumns) from a single
+        source
+    @return: List of lists of colliding titles
+    """
+    columns = NoteColumns.of(notes)
+    names = {}
+    for key, title in itertools.izip(columns.keys, columns.titles):
+        names.setdefault(key, []).append(title)
+    return [titles for titles in names.values() if len(set(titles)) > 1]
+
+
+class NoteColumns(object):
+    """
+    A notes list kept as columns of titles, keys and timestamps. A Note
+    is only made for an entry when it is asked for, so that the notes
+    which haven't changed since the last sync - usually nearly all of
+    them - never become Note objects.
+
+    >>> notes = NoteColumns([(12, u'NoteOne'), (34, u'NOTEtwo')])
+    >>> len(notes), notes.keys, notes[1].name, notes[1].mtime
+    (2, [u'noteone', u'notetwo'], u'NOTEtwo', 34)
+    """
+
+    def __init__(self, entries=()):
+        """
+        @param entries: Iterable of (seconds since epoch, title) tuples,
+            as from iter_notes_list
+        """
+        self.titles = []
+        self.keys = []
+        self.mtimes = array.array(_TIME_TYPECODE)
+        for timestamp, title in entries:
+            self.titles.append(title)
+            self.keys.append(fold_title(title))
+            self.mtimes.append(timestamp)
+
+    @classmethod
+    def of(cls, notes):
+        """
+        @param notes: NoteColumns, or list of Note instances
+        @return: notes as NoteColumns
+        """
+        if isinstance(notes, cls):
+            return notes
+        return cls((note.mtime, note.name) for note in notes)
+
+    def entries(self):
+        """
+        @return: Iterator of (seconds since epoch, title) tuples
+        """
+        return itertools.izip(self.mtimes, self.titles)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __getitem__(self, n):
+        return Note(self.titles[n], self.mtimes[n])
+
+    def __iter__(self):
+        for n in xrange(len(self.titles)):
+            yield self[n]
+
+
 class Note(object):
 
     def __init__(self, name, last_modified, local_path=None):
         """
         @param name: Name of the note - e.g. HomePage
-        @param last_modified: Time the note was last modified
+        @param last_modified: Time the note was last modified, either
+            seconds since the epoch or a UTC time.struct_time
         @param local_path: Where the note resides on the local filesystem
         """
         self.name = name
@@ -193,6 +586,29 @@ class Note(object):
         self.local_path = local_path
         self.contents = None       # note text content, utf8
         self.file_contents = None  # binary (str) content of image/sound
+        self.device_filename = None  # image/sound still to be fetched from the device
+
+    def _get_name(self):
+        return self._name
+
+    def _set_name(self, name):
+        self._name = name
+        self.key = fold_title(name)
+
+    # Keep the comparison key in step with the title
+    name = property(_get_name, _set_name)
+
+    def _get_last_modified(self):
+        return time.gmtime(self.mtime)
+
+    def _set_last_modified(self, last_modified):
+        if isinstance(last_modified, time.struct_time):
+            last_modified = calendar.timegm(last_modified)
+        self.mtime = int(last_modified)
+
+    # Only converted to a struct_time when asked for, as notes
+    # lists are compared on the (much cheaper) integer mtime
+    last_modified = property(_get_last_modified, _set_last_modified)
 
     def _filename_base(self):
         """
@@ -274,7 +690,7 @@ class Note(object):
             # backslash characters in paths on windows, so convert to
             # forward slashes for comparison. they still work equally
             # well for the FS operations.
-            fn_match_re = re.compile(r'%s(\.[0-9]+)?\.%s'%(f_base.replace('\\','/'), FILE_EXTENSION))
+            fn_match_re = re.compile(r'%s(\.[0-9]+)?\.%s$'%(f_base.replace('\\','/'), FILE_EXTENSION))
             for fn in os.listdir(settings.local_dir):
                 file_path = os.path.join(settings.local_dir, fn)
                 if (fn_match_re.match(file_path.replace('\\','/')) and
@@ -334,8 +750,18 @@ class Note(object):
         # XXX: this could lead to loss of data if two notes on
         # the iphone have titles differing only in case...?
         # perhaps should use the .1.EXT type thing locally and
-        # preserve case distinctions.
-        return cmp(self.name.lower(), other_note.name.lower())
+        # preserve case distinctions. For now SyncAnalyser warns
+        # about them (see find_case_collisions).
+        return cmp(self.key, other_note.key)
+
+    def __eq__(self, other_note):
+        return isinstance(other_note, Note) and self.key == other_note.key
+
+    def __ne__(self, other_note):
+        return not self.__eq__(other_note)
+
+    def __hash__(self):
+        return hash(self.key)
 
     def __repr__(self):
         msg_local_path = "EMPTY"
@@ -354,7 +780,18 @@ class Note(object):
         Get the note from the iPhone
         """
         logging.info(u'<< Getting note from device: %s' % (self.name, ))
-        self.contents = settings.iphone_request('get_note', {'title': self.name.encode('utf-8')}).decode('utf-8')
+        self.set_device_contents(settings.iphone_request('get_note', {'title': self.name.encode('utf-8')}))
+
+    def set_device_contents(self, response):
+        """
+        Take the note's contents from the device's answer to get_note
+
+        @param response: Body of the response (None if 404)
+        """
+        if response is None:
+            self.contents = None
+        else:
+            self.contents = response.decode('utf-8')
         # HERE
         print self
         if self.contents is None:
@@ -365,34 +802,26 @@ class Note(object):
         #elif self.name.startswith('File'):
         #    filename = self.name[4:]
         if filename:
-            try:
-                # This note has a file component which we should get
-                #self.file_contents = settings.iphone_get_file(filename)
-                self.file_contents = settings.iphone_get_file(filename.encode('utf-8'))
-            except e:
-                logging.warn('Device file not found: %s' % (filename, ))
-                print self
-                print e
-                raise
+            # This note has a file component, which save_to_local
+            # streams straight to disk rather than holding in memory
+            self.device_filename = filename
 
 
     def backup_to_local(self):
         """
-        Backup the note to the local storage
+        Backup the note to the local storage, beside the note's own
+        file with a tilde appended
         """
-        # Add tilde indicating backup
-        self.local_path = self.local_path + '~'
         self.establish_local_path(MODE_FIND_OR_CREATE)
-        logging.info('>> Making back-up of note to local: %s' % (self.local_path, ))
-        with codecs.open(self.local_path, 'w', 'utf-8') as f:
+        # Add tilde indicating backup
+        backup_path = self.local_path + '~'
+        logging.info('>> Making back-up of note to local: %s' % (backup_path, ))
+        with codecs.open(backup_path, 'w', 'utf-8') as f:
             f.write(self.contents)
         # Update last modified time on file to this notes last accessed time
-        utime = calendar.timegm(self.last_modified)
         ## stu 110125 # fixed again (did the TN time format change after 100909?)
-        self.update_time(utime)
+        os.utime(backup_path, (self.mtime, self.mtime))
         # ... ignoring related images files ... 
-        # Now remove tilde from local path name
-        self.local_path = self.local_path.rstrip('~')
 
     def save_to_local(self):
         """
@@ -403,14 +832,24 @@ class Note(object):
         with codecs.open(self.local_path, 'w', 'utf-8') as f:
             f.write(self.contents)
         # Update last modified time on file to this notes last accessed time
-        utime = calendar.timegm(self.last_modified)
         ## stu 110125 # fixed again (did the TN time format change after 100909?)
-        self.update_time(utime)
+        self.update_time(self.mtime)
         # If there is a related file, then save that as well
         if self.file_contents:
             file_path = os.path.join(settings.local_files_dir, self.name[5:])
             with open(file_path, 'wb') as f:
                 f.write(self.file_contents)
+        elif self.device_filename:
+            file_path = os.path.join(settings.local_files_dir, self.device_filename)
+            try:
+                found = settings.iphone_get_file_to(self.device_filename.encode('utf-8'), file_path)
+            except Exception, e:
+                logging.warn('Device file not found: %s' % (self.device_filename, ))
+                print self
+                print e
+                raise
+            if not found:
+                logging.warn('Device file not found: %s' % (self.device_filename, ))
 
     def update_time(self, new_time):
         """
@@ -426,7 +865,7 @@ class Note(object):
         Delete the local file representing this note
         """
         self.establish_local_path(MODE_FIND_NOTE)
-        logging.info(u'<< Deleting from local: %s, %s' % (self.name, self.local_path))
+        logging.info(u'<< Deleting from local: %s, %r' % (self.name, self.local_path))
         try:
             os.remove(self.local_path)
             logging.info(u'Removed: %s' % (self.local_path, ))
@@ -443,28 +882,32 @@ class Note(object):
                 except:
                     pass
 
+    def read_local(self):
+        """
+        @return: The local note exactly as it is on disk
+        """
+        self.establish_local_path(MODE_FIND_NOTE)
+        with codecs.open(self.local_path, 'r', 'utf-8') as f:
+            return f.read()
+
     def hydrate_from_local(self):
         """
         Get the note from local
         """
         self.establish_local_path(MODE_FIND_NOTE)
-        logging.info(u'<< Getting note from local: %s, %s' % (self.name, self.local_path))
-        with codecs.open(self.local_path, 'r', 'utf-8') as f:
-            self.contents = f.read()
+        logging.info(u'<< Getting note from local: %s, %r' % (self.name, self.local_path))
         # Update the timestamp in the metadata
-        new_contents = []
-        substituted_timestamp = False
-        for line in self.contents.splitlines():
-            if not substituted_timestamp and line.startswith('Timestamp: '):
-                # Substitute this line with the actual timestamp
-                line = u'Timestamp: %s' % (time.strftime('%Y-%m-%d %H:%M:%S +0000', self.last_modified), )
-                substituted_timestamp = True
-            new_contents.append(line + os.linesep)
-        self.contents = u''.join(new_contents)
-
-    def save_to_iphone(self):
+        self.contents = stamp_contents(self.read_local(), self.last_modified)
+
+    def save_to_iphone(self, echo=True):
         """
         Save the note to the iPhone
+
+        @param echo: Whether the note as saved by the device is wanted.
+            If not, the device may answer with just the title, and the
+            note as sent becomes the base for the next delta or merge
+        @return: Note contents as saved by the device (or its title),
+            starting ERROR if it wasn't saved
         """
         logging.info(u'>> Saving to device: %s' % (self.name, ))
         self.establish_local_path(MODE_CHECK_PRESENT)
@@ -473,8 +916,16 @@ class Note(object):
         # which does not contain the Title: metadata. filename
         # is used to generate the note title.
         # any returned file contents must always be utf-8 unicode
-        new_contents = settings.iphone_request('update_note', {'contents': self.contents.encode('utf-8'),
-                                                               'filename': filename}).decode('utf-8')
+        reply_fields = settings.reply_fields(echo)
+        new_contents = self.send_delta(reply_fields)
+        if new_contents is None:
+            request_data = {'contents': self.contents.encode('utf-8'),
+                            'filename': filename}
+            request_data.update(reply_fields)
+            new_contents = settings.iphone_request('update_note', request_data).decode('utf-8')
+        if not new_contents.startswith('ERROR'):
+            # What the device now has is the base for the next delta or merge
+            settings.note_store.set_base(self.name, self.contents if reply_fields else new_contents)
         # If this is a file, and the file exists locally then upload the file
         filename = ''
         if self.name.startswith('File:'):
@@ -490,6 +941,43 @@ class Note(object):
                 logging.warn(u'File for entry does not exist: %s, %s' % (file_path, self.name))
         return new_contents
 
+    def send_delta(self, reply_fields={}):
+        """
+        Send the note to the device as an edit script against the base
+        the device already has, if the device accepts those and the
+        script is much smaller than the note
+
+        @param reply_fields: Arguments saying what to answer with - see
+            SyncSettings.reply_fields
+        @return: Note contents as saved by the device (or its title), or
+            None if the note must be sent whole
+        """
+        if not settings.delta or 'update_note_delta' not in settings.capabilities:
+            return None
+        if len(self.contents) < DELTA_THRESHOLD:
+            return None
+        base = settings.note_store.get_base(self.name)
+        if base is None:
+            return None
+        script = delta.make_delta(base, self.contents)
+        size = len(self.contents.encode('utf-8'))
+        if len(script) * 2 > size:
+            return None
+        request_data = {'title': self.name.encode('utf-8'),
+                        'base': notestore.blob_id(base),
+                        'delta': script}
+        request_data.update(reply_fields)
+        try:
+            new_contents = settings.iphone_request('update_note_delta', request_data)
+        except IphoneConnectError, e:
+            # e.g. the device's copy isn't the base after all
+            logging.info(u'Delta for %s refused (%s), sending whole note' % (self.name, e[0]['status']))
+            return None
+        if new_contents is None or new_contents.startswith('ERROR'):
+            return None
+        logging.info(u'>> Sent %d byte delta for %d byte note: %s' % (len(script), size, self.name))
+        return new_contents.decode('utf-8')
+
     def delete_on_iphone(self):
         """
         Delete the note from the iPhone
@@ -508,6 +996,7 @@ class SyncSettings(object):
         other:local_dir   [ ~/trunksync                       ] : Local directory where note text files will be stored
         local_files_dir   [ ~/Documents/TrunkNotes/Files      ] : Local directory where images, sound recordings will be stored
         last_sync_path    [ ~/Documents/TrunkNotes/.trunksync ] : Local file where last-modifed timestamps will be stored
+        auth_path         [ ~/Documents/TrunkNotes/.trunksync-auth ] : Local file where negotiated authentication is kept, per device address
         iphone_user       [ None                              ] : Username (if required)  - see also options:credentials
         iphone_password   [ None                              ] : Corresponding username (plaintext)  - see also options:credentials
         quiet             [ options.quiet or False            ] : Verbosity
@@ -515,8 +1004,25 @@ class SyncSettings(object):
         iphone_ip         [ options.ipaddress                 ] : IP address of iPhone
         iphone_port       [ options.port                      ] : Port
         http              [ None                              ] : 
+        address_cache     [ AddressCache(ADDRESS_TTL)         ] : Resolved device addresses, shared across connections
+        connect_timings   [ []                                ] : Timings of each connection made - see httplib2.HTTPConnectionWithTimeout
         uri               [ None                              ] : 
         sync_mode         [ options.sync_mode or 'default'    ] : 'sync', 'backup', 'restore', or 'wipelocal'
+        compress          [ options.compress                  ] : Compress note uploads if the device accepts it
+        discovery         [ options.discovery or 'auto'       ] : 'dnssd' (pybonjour), 'mdns' (built-in), or 'auto'
+        conflict_policy   [ options.conflict_policy or 'ask'  ] : 'ask', 'newest', 'device' or 'local' - see ConflictPolicy
+        conflict_rules    [ options.conflict_rules or []      ] : List of (pattern, choice) - see ConflictPolicy
+        merge             [ options.merge                     ] : Merge notes edited on both sides where the edits don't overlap
+        note_store        [ None                              ] : notestore.NoteStore of note bodies, past and last synced
+        snapshot          [ options.snapshot                  ] : Snapshot name or time to restore the device to, or None
+        delta             [ options.delta                     ] : Send long notes as edits to their base, if the device accepts them
+        pipeline          [ options.pipeline                  ] : Pipeline small requests, if the device supports it
+        concurrency       [ AimdLimit(maximum=options.concurrency) ] : Adaptive limit on requests in flight to the device - see concurrency.py
+        retry             [ RetryPolicy(options.retries)      ] : Retries of failed device requests, with a CircuitBreaker pausing for up to options.max_pause - see retry.py
+        timeouts          [ REQUEST_TIMEOUTS                  ] : Request type -> (connect, read, total) seconds, DEFAULT_TIMEOUTS for others
+        deadline          [ now + options.deadline or None    ] : Time (time.time()) by which the run must be over - see TrunkSync.sync
+        capabilities      [ set()                             ] : Optional requests the device supports, from sync-capabilities
+        notes_cursor      [ None                              ] : Cursor given with the notes list saved by the last sync - see TrunkSync.list_iphone_notes
         """
         if sys.platform == 'darwin':
             base = os.environ['HOME']
@@ -525,6 +1031,7 @@ class SyncSettings(object):
         self.local_dir = os.path.join(base, 'Documents', 'TrunkNotes', 'Notes'      ) 
         self.local_files_dir = os.path.join(base, 'Documents', 'TrunkNotes', 'Files'      ) 
         self.last_sync_path = os.path.join(base, 'Documents', 'TrunkNotes', '.trunksync' ) 
+        self.auth_path = os.path.join(base, 'Documents', 'TrunkNotes', '.trunksync-auth' ) 
         self.iphone_user = None
         self.iphone_password = None
         if options.credentials:
@@ -539,7 +1046,32 @@ class SyncSettings(object):
         self.dryrun = options.dryrun or False
         self.iphone_ip = options.ipaddress # will be None if not set
         self.iphone_port = options.port # will be None if not set
+        self.compress = options.compress
+        self.discovery = options.discovery or 'auto'
+        self.conflict_policy = options.conflict_policy or 'ask'
+        try:
+            self.conflict_rules = [ConflictPolicy.parse_rule(rule) for rule in options.conflict_rules or []]
+        except ValueError, e:
+            raise SystemExit(str(e))
+        self.merge = options.merge
+        self.snapshot = options.snapshot
+        self.delta = options.delta
+        self.pipeline = options.pipeline
+        self.concurrency = concurrency.AimdLimit(maximum=options.concurrency)
+        self.deadline = None
+        if options.deadline:
+            self.deadline = time.time() + options.deadline
+        self.timeouts = dict(REQUEST_TIMEOUTS)
+        self.retry = retry.RetryPolicy(attempts=options.retries, deadline=self.deadline,
+                                       breaker=retry.CircuitBreaker(max_pause=options.max_pause))
+        self.capabilities = set()
+        self.notes_cursor = None
+        # Per device, so established along with last_sync_path
+        self.note_store = None
         self.http = None
+        # Shared by every connection made during this run
+        self.address_cache = httplib2.AddressCache(ADDRESS_TTL)
+        self.connect_timings = []
         self.uri = None
         if options.sync_mode in ['sync', 'backup', 'restore', 'wipelocal']:
             self.sync_mode = options.sync_mode
@@ -552,53 +1084,370 @@ class SyncSettings(object):
         """
         Setup the connection object with the username and password credentials
         """
-        self.http = httplib2.Http()
-        if self.iphone_user:
-            self.http.add_credentials(self.iphone_user, self.iphone_password)
+        self.http = self.new_connection()
         self.uri = 'http://%s:%s' % (self.iphone_ip, self.iphone_port)
+        # Send credentials with the first request if a previous run
+        # found out which scheme the device wants
+        self.load_authorizations()
         # Get the UUID of the device and modify last_sync_path accordingly
         # This is to support syncing with multiple devices
         uuid = self.iphone_request('uuid')
+        self.save_authorizations()
         if not self.last_sync_path.endswith(uuid):
             self.last_sync_path += '-%s' % (uuid, )
+        self.note_store = notestore.NoteStore(self.last_sync_path + '.store', fold_title)
+        try:
+            self.capabilities = set((self.iphone_request('capabilities') or '').split())
+        except IphoneConnectError:
+            # Older versions of Trunk Notes don't know the request
+            self.capabilities = set()
+        logging.debug('Device capabilities: %s' % (', '.join(sorted(self.capabilities)) or 'none', ))
+        self.notes_cursor = self.load_notes_cursor()
+        if self.compress:
+            self.probe_request_compression(uuid)
+
+    def new_connection(self):
+        """
+        @return: httplib2.Http set up like self.http, for use by another
+            thread (Http objects must not be shared between threads)
+        """
+        http = httplib2.Http()
+        http.address_cache = self.address_cache
+        # Requests are many and small, so don't let Nagle's algorithm
+        # hold back their bodies waiting for the headers to be acked
+        http.socket_options = httplib2.socket_options(nodelay=True, keepalive=True,
+                                                      sndbuf=SOCKET_BUFFER_SIZE, rcvbuf=SOCKET_BUFFER_SIZE)
+        http.connect_hook = self.record_connect
+        http.connect_timeout, http.timeout, http.total_timeout = DEFAULT_TIMEOUTS
+        if self.iphone_user:
+            http.add_credentials(self.iphone_user, self.iphone_password)
+        if self.http is not None:
+            http.request_encoding = self.http.request_encoding
+            # Authorizations are safe to share, and this saves every
+            # connection a 401 before its first request succeeds
+            http.authorizations = self.http.authorizations
+        return http
+
+    def set_timeouts(self, http, request_type, rounds=1):
+        """
+        Limit the next request made with http to the timeouts for its type
+
+        @param request_type: Type of request, e.g. get_note
+        @param rounds: Round trips the request will take (for a batch of
+            pipelined requests), each allowed the total time of one
+        """
+        connect, read, total = self.timeouts.get(request_type, DEFAULT_TIMEOUTS)
+        http.connect_timeout, http.timeout, http.total_timeout = connect, read, total * rounds
+
+    def past_deadline(self):
+        """
+        @return: Whether the run has reached its deadline, if it has one
+        """
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def record_connect(self, connection, timings):
+        """
+        Connect hook for device connections - see new_connection
+        """
+        self.connect_timings.append(timings)
+        logging.debug('Connected to %s:%s in %.1fms (resolving %.1fms%s)' % (
+            timings['address'][0], timings['address'][1], timings['connect'] * 1000,
+            timings['resolve'] * 1000, timings['cached'] and ', cached' or ''))
+
+    def connection_stats(self):
+        """
+        @return: Dictionary summarising connect_timings
+        """
+        count = len(self.connect_timings)
+        stats = {'connections': count, 'resolved': self.address_cache.misses}
+        if count:
+            stats['mean_resolve_ms'] = round(sum(t['resolve'] for t in self.connect_timings) * 1000 / count, 1)
+            stats['mean_connect_ms'] = round(sum(t['connect'] for t in self.connect_timings) * 1000 / count, 1)
+        return stats
+
+    def _read_auth_file(self):
+        """
+        @return: Dictionary of device address to saved authorizations
+        """
+        try:
+            with open(self.auth_path, 'rb') as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(saved, dict):
+            return {}
+        return saved
+
+    def load_authorizations(self):
+        """
+        Restore the authentication negotiated with this device on the
+        last run (scheme, realm and any Digest nonce and count), so the
+        first request carries credentials instead of drawing a 401.
+        A device which has since changed its mind just challenges
+        again, and a fresh authorization is negotiated as usual.
+        """
+        if not self.iphone_user:
+            return
+        saved = self._read_auth_file().get('%s:%s' % (self.iphone_ip, self.iphone_port))
+        if saved:
+            self.http.load_authorizations(saved)
+            logging.debug('Loaded %d saved authorization(s)' % (len(self.http.authorizations), ))
 
-    def iphone_request(self, request_type, request_data={}):
+    def save_authorizations(self):
+        """
+        Keep the authentication negotiated with this device for the next
+        run - see load_authorizations. Passwords are not saved.
+        """
+        if not self.iphone_user or self.http is None:
+            return
+        saved = self._read_auth_file()
+        saved['%s:%s' % (self.iphone_ip, self.iphone_port)] = self.http.save_authorizations()
+        try:
+            with open(self.auth_path + '.tmp', 'wb') as f:
+                json.dump(saved, f, indent=1, sort_keys=True)
+            if os.path.exists(self.auth_path):
+                # os.rename will not replace a file on Windows
+                os.remove(self.auth_path)
+            os.rename(self.auth_path + '.tmp', self.auth_path)
+        except (IOError, OSError), e:
+            logging.warn('Could not save authentication state: %s' % (e, ))
+
+    def load_notes_cursor(self):
+        """
+        @return: Cursor given with the notes list saved by the last sync,
+            or None if there isn't one, or the last sync file is no longer
+            that notes list (e.g. a sync was stopped part way)
+        """
+        try:
+            with open(self.last_sync_path + '.cursor', 'rb') as f:
+                saved = json.load(f)
+            with open(self.last_sync_path, 'rb') as f:
+                listing = hashlib.sha1(f.read()).hexdigest()
+        except (IOError, OSError, ValueError):
+            return None
+        if saved.get('listing') != listing:
+            return None
+        return saved.get('cursor')
+
+    def save_notes_cursor(self, cursor, raw_notes):
+        """
+        Keep the cursor given with the notes list just saved as the last
+        sync file, for the next sync to list the changes since
+
+        @param cursor: Cursor, or None to forget any saved cursor
+        @param raw_notes: Notes list saved as the last sync file (unicode)
+        """
+        path = self.last_sync_path + '.cursor'
+        try:
+            if cursor is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                return
+            with open(path + '.tmp', 'wb') as f:
+                json.dump({'cursor': cursor,
+                           'listing': hashlib.sha1(raw_notes.encode('utf-8')).hexdigest()}, f)
+            if os.path.exists(path):
+                # os.rename will not replace a file on Windows
+                os.remove(path)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), e:
+            logging.warn('Could not save the notes list cursor: %s' % (e, ))
+
+    def probe_request_compression(self, uuid):
+        """
+        Find out whether the device accepts gzip compressed request
+        bodies, by repeating the uuid request compressed. Large note
+        updates are compressed from then on. Files are sent as they are
+        (they are mostly images and recordings, compressed already) -
+        see iphone_upload_file.
+
+        @param uuid: UUID returned by the uncompressed request
+        """
+        threshold = self.http.request_compression_threshold
+        self.http.request_encoding = 'gzip'
+        self.http.request_compression_threshold = 0
+        try:
+            try:
+                accepted = (self.iphone_request('uuid') == uuid)
+            except (IphoneConnectError, httplib2.HttpLib2Error):
+                accepted = False
+        finally:
+            self.http.request_compression_threshold = threshold
+        if not accepted:
+            self.http.request_encoding = None
+        logging.debug('Device accepts compressed requests: %s' % (accepted, ))
+
+    def reply_fields(self, echo):
+        """
+        @param echo: Whether the note as saved by the device is wanted
+            back from update_note or update_note_delta
+        @return: Arguments for those requests, asking for just the note's
+            title back where that will do and the device supports it
+        """
+        if echo or 'reply_title' not in self.capabilities:
+            return {}
+        return {'reply': 'title'}
+
+    def encode_request(self, request_dict):
+        """
+        @param request_dict: Dictionary of key/value pair arguments for a request
+        @return: (headers, body) for the request: urlencoded, or as
+            multipart/form-data if the device accepts that and it is
+            smaller, as it is for notes which aren't plain ASCII
+        """
+        body = urllib.urlencode(request_dict)
+        if 'form_data' in self.capabilities:
+            boundary, multipart = encode_multipart(request_dict)
+            if len(multipart) < len(body):
+                return {'Content-type': 'multipart/form-data; boundary=%s' % (boundary, )}, multipart
+        return {'Content-type': 'application/x-www-form-urlencoded'}, body
+
+    def iphone_request(self, request_type, request_data={}, http=None):
         """
         Make a request to Trunk Notes on the iPhone
 
         @param request_type: Type of request, e.g. uuid
         @param request_data: Dictionary of key/value pair arguments for request
+        @param http: Connection to use instead of self.http - see new_connection
 
         @return: String returned from request (None if 404)
         """
         request_dict = {}
         request_dict.update({'submit': 'sync-%s' % (request_type, )})
         request_dict.update(request_data)
-        headers = {'Content-type': 'application/x-www-form-urlencoded'}
-        response, content = self.http.request(self.uri, 'POST',
-                                              headers=headers, body=urllib.urlencode(request_dict))
-        if response['status'] == '200':
-            return content
-        elif response['status'] == '404':
-            return None
-        else:
-            raise IphoneConnectError, response
+        headers, body = self.encode_request(request_dict)
+        def attempt():
+            self.set_timeouts(http or self.http, request_type)
+            with self.concurrency.request(request_type) as outcome:
+                response, content = (http or self.http).request(self.uri, 'POST', headers=headers, body=body)
+                outcome.kind = '%s %s' % (request_type, concurrency.size_class(len(body) + len(content)))
+                if response.status >= 500:
+                    outcome.error()
+            if response['status'] == '200':
+                return content
+            elif response['status'] == '404':
+                return None
+            else:
+                raise IphoneConnectError, response
+        return self.retry.call(attempt, request_type in IDEMPOTENT_REQUESTS, classify_failure, request_type)
 
-    def iphone_get_file(self, filename):
+    def iphone_requests(self, request_type, request_data_list):
         """
-        Try and get a file from the iPhone
+        Make several requests of one type to Trunk Notes on the iPhone,
+        pipelined if the device supports it
+
+        @param request_type: Type of request, e.g. get_note
+        @param request_data_list: List of dictionaries of arguments, one per request
+
+        @return: List of strings returned from the requests (None if 404)
+        """
+        requests = []
+        for request_data in request_data_list:
+            request_dict = {}
+            request_dict.update({'submit': 'sync-%s' % (request_type, )})
+            request_dict.update(request_data)
+            headers, body = self.encode_request(request_dict)
+            requests.append(('POST', body, headers))
+        def attempt():
+            depth = self.pipeline and self.concurrency.allowed() or 1
+            rounds = (len(requests) + depth - 1) // depth
+            self.set_timeouts(self.http, request_type, rounds)
+            # The batch takes up to depth of the requests allowed in flight,
+            # and each of its round trips counts as one request's latency
+            with self.concurrency.request('pipelined %s' % (request_type, ), len(requests), rounds) as outcome:
+                results = self.http.pipeline(self.uri, requests, depth=depth)
+                if [response for response, content in results if response.status >= 500]:
+                    outcome.error()
+            contents = []
+            for response, content in results:
+                if response['status'] == '200':
+                    contents.append(content)
+                elif response['status'] == '404':
+                    contents.append(None)
+                else:
+                    raise IphoneConnectError, response
+            return contents
+        # The whole batch is made again, so only if every request in it
+        # can be repeated
+        return self.retry.call(attempt, request_type in IDEMPOTENT_REQUESTS, classify_failure,
+                               'pipelined %s' % (request_type, ))
+
+    def iphone_request_stream(self, request_type, request_data={}):
+        """
+        Make a request to Trunk Notes on the iPhone, without reading
+        the whole response into memory
+
+        @param request_type: Type of request, e.g. notes_list
+        @param request_data: Dictionary of key/value pair arguments for request
+
+        @return: Iterator over chunks of the response (None if 404)
+        """
+        request_dict = {}
+        request_dict.update({'submit': 'sync-%s' % (request_type, )})
+        request_dict.update(request_data)
+        headers, body = self.encode_request(request_dict)
+        def attempt():
+            # The total timeout also covers the caller reading the response
+            self.set_timeouts(self.http, request_type)
+            response, chunks = self.http.request_stream(self.uri, 'POST', headers=headers, body=body)
+            if response['status'] == '200':
+                return chunks
+            for chunk in chunks:
+                pass
+            if response['status'] == '404':
+                return None
+            else:
+                raise IphoneConnectError, response
+        # Only up to the start of the response is retried, as the
+        # caller reads the rest
+        return self.retry.call(attempt, request_type in IDEMPOTENT_REQUESTS, classify_failure, request_type)
+
+    def iphone_get_file_to(self, filename, local_path):
+        """
+        Get a file from the iPhone, writing it to disk as it arrives.
+        A download which fails part way carries on from where it got to
+        when it is retried, or in the next run - see transfer.PartialDownload
 
         @param filename: Filename on the iPhone
+        @param local_path: Where to save the file
 
-        @return: File contents (None if doesn't exist)
+        @return: True if the file was saved, False if it doesn't exist
+        @raise transfer.TransferError: If the file still arrives damaged
+            after retrying
         """
-        response, content = self.http.request('%s/files/%s' % (self.uri, filename), 'GET')
-        if response['status'] == '200':
-            return content
-        elif response['status'] == '404':
-            return None
-        else:
-            raise IphoneConnectError, response
+        download = transfer.PartialDownload(local_path)
+        def attempt():
+            self.set_timeouts(self.http, 'get_file')
+            # Only the wait for the response counts towards the latency, as
+            # the time the body takes depends on the size of the file
+            with self.concurrency.request('get_file headers') as outcome:
+                response, chunks = self.http.request_stream('%s/files/%s' % (self.uri, filename), 'GET',
+                                                            headers=download.resume_headers())
+                if response.status >= 500:
+                    outcome.error()
+            if response.status not in (200, 206):
+                # Drain the body so the connection can be reused
+                for chunk in chunks:
+                    pass
+                if response.status == 404:
+                    download.discard()
+                    return False
+                elif response.status == 416:
+                    # The file is now shorter than what was downloaded of it
+                    download.discard()
+                    raise transfer.TransferError('%s has changed on the device' % (filename, ))
+                raise IphoneConnectError, response
+            download.start(response.status, response)
+            try:
+                for chunk in chunks:
+                    download.write(chunk)
+            except:
+                # Keep what arrived, for the retry to carry on from
+                download.checkpoint()
+                raise
+            download.finish()
+            return True
+        return self.retry.call(attempt, True, classify_failure, 'get_file')
 
     def iphone_upload_file(self, filename, local_path):
         """
@@ -609,29 +1458,214 @@ class SyncSettings(object):
 
         @return: Result of making request
         """
-        # Read entire file into memory - not ideal...
-        # file_contents = codecs.open(local_path, 'r', 'utf-8').read()
-        file_contents = open(local_path, 'r').read()
+        if 'upload_file_range' in self.capabilities:
+            return self.iphone_upload_file_range(filename, local_path)
         boundary = '----------ThIs_Is_tHe_bouNdaRY_$'
         crlf = '\r\n'
-        l = ['--' + boundary,
-             'Content-disposition: form-data; filename="%s"' % (filename, ),
-             'Content-type: application/octet-stream',
-             '',
-             file_contents,
-             '--' + boundary + '--',
-             '',
-            ]
-        body = crlf.join(l)
-        headers = {'Content-type': 'multipart/form-data; boundary=%s' % (boundary, ),
-                   'Content-length': str(len(body)),
-                  }
-        response, content = self.http.request(self.uri, 'POST', headers=headers, body=body)
-        if response['status'] == '200':
-            return content
-        else:
-            raise IphoneConnectError, response
+        # Only the parts around the file are built here: the file is
+        # sent from a memory map of it - see httplib2.FileBody
+        preamble = crlf.join(['--' + boundary,
+                              'Content-disposition: form-data; filename="%s"' % (filename, ),
+                              'Content-type: application/octet-stream',
+                              '',
+                              ''])
+        epilogue = crlf.join(['',
+                              '--' + boundary + '--',
+                              ''])
+        with open(local_path, 'rb') as f:
+            body = httplib2.FileBody([preamble, f, epilogue])
+            size = len(body)
+            headers = {'Content-type': 'multipart/form-data; boundary=%s' % (boundary, ),
+                       'Content-length': str(size),
+                      }
+            def attempt():
+                self.set_timeouts(self.http, 'upload_file')
+                with self.concurrency.request('upload_file %s' % (concurrency.size_class(size), )) as outcome:
+                    response, content = self.http.request(self.uri, 'POST', headers=headers, body=body)
+                    if response.status >= 500:
+                        outcome.error()
+                if response['status'] == '200':
+                    return content
+                else:
+                    raise IphoneConnectError, response
+            return self.retry.call(attempt, False, classify_failure, 'upload_file')
+
+    def iphone_upload_file_range(self, filename, local_path):
+        """
+        Upload a local file to the iPhone files store in chunks of up to
+        UPLOAD_CHUNK_BYTES, where the device supports it. A retry carries
+        on from the last chunk the device has - see transfer
+
+        @param filename: Filename
+        @param local_path: Path to local file
+
+        @return: Result of the request which completed the upload
+        @raise transfer.TransferError: If the file the device ends up
+            with still doesn't match after retrying
+        """
+        url = '%s/files/%s' % (self.uri, urllib.quote(filename))
+        with open(local_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            digest = transfer.sha_digest(f)
+            def put(body, content_range):
+                headers = {'Content-type': 'application/octet-stream',
+                           'Content-length': str(len(body)),
+                           'Content-range': content_range,
+                           'Digest': digest,
+                          }
+                self.set_timeouts(self.http, 'upload_file')
+                with self.concurrency.request('upload_file %s' % (concurrency.size_class(len(body)), )) as outcome:
+                    response, content = self.http.request(url, 'PUT', headers=headers, body=body)
+                    if response.status >= 500:
+                        outcome.error()
+                return response, content
+            def attempt():
+                # Ask how much of the file the device has already
+                response, content = put('', 'bytes */%d' % (size, ))
+                while response.status == 308:
+                    offset = transfer.received_bytes(response.get('range'))
+                    if offset >= size:
+                        raise IphoneConnectError, response
+                    length = min(UPLOAD_CHUNK_BYTES, size - offset)
+                    response, content = put(httplib2.FileBody([(f, offset, length)]),
+                                            'bytes %d-%d/%d' % (offset, offset + length - 1, size))
+                if response.status == 200:
+                    return content
+                elif response.status == 409:
+                    # The device has discarded what it had, to start again
+                    raise transfer.TransferError('Uploaded %s does not match: %s' % (filename, content))
+                raise IphoneConnectError, response
+            # Each chunk says where it goes, so can be sent again
+            return self.retry.call(attempt, True, classify_failure, 'upload_file')
+
+
+
+class Conflict(object):
+    """
+    A note which has been created, or updated, both on the device and
+    locally since the last sync
+    """
+
+    def __init__(self, kind, device_note, local_note):
+        """
+        @param kind: 'created' or 'updated'
+        @param device_note: Note as listed by the device
+        @param local_note: Note as found locally
+        """
+        self.kind = kind
+        self.device_note = device_note
+        self.local_note = local_note
+        self.key = device_note.key
+        self.name = device_note.name
+        # 'device', 'local', 'merged', or None until decided
+        self.resolution = None
+
+    def describe(self):
+        return '%s has been %s on your mobile device and locally.' % (self.name, self.kind)
+
+    def folder(self):
+        """
+        @return: Folder of the local note, relative to local_dir
+        """
+        path = self.local_note.local_path or ''
+        return os.path.dirname(os.path.relpath(path, settings.local_dir)) if path else ''
+
+    def newest(self):
+        """
+        @return: 'device' or 'local', whichever changed most recently
+        """
+        if self.device_note.mtime >= self.local_note.mtime:
+            return 'device'
+        return 'local'
+
+    def merge(self, store):
+        """
+        Try to combine the device and local edits, using the body both
+        sides had at the last sync. On success the merged body is left
+        in local_note.contents and resolution is 'merged'.
 
+        @param store: notestore.NoteStore holding the last synced bodies
+        @return: True if the edits were merged
+        """
+        if self.kind != 'updated' or self.name.startswith('File:'):
+            # Nothing in common to merge from, or a file to go with it
+            return False
+        base = store.get_base(self.name)
+        if base is None:
+            return False
+        self.device_note.hydrate_from_iphone()
+        if self.device_note.contents is None:
+            return False
+        local = self.local_note.read_local()
+        # The local Timestamp: line is rewritten whenever the note is
+        # uploaded, so a difference in it is not a local edit
+        base_timestamp = TIMESTAMP_LINE.search(base)
+        if base_timestamp:
+            local = TIMESTAMP_LINE.sub(lambda match: base_timestamp.group(0), local, 1)
+        merged = merge3.merge_text(base, self.device_note.contents, local)
+        if merged is None:
+            logging.info(u'Edits to %s overlap, cannot merge' % (self.name, ))
+            return False
+        logging.info(u'Merged edits to %s' % (self.name, ))
+        self.local_note.contents = merged
+        self.resolution = 'merged'
+        return True
+
+
+class ConflictPolicy(object):
+    """
+    Settles conflicts without asking, where configured to
+
+    Rules are (pattern, choice) pairs tried in order. A pattern matches
+    a conflict if it fnmatches either the note's folder (relative to
+    local_dir) or the note's title. Choices are 'device', 'local',
+    'newest' or 'ask'.
+    """
+
+    CHOICES = ('ask', 'newest', 'device', 'local')
+
+    def __init__(self, default='ask', rules=()):
+        """
+        @param default: Choice for conflicts no rule matches
+        @param rules: List of (pattern, choice)
+        """
+        assert default in self.CHOICES, 'Invalid conflict policy'
+        self.default = default
+        self.rules = list(rules)
+
+    @classmethod
+    def parse_rule(cls, rule):
+        """
+        >>> ConflictPolicy.parse_rule('Work/*=local')
+        ('Work/*', 'local')
+
+        @param rule: PATTERN=CHOICE, as given on the command line
+        """
+        if '=' not in rule:
+            raise ValueError('conflict rule must be PATTERN=CHOICE: %s' % (rule, ))
+        pattern, choice = rule.rsplit('=', 1)
+        if choice not in cls.CHOICES:
+            raise ValueError('conflict rule choice must be one of %s: %s' % (', '.join(cls.CHOICES), rule))
+        return pattern, choice
+
+    def choice_for(self, conflict):
+        folder = conflict.folder()
+        for pattern, choice in self.rules:
+            if (fnmatch.fnmatch(folder, pattern) or
+                fnmatch.fnmatch(conflict.name, pattern)):
+                return choice
+        return self.default
+
+    def resolve(self, conflict):
+        """
+        @return: 'device', 'local', or None if the user must decide
+        """
+        choice = self.choice_for(conflict)
+        if choice == 'newest':
+            return conflict.newest()
+        elif choice == 'ask':
+            return None
+        return choice
 
 
 class SyncAnalyser(object):
@@ -655,10 +1689,16 @@ class SyncAnalyser(object):
         self.updated_locally = []
         self.deleted_on_iphone = []
         self.deleted_locally = []
+        # (source, titles) for titles differing only in case
+        self.case_collisions = []
+        # Conflict for each note changed on both sides
+        self.conflicts = []
+        # Local notes holding a merge of both sides' edits
+        self.merged = []
         ## stu 100912
-        ## stu 110131 - DISABLED, enable get_internal_title()
-        #self.overridden_on_iphone = []
-        #self.overridden_locally = []
+        # Losing side of each conflict, backed up before being replaced
+        self.overridden_on_iphone = []
+        self.overridden_locally = []
 
     def analyse(self):
         """
@@ -682,112 +1722,119 @@ class SyncAnalyser(object):
         >>> print t.deleted_locally
         [NoteThree (2)]
         """
+        # Report titles which only differ in case, as only one of each
+        # will survive the sync
+        for source, notes in (('device', self.iphone_notes), ('local', self.local_notes)):
+            for titles in find_case_collisions(notes):
+                logging.warn(u'Notes on %s differ only in case, only one will be synced: %s' % (source, u', '.join(titles)))
+                self.case_collisions.append((source, titles))
         # - for each note from iPhone:
         #  * mark as NEW ON IPHONE if,
         #    * not in last sync list
         #  * mark as UPDATED ON IPHONE if,
         #    * in last sync list AND last modification date > last sync list
-        for note in self.iphone_notes:
-            if not note in self.lastsync_notes:
-                # not seen this note before
-                self.new_on_iphone.append(note)
-            else:
-                i = self.lastsync_notes.index(note)
-                if note.last_modified > self.lastsync_notes[i].last_modified:
-                    # # Get the path of the note locally, so that when the local
-                    # # note is updated the correct file will be written to
-                    # i2 = self.local_notes.index(note)
-                    # assert i2 >= 0, 'Note mentioned in last sync but no connected local note'
-                    # note.local_path = self.local_notes[i2].local_path
-                    self.updated_on_iphone.append(note)
         # - for each note locally:
         #     * mark as NEW LOCALLY if,
         #       * not in last sync list
         #     * mark as UPDATED LOCALLY if,
         #       * in last sync list AND last modification date > last sync list
-        for note in self.local_notes:
-            if not note in self.lastsync_notes:
-                self.new_locally.append(note)
-            else:
-                i = self.lastsync_notes.index(note)
-                if note.last_modified > self.lastsync_notes[i].last_modified:
-                    self.updated_locally.append(note)
+        # - for each note in last sync list:
+        #     * mark as DELETED ON IPHONE if,
+        #       * not in iPhone list
+        #     * mark as DELETED LOCALLY if,
+        #       * not in local list
+        self.new_on_iphone, self.updated_on_iphone, self.deleted_on_iphone = \
+            classify_notes(self.iphone_notes, self.lastsync_notes)
+        self.new_locally, self.updated_locally, self.deleted_locally = \
+            classify_notes(self.local_notes, self.lastsync_notes)
+        # Index the last sync list by note key. Where titles collide the
+        # first is used, as list.index() would have found.
+        last_columns = NoteColumns.of(self.lastsync_notes)
+        lastsync_mtimes = {}
+        for key, mtime in itertools.izip(last_columns.keys, last_columns.mtimes):
+            lastsync_mtimes.setdefault(key, mtime)
         # - for each ~file~ note locally:
         #     * mark as NEW LOCALLY if,
         #       * not in last sync list, and not already marked as NEW LOCALLY
         #     * mark as UPDATED LOCALLY if,
         #       * in last sync list AND last modification date > last sync list, and not already marked as UPDATED LOCALLY
+        new_locally_keys = set(note.key for note in self.new_locally)
+        updated_locally_keys = set(note.key for note in self.updated_locally)
         for note in self.local_file_notes:
-            if not note in self.lastsync_notes:
-                if not note in self.new_locally:
+            last_mtime = lastsync_mtimes.get(note.key)
+            if last_mtime is None:
+                if note.key not in new_locally_keys:
                     self.new_locally.append(note)
-            else:
-                i = self.lastsync_notes.index(note)
-                if note.last_modified > self.lastsync_notes[i].last_modified:
-                    if not note in self.updated_locally:
-                        self.updated_locally.append(note)
-        # - for each note in last sync list:
-        #     * mark as DELETED ON IPHONE if,
-        #       * not in iPhone list
-        #     * mark as DELETED LOCALLY if,
-        #       * not in local list
-        for note in self.lastsync_notes:
-            if not note in self.iphone_notes:
-                self.deleted_on_iphone.append(note)
-            if not note in self.local_notes:
-                self.deleted_locally.append(note)
+                    new_locally_keys.add(note.key)
+            elif note.mtime > last_mtime:
+                if note.key not in updated_locally_keys:
+                    self.updated_locally.append(note)
+                    updated_locally_keys.add(note.key)
         # Resolve conflicts.
         # Note it isn't possible for note to be 'new' on
         # one location and 'updated' on the other, as
         # 'new' status derives from a common source - the
         # last sync list.
+        # All conflicts are collected first, settled by the conflict
+        # policy where it can, and the rest put to the user in one go.
+        local_index = dict((note.key, note) for note in self.local_notes + self.local_file_notes)
         for note in self.new_on_iphone:
-            if note in self.new_locally:
-                if self.ui:
-                    ## stu 100912 - added backups, when conflicts discovered
-                    ## stu 110131 - DISABLED, enable get_internal_title()
-                    noi, nol = self.new_on_iphone, self.new_locally
-                    answer = self.ui.resolve_conflict('%s has been created on your mobile device and locally.' % (note.name, ), ['device', 'local'])
-                    if answer == 'device':
-                        # User has chosen to keep one on device, so remove local note reference
-                        ## self.overridden_locally.append(note)
-                        self.new_locally.remove(note)
-                    elif answer == 'local':
-                        ## self.overridden_on_iphone.append(note)
-                        self.new_on_iphone.remove(note)
-                    else:
-                        assert False, 'Invalid resolve choice'
-                else:
-                    print 'Resolve conflict: A note with the same name has been created on both the iPhone and locally since last sync'
-                    # XXX: perhaps 'return False' here?
-            assert not note in self.updated_locally, 'Note new on iPhone but updated locally'
+            if note.key in new_locally_keys:
+                self.conflicts.append(Conflict('created', note, local_index[note.key]))
+            assert not note.key in updated_locally_keys, 'Note new on iPhone but updated locally'
         for note in self.updated_on_iphone:
-            if note in self.updated_locally:
-                if self.ui:
-                    ## stu 100912 - logic to backup or diff, when conflicts discovered
-                    ## stu 110131 - DISABLED, enable get_internal_title()
-                    answer = self.ui.resolve_conflict('%s has been updated on your mobile device and locally.' % (note.name, ), ['device', 'local'])
-                    if answer == 'device':
-                        # User has chosen to keep one on device, so remove local note reference
-                        ##self.overridden_locally.append(note)
-                        self.updated_locally.remove(note)
-                    elif answer == 'local':
-                        ##self.overridden_on_iphone.append(note)
-                        self.updated_on_iphone.remove(note)
-                    else:
-                        assert False, 'Invalid resolve choice'
-                else:
-                    print 'Resolve conflict: A note with the same name has been updated on both the iPhone and locally since last sync'
-                    # XXX: perhaps 'return False' here?
-            assert not note in self.new_locally, 'Note updated on iPhone but new locally'
+            if note.key in updated_locally_keys:
+                self.conflicts.append(Conflict('updated', note, local_index[note.key]))
+            assert not note.key in new_locally_keys, 'Note updated on iPhone but new locally'
+        # Edits to different parts of a note are merged without asking
+        if settings.merge and settings.note_store is not None and not settings.dryrun:
+            for conflict in self.conflicts:
+                conflict.merge(settings.note_store)
+        policy = ConflictPolicy(settings.conflict_policy, settings.conflict_rules)
+        undecided = []
+        for conflict in self.conflicts:
+            if conflict.resolution is not None:
+                continue
+            conflict.resolution = policy.resolve(conflict)
+            if conflict.resolution is None:
+                undecided.append(conflict)
+        if undecided:
+            if self.ui:
+                ## stu 100912 - added backups, when conflicts discovered
+                ## stu 110131 - DISABLED, enable get_internal_title()
+                self.ui.resolve_conflicts(undecided)
+            else:
+                print 'Resolve conflict: %d notes have been changed on both the iPhone and locally since last sync' % (len(undecided), )
+                # XXX: perhaps 'return False' here?
+        for conflict in self.conflicts:
+            if conflict.kind == 'created':
+                on_iphone, locally, locally_keys = self.new_on_iphone, self.new_locally, new_locally_keys
+            else:
+                on_iphone, locally, locally_keys = self.updated_on_iphone, self.updated_locally, updated_locally_keys
+            if conflict.resolution == 'device':
+                # User has chosen to keep one on device, so remove local note reference
+                self.overridden_locally.append(conflict.local_note)
+                locally.remove(conflict.device_note)
+                locally_keys.discard(conflict.key)
+            elif conflict.resolution == 'local':
+                # Backed up beside the local note which replaces it
+                conflict.device_note.local_path = conflict.local_note.local_path
+                self.overridden_on_iphone.append(conflict.device_note)
+                on_iphone.remove(conflict.device_note)
+            elif conflict.resolution == 'merged':
+                # Both sides get the merged note
+                self.merged.append(conflict.local_note)
+                locally.remove(conflict.device_note)
+                on_iphone.remove(conflict.device_note)
+            else:
+                assert conflict.resolution is None and self.ui is None, 'Invalid resolve choice'
         # Make sure that no notes which were updated locally are scheduled for deletion locally
-        for note in self.updated_locally:
-            if note in self.deleted_on_iphone:
-                self.deleted_on_iphone.remove(note)
+        self.deleted_on_iphone = [note for note in self.deleted_on_iphone
+                                  if note.key not in updated_locally_keys]
         # Make sure that no notes which were updated on the iphone are scheduled for deletion on the iphone
-        for note in self.updated_on_iphone:
-            if note in self.deleted_locally:
-                self.deleted_locally.remove(note)
+        updated_on_iphone_keys = set(note.key for note in self.updated_on_iphone)
+        self.deleted_locally = [note for note in self.deleted_locally
+                                if note.key not in updated_on_iphone_keys]
         # try:
         # except ValueError, e:
         #     print note
@@ -828,24 +1875,64 @@ class TrunkSync(object):
         """
 
         self.ui = ui
+        # Set once the sync stops part way - see checkpoint
+        self.stopped = False
+        # The device's notes as listed at the start of the sync, and the
+        # cursor given with them - see list_iphone_notes
+        self.listing = []
+        self.cursor = None
         settings.setup_iphone_connection()
 
-    def get_notes_from_iphone(self):
+    def get_notes_from_iphone(self, lastsync_notes=()):
         """
         Get a list of notes form the iPhone
 
-        @return: List of Note instances
+        @param lastsync_notes: NoteColumns from the last sync file, for
+            the device to list only the changes since - see list_iphone_notes
+        @return: NoteColumns
         """
-        raw_notes = settings.iphone_request('notes_list').decode('utf-8')
-        notes = []
-        for note in raw_notes.splitlines():
-            note = note.strip()
-            if note:
-                timestamp, title = note.split(u':', 1)
-                notes.append(Note(title, time.gmtime(int(timestamp))))
-                # DEBUG HERE
-                logging.debug(u'%s - %s' % (timestamp, title))
-        return notes
+        known = NoteColumns.of(lastsync_notes).entries()
+        self.listing, self.cursor = self.list_iphone_notes(known, settings.notes_cursor)
+        return NoteColumns(self.listing)
+
+    def list_iphone_notes(self, known, cursor):
+        """
+        List the notes on the device. Where the device supports
+        notes_list_since, each listing comes with a cursor (a 'cursor:'
+        line before the notes), and the next can ask for just the notes
+        created or changed since, with 'deleted:' lines for those deleted
+        since, by sending the cursor as since. A device which no longer
+        knows the cursor answers 410, and every note is listed instead.
+
+        @param known: Iterable of (seconds since epoch, title) tuples,
+            the notes as listed with cursor
+        @param cursor: Cursor to list the changes since, or None
+        @return: (list of (seconds since epoch, title) tuples, cursor
+            given with them or None)
+        """
+        if 'notes_list_since' not in settings.capabilities:
+            chunks = settings.iphone_request_stream('notes_list') or []
+            return list(iter_notes_list(chunks)), None
+        given = [None]
+        if cursor is not None:
+            try:
+                chunks = settings.iphone_request_stream('notes_list', {'since': cursor}) or []
+                notes = dict((title, timestamp) for timestamp, title in known)
+                changes = 0
+                for timestamp, title in iter_notes_changes(chunks, given):
+                    if timestamp is None:
+                        notes.pop(title, None)
+                    else:
+                        notes[title] = timestamp
+                    changes += 1
+                logging.info('Notes changed on the device since the last listing: %d' % (changes, ))
+                return [(timestamp, title) for title, timestamp in sorted(notes.items())], given[0]
+            except IphoneConnectError, e:
+                if e[0]['status'] != '410':
+                    raise
+                logging.info('Device no longer has the changes since the last listing, listing every note')
+        chunks = settings.iphone_request_stream('notes_list', {'since': ''}) or []
+        return list(iter_notes_changes(chunks, given)), given[0]
 
     def get_notes_from_local(self):
         """
@@ -874,7 +1961,7 @@ class TrunkSync(object):
                     # only consider .EXT files
                 note_path = os.path.join(dirpath, filename)
                 # For a local note the timestamp is just the files last modified date
-                last_modified = time.gmtime(os.stat(note_path).st_mtime)
+                last_modified = int(os.stat(note_path).st_mtime)
                 # Note title is preferrably from the Title: metadata, if this does
                 # not exist then it will be the filename (minus the file extension)
                 note_name = Note.get_internal_title(note_path)
@@ -883,8 +1970,16 @@ class TrunkSync(object):
                     # any other notes of the same name, but all bets are
                     # off really without the metadata.
                     note_name = os.path.splitext(filename)[0]
+                    # local_dir is a byte string, so filenames are too
+                    try:
+                        note_name = note_name.decode(sys.getfilesystemencoding() or 'utf-8')
+                    except UnicodeDecodeError:
+                        # e.g. ASCII under the C locale
+                        note_name = note_name.decode('utf-8', 'replace')
+                # Keyed by the exact title, so titles which differ only
+                # in case are all kept for find_case_collisions to report
                 if note_name in notes:
-                    if notes[note_name].last_modified > last_modified:
+                    if notes[note_name].mtime > last_modified:
                         logging.warn(u'Multiple local notes for "%s" - using most recent'%(note_name))
                         continue
                 notes[note_name] = Note(note_name, last_modified, local_path=note_path)
@@ -920,7 +2015,7 @@ class TrunkSync(object):
                     continue
                 file_path = os.path.join(dirpath, filename)
                 # For a local note the timestamp is just the files last modified date
-                last_modified = time.gmtime(os.stat(note_path).st_mtime)
+                last_modified = int(os.stat(note_path).st_mtime)
                 # Construct note name and path
                 note_path = os.path.join(settings.local_dir, "File" + filename + "." + FILE_EXTENSION)
                 # Note title is preferrably from the Title: metadata, if this does
@@ -933,18 +2028,231 @@ class TrunkSync(object):
         """
         Get a list of notes as they were the last time sync happened
 
-        @return: List of Note instances
+        @return: NoteColumns
         """
-        notes = []
+        notes = NoteColumns()
         # Assuming not the first time synced with this directory
         if os.path.exists(settings.last_sync_path):
-            for line in codecs.open(settings.last_sync_path, 'r', 'utf-8').readlines():
-                line = line.strip()
-                if line:
-                    timestamp, title = line.split(':', 1)
-                notes.append(Note(title, time.gmtime(int(timestamp))))
+            with open(settings.last_sync_path, 'rb') as f:
+                notes = NoteColumns(iter_notes_list(f))
         return notes
 
+    def until_deadline(self, notes):
+        """
+        @param notes: List of Note instances
+        @return: Iterator over notes, ending early (and setting
+            self.stopped) once settings.deadline is reached
+        """
+        for note in notes:
+            if settings.past_deadline():
+                self.stopped = True
+                return
+            yield note
+
+    def hydrate_notes_from_iphone(self, notes):
+        """
+        Get notes from the iPhone, a batch of pipelined requests at a
+        time, until settings.deadline
+
+        @param notes: List of Note instances
+        @return: Iterator over notes, each hydrated when it is reached
+        """
+        for start in xrange(0, len(notes), PIPELINE_BATCH):
+            if settings.past_deadline():
+                self.stopped = True
+                return
+            batch = notes[start:start + PIPELINE_BATCH]
+            for note in batch:
+                logging.info(u'<< Getting note from device: %s' % (note.name, ))
+            responses = settings.iphone_requests('get_note', [{'title': note.name.encode('utf-8')}
+                                                              for note in batch])
+            for note, response in zip(batch, responses):
+                note.set_device_contents(response)
+                yield note
+
+    def delete_notes_on_iphone(self, notes):
+        """
+        Delete notes from the iPhone, a batch of pipelined requests at a
+        time, until settings.deadline
+
+        @param notes: List of Note instances
+        @return: List of the notes deleted
+        """
+        deleted = []
+        for start in xrange(0, len(notes), PIPELINE_BATCH):
+            if settings.past_deadline():
+                self.stopped = True
+                break
+            batch = notes[start:start + PIPELINE_BATCH]
+            for note in batch:
+                logging.info(u'<< Deleting from device: %s' % (note.name, ))
+            settings.iphone_requests('remove_note', [{'title': note.name.encode('utf-8')} for note in batch])
+            deleted.extend(batch)
+        return deleted
+
+    def update_local_times(self, notes, raw_notes):
+        """
+        Update timestamps on those notes which were new locally but
+        were replaced with versions from the iPhone
+
+        @param notes: Note instances sent to the device
+        @param raw_notes: Notes list from the device, after sending them
+        """
+        times_from_iphone = {}
+        for line in raw_notes.split('\n'):
+            if ':' in line:
+                timestamp, note_name = line.split(':', 1)
+                try:
+                    times_from_iphone[note_name] = int(timestamp)
+                except ValueError:
+                    logging.warn('Error in timestamp for note: %s' % (note_name, ))
+        for note in notes:
+            try:
+                timestamp = times_from_iphone.get(note.name)
+            except:
+                timestamp = None
+            if timestamp:
+                note.update_time(timestamp)
+            else:
+                logging.warn('Could not update the local timestamp of '
+                             'note: %s' % (note.name, ))
+
+    def checkpoint(self, iphone_notes, lastsync_notes, synced, sent_new):
+        """
+        Save the last sync state of a sync stopped part way, so the next
+        run carries on from there: notes whose changes were made are
+        recorded as they now are on the device, and every other note as
+        it was after the last complete sync, so its change is found
+        again. No snapshot is taken.
+
+        @param iphone_notes: NoteColumns from the device at the start of
+            the sync
+        @param lastsync_notes: NoteColumns from the last sync file
+        @param synced: Keys of the notes whose changes were made
+        @param sent_new: Notes new locally which were sent to the device
+        """
+        try:
+            raw_notes = settings.iphone_request('notes_list').decode('utf-8')
+            device_notes = NoteColumns(iter_notes_list([raw_notes.encode('utf-8')]))
+        except (IphoneConnectError, httplib2.HttpLib2Error, socket.error, httplib.HTTPException, retry.CircuitOpen), e:
+            # Notes sent to the device then keep their entries from
+            # before, so are sent again by the next run
+            logging.warn('Could not list the notes on the device (%s), '
+                         'saving progress as of the start of the sync' % (e, ))
+            raw_notes = None
+            device_notes = iphone_notes
+        notes = [(key, mtime, title) for key, mtime, title
+                 in itertools.izip(lastsync_notes.keys, lastsync_notes.mtimes, lastsync_notes.titles)
+                 if key not in synced]
+        notes.extend((key, mtime, title) for key, mtime, title
+                     in itertools.izip(device_notes.keys, device_notes.mtimes, device_notes.titles)
+                     if key in synced)
+        notes.sort(key=lambda note: note[0])
+        with codecs.open(settings.last_sync_path, 'w', 'utf-8') as last_sync_file:
+            for key, mtime, title in notes:
+                last_sync_file.write(u'%d:%s\n' % (mtime, title))
+        settings.note_store.save()
+        if raw_notes is not None:
+            self.update_local_times(sent_new, raw_notes)
+
+    def take_snapshot(self, raw_notes):
+        """
+        Record every note as it stands at the end of the sync, so any of
+        them can be restored later. Notes which have been synced before
+        already have their body in the store as a base, so only notes
+        the store has never seen are read from disk.
+
+        @param raw_notes: Notes list from the device, after syncing
+        """
+        store = settings.note_store
+        local_index = None
+        entries = []
+        for timestamp, title in iter_notes_list([raw_notes.encode('utf-8')]):
+            sha = store.base_id(title)
+            if sha is None:
+                if local_index is None:
+                    local_index = dict((note.key, note) for note in self.get_notes_from_local())
+                note = local_index.get(fold_title(title))
+                if note is None:
+                    logging.warn(u'No local copy to snapshot of note: %s' % (title, ))
+                    continue
+                sha = store.set_base(title, note.read_local())
+            entries.append((title, timestamp, sha))
+        store.save()
+        name = store.snapshot(entries)
+        logging.info('Snapshot %s of %d notes' % (name, len(entries)))
+
+    def restore_snapshot(self):
+        """
+        Put the device back as it was at settings.snapshot, uploading
+        only the notes which have changed (or gone) since. Notes created
+        on the device after the snapshot are left alone.
+        """
+        store = settings.note_store
+        name = store.find_manifest(settings.snapshot)
+        if name is None:
+            self.ui.error('No snapshot at or before %s. Snapshots: %s' %
+                          (settings.snapshot, ', '.join(store.manifests()) or 'none'))
+            sys.exit(1)
+        chunks = settings.iphone_request_stream('notes_list') or []
+        device_times = dict((fold_title(title), timestamp) for timestamp, title in iter_notes_list(chunks))
+        # A note whose device timestamp is the one recorded in the
+        # manifest hasn't changed since
+        changed = [(title, sha) for title, timestamp, sha in store.read_manifest(name)
+                   if device_times.get(fold_title(title)) != timestamp]
+        logging.info('Restoring snapshot %s: %d notes differ' % (name, len(changed)))
+        if settings.dryrun:
+            for title, sha in changed:
+                print title.encode('utf-8')
+            return True
+        # Restored notes are stamped as edited now, so the next sync
+        # brings them back to local as well
+        now = time.gmtime()
+        jobs = Queue.Queue()
+        failed = []
+        for title, sha in changed:
+            contents = store.get(sha)
+            if contents is None:
+                logging.error(u'Snapshot body missing for note: %s' % (title, ))
+                failed.append(title)
+                continue
+            filename = Note(title, now)._filename_base() + '.' + FILE_EXTENSION
+            request_data = {'contents': stamp_contents(contents, now).encode('utf-8'),
+                            'filename': filename.encode('utf-8')}
+            request_data.update(settings.reply_fields(False))
+            jobs.put((title, request_data))
+        def upload():
+            http = settings.new_connection()
+            while not settings.past_deadline():
+                try:
+                    title, request_data = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                logging.info(u'>> Restoring to device: %s' % (title, ))
+                try:
+                    result = settings.iphone_request('update_note', request_data, http=http)
+                except (IphoneConnectError, httplib2.HttpLib2Error, socket.error, retry.CircuitOpen), e:
+                    logging.error(u'Could not restore note %s: %s' % (title, e))
+                    result = None
+                if result is None or result.startswith('ERROR'):
+                    failed.append(title)
+        # As many workers as could ever be let through, with
+        # settings.concurrency deciding how many of them are at once
+        workers = [threading.Thread(target=upload) for i in range(min(settings.concurrency.maximum, jobs.qsize()))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if not jobs.empty():
+            self.ui.error('Trunk Sync reached its deadline with %d notes left to restore. '
+                          'Restore the snapshot again to finish' % (jobs.qsize(), ))
+            sys.exit(1)
+        if failed:
+            self.ui.error(u'%d notes could not be restored: %s' % (len(failed), u', '.join(sorted(failed))))
+            sys.exit(1)
+        self.ui.message('Restored %d notes from snapshot %s' % (len(changed), name))
+        return True
+
     def sync(self):
         """
         Perform synchronization
@@ -974,6 +2282,8 @@ class TrunkSync(object):
             except OSError:
                 pass
             return True
+        if mode == 'restore' and settings.snapshot:
+            return self.restore_snapshot()
 
         # Check that required directories exist - if they don't then create
         try:
@@ -985,11 +2295,11 @@ class TrunkSync(object):
             self.ui.error('Could not create Trunk Sync directories')
             sys.exit(1)
         # Get lists of notes from the three sources
-        iphone_notes = self.get_notes_from_iphone()
+        lastsync_notes = self.get_notes_from_lastsync()
+        iphone_notes = self.get_notes_from_iphone(lastsync_notes)
         local_notes = self.get_notes_from_local()
         #local_file_notes = get_notes_from_localfiles()
         local_file_notes = []
-        lastsync_notes = self.get_notes_from_lastsync()
         # Tell the user that the sync is going to start
         if not self.ui.inform_sync_start():
             return False
@@ -997,87 +2307,120 @@ class TrunkSync(object):
         analyser = SyncAnalyser(iphone_notes, local_notes, local_file_notes, lastsync_notes, self.ui)
         if mode != 'sync' or analyser.analyse():
             if mode == 'backup':
-                # If backing up then new_on_iphone is all notes from the iPhone
-                analyser.new_on_iphone = iphone_notes
+                # If backing up then new_on_iphone is all notes from the iPhone,
+                # bar those whose local copy is as saved by the last backup
+                # (save_to_local gives the file the device's timestamp)
+                local_mtimes = dict((note.key, note.mtime) for note in local_notes)
+                analyser.new_on_iphone = [iphone_notes[n] for n, (key, mtime)
+                                          in enumerate(itertools.izip(iphone_notes.keys, iphone_notes.mtimes))
+                                          if local_mtimes.get(key) != mtime]
             elif mode == 'restore':
                 # If restoring then new_locally is all notes from the local store
                 analyser.new_locally = local_notes
-            # stu 100912
-            ## stu 110131 - DISABLED, enable get_internal_title()
-            # Backup new_locally notes that have been overridden
-            ## for note in analyser.overridden_locally:
-            ##     note.hydrate_from_local()
-            ##     note.backup_to_local()
-            # Backup new_on_iphone notes that have been overridden
-            ## for note in analyser.overridden_on_iphone:
-            ##     note.hydrate_from_iphone()
-            #     note.backup_to_local()
-            # Update local notes with notes from iPhone
-            for note in analyser.new_on_iphone:
-                note.hydrate_from_iphone()
-                note.save_to_local()
-            for note in analyser.updated_on_iphone:
-                note.hydrate_from_iphone()
-                note.save_to_local()
-            for note in analyser.deleted_on_iphone:
-                note.delete_local()
-            # Update iPhone notes with local changes
-            for note in analyser.new_locally:
-                note.hydrate_from_local()
-                new_contents = note.save_to_iphone()
-                if new_contents is None:
-                    continue
-                # Since this is a note which has been created locally
-                # the note will now be retrieved from the mobile device
-                # and saved back locally so the Trunk Notes header
-                # is in place
-                if not new_contents.startswith('ERROR'):
-                    note.contents = new_contents
-                    # Update the notes title
-                    for line in note.contents.split('\n'):
-                        if line.startswith('Title: '):
-                            note_name = line.split(':', 1)[1].strip()
-                            note.name = note_name
-                            break
+            store = settings.note_store
+            # Keys of the notes whose changes have been made, and new
+            # local notes sent to the device, for a checkpoint if the
+            # deadline stops the sync part way
+            synced = set()
+            sent_new = []
+            made = 0
+            try:
+                # stu 100912
+                # Backup local notes that have been overridden
+                for note in analyser.overridden_locally:
+                    note.contents = note.read_local()
+                    note.backup_to_local()
+                # Backup device notes that have been overridden
+                for note in self.hydrate_notes_from_iphone(analyser.overridden_on_iphone):
+                    note.backup_to_local()
+                # Update local notes with notes from iPhone
+                for note in self.hydrate_notes_from_iphone(analyser.new_on_iphone + analyser.updated_on_iphone):
                     note.save_to_local()
-                else:
-                    logging.error('Saving note to device returned ERROR')
-            for note in analyser.updated_locally:
-                note.hydrate_from_local()
-                note.save_to_iphone()
-            for note in analyser.deleted_locally:
-                note.delete_on_iphone()
-            # Finally get a raw list of notes from the iPhone
-            # and save this as the lastsync file.
-            #
-            # Note we decode as utf-8 then re-encode in utf-8.
-            # Alternatively we could just ensure we write
-            # last_sync_file as binary, but that seems fragile.
-            raw_notes = settings.iphone_request('notes_list').decode('utf-8')
+                    store.set_base(note.name, note.contents)
+                    synced.add(note.key)
+                    made += 1
+                for note in self.until_deadline(analyser.deleted_on_iphone):
+                    note.delete_local()
+                    store.forget_base(note.name)
+                    synced.add(note.key)
+                    made += 1
+                # Merged notes go both ways
+                for note in self.until_deadline(analyser.merged):
+                    note.save_to_local()
+                    note.hydrate_from_local()
+                    note.save_to_iphone(echo=False)
+                    synced.add(note.key)
+                    made += 1
+                # Update iPhone notes with local changes
+                for note in self.until_deadline(analyser.new_locally):
+                    note.hydrate_from_local()
+                    new_contents = note.save_to_iphone()
+                    if new_contents is None:
+                        continue
+                    # Since this is a note which has been created locally
+                    # the note will now be retrieved from the mobile device
+                    # and saved back locally so the Trunk Notes header
+                    # is in place
+                    if not new_contents.startswith('ERROR'):
+                        # Under the title it had locally, and the one
+                        # the device gave it
+                        synced.add(note.key)
+                        note.contents = new_contents
+                        # Update the notes title
+                        for line in note.contents.split('\n'):
+                            if line.startswith('Title: '):
+                                note_name = line.split(':', 1)[1].strip()
+                                note.name = note_name
+                                break
+                        note.save_to_local()
+                        synced.add(note.key)
+                        sent_new.append(note)
+                        made += 1
+                    else:
+                        logging.error('Saving note to device returned ERROR')
+                for note in self.until_deadline(analyser.updated_locally):
+                    note.hydrate_from_local()
+                    note.save_to_iphone(echo=False)
+                    synced.add(note.key)
+                    made += 1
+                for note in self.delete_notes_on_iphone(analyser.deleted_locally):
+                    store.forget_base(note.name)
+                    synced.add(note.key)
+                    made += 1
+            except (IphoneConnectError, httplib2.HttpLib2Error, socket.error, httplib.HTTPException,
+                    retry.CircuitOpen), e:
+                # Requests are not retried past the deadline, and an
+                # outage which outlasts it (or max_pause) won't end
+                # during this run, so keep what has been done
+                if not (settings.past_deadline() or isinstance(e, retry.CircuitOpen)):
+                    raise
+                logging.error('Device request failed: %s' % (e, ))
+                self.stopped = True
+                reason = 'stopped as the device is not responding'
+            else:
+                reason = 'reached its deadline'
+            if self.stopped:
+                self.checkpoint(iphone_notes, lastsync_notes, synced, sent_new)
+                changes = sum(len(notes) for notes in (analyser.new_on_iphone, analyser.updated_on_iphone,
+                                                       analyser.deleted_on_iphone, analyser.merged,
+                                                       analyser.new_locally, analyser.updated_locally,
+                                                       analyser.deleted_locally))
+                self.ui.message('Trunk Sync %s, with %d of %d changes made. '
+                                'The next sync will make the rest' % (reason, made, changes))
+                return True
+            # Finally list the notes on the iPhone, as the changes
+            # made since the start where the device can, and save
+            # this as the lastsync file
+            listing, cursor = self.list_iphone_notes(self.listing, self.cursor)
+            raw_notes = u''.join(u'%d:%s\n' % (timestamp, title) for timestamp, title in listing)
             with codecs.open(settings.last_sync_path, 'w', 'utf-8') as last_sync_file:
                 last_sync_file.write(raw_notes)
-            # Update timestamps on those notes which were new locally
-            # but were replaced with versions from the iPhone
-            times_from_iphone = {}
-            for line in raw_notes.split('\n'):
-                if ':' in line:
-                    timestamp, note_name = line.split(':', 1)
-                    try:
-                        times_from_iphone[note_name] = int(timestamp)
-                    except ValueError:
-                        logging.warn('Error in timestamp for note: %s' % (note_name, ))
-            for note in analyser.new_locally:
-                try:
-                    timestamp = times_from_iphone.get(note.name)
-                except:
-                    timestamp = None
-                if timestamp:
-                    note.update_time(timestamp)
-                else:
-                    logging.warn('Could not update the local timestamp of '
-                                 'note: %s' % (note.name, ))
+            settings.save_notes_cursor(cursor, raw_notes)
+            self.take_snapshot(raw_notes)
+            self.update_local_times(analyser.new_locally, raw_notes)
 
 
+        logging.debug('Connections: %r' % (settings.connection_stats(), ))
         self.ui.message('Trunk Sync has finished')
         return True
 
@@ -1085,14 +2428,32 @@ class TrunkSync(object):
 
 class TrunkDeviceFinder(object):
     """
-    Find a running Trunk Notes instance using Bonjour
+    Find a running Trunk Notes instance using Bonjour, or the built-in
+    multicast DNS browser (see mdns.py)
     """
 
     timeout = 5
 
-    def __init__(self, ipaddr=None):
+    # Shared so records learnt by one search are reused by the next
+    mdns_browser = None
+
+    def __init__(self, ipaddr=None, engine='auto'):
+        """
+        @param ipaddr: Only accept instances on this host
+        @param engine: 'dnssd' (pybonjour), 'mdns' (built-in), or 'auto'
+            to use pybonjour where a DNS-SD library is installed
+        """
+        global pybonjour
         self.bonjour_clients = []
+        # hosttarget -> IP address, where the mDNS browser learnt it
+        self.addresses = {}
         self.target_ip = ipaddr
+        if engine == 'auto':
+            import pybonjour
+            engine = pybonjour.library_available() and 'dnssd' or 'mdns'
+        elif engine == 'dnssd':
+            import pybonjour
+        self.engine = engine
 
     def resolve_callback(self, sdRef, flags, interfaceIndex, errorCode, fullname,
                      hosttarget, port, txtRecord):
@@ -1106,6 +2467,8 @@ class TrunkDeviceFinder(object):
                     self.bonjour_clients.append((fullname, hosttarget, port))
 
     def bonjour_search(self):
+        if self.engine == 'mdns':
+            return self.mdns_search()
         self.browse_sdRef = pybonjour.DNSServiceBrowse(regtype='_http._tcp.',
                                                        callBack=self.browse_callback)
         try:
@@ -1140,13 +2503,36 @@ class TrunkDeviceFinder(object):
         finally:
             resolve_sdRef.close()
 
+    def mdns_search(self):
+        import mdns
+        if TrunkDeviceFinder.mdns_browser is None:
+            TrunkDeviceFinder.mdns_browser = mdns.Browser()
+        pause = 1
+        while True:
+            for fullname, hosttarget, port, address, txt in self.mdns_browser.browse('_http._tcp.local.', self.timeout):
+                # Same filtering as resolve_callback
+                if fullname.startswith('TrunkNotes._http._tcp'):
+                    if self.target_ip in [None, hosttarget, address]:
+                        self.bonjour_clients.append((fullname, hosttarget, port))
+                        if address:
+                            self.addresses[hosttarget] = address
+            if self.bonjour_clients:
+                break
+            # Wait longer between each round until the device appears
+            time.sleep(pause)
+            pause = min(pause * 2, 30)
+
 
 class TrunkSyncBaseUi(object):
     """Base class for SimpleUi and EasyUi"""
 
+    # hosttarget -> IP address, for hosts the system resolver may not know
+    device_addresses = {}
+
     def find_trunk(self):
-        device_finder = TrunkDeviceFinder()
+        device_finder = TrunkDeviceFinder(engine=settings.discovery)
         device_finder.bonjour_search()
+        self.device_addresses = device_finder.addresses
         return device_finder.bonjour_clients
 
     def get_trunk_instance(self):
@@ -1179,7 +2565,7 @@ class TrunkSyncBaseUi(object):
         if not self.confirm_sync_mode():
             self.message('Operation cancelled.')
             sys.exit(1)
-        settings.iphone_ip = chosen_instance[1]
+        settings.iphone_ip = self.device_addresses.get(chosen_instance[1], chosen_instance[1])
         settings.iphone_port = chosen_instance[2]
         # 2. Sync with this Trunk instances
         success = False
@@ -1187,6 +2573,11 @@ class TrunkSyncBaseUi(object):
             try:
                 sync = TrunkSync(self)
                 success = sync.sync()
+                # Digest nonces and counts have moved on since the
+                # authorization was saved after the first request
+                settings.save_authorizations()
+                logging.info('Device concurrency: %s' % (settings.concurrency.describe(), ))
+                logging.info('Device requests: %s' % (settings.retry.describe(), ))
             except IphoneConnectError, e:
                 if e[0]['status'] == '401':
                     # Authentication error - prompt user
@@ -1196,6 +2587,9 @@ class TrunkSyncBaseUi(object):
                 else:
                     # Unknown error
                     raise
+            except retry.CircuitOpen, e:
+                self.error('%s. Trunk Sync will now exit' % (e, ))
+                sys.exit(1)
 
 class TrunkSyncSimpleUi(TrunkSyncBaseUi):
     """command line interface to trunksync"""
@@ -1274,6 +2668,23 @@ class TrunkSyncSimpleUi(TrunkSyncBaseUi):
                 chosen_n = 0
         return choices[chosen_n - 1]
 
+    def resolve_conflicts(self, conflicts):
+        """
+        Settle all conflicts with one answer, or review them one by one
+        """
+        print '%d notes have been changed on your mobile device and locally:' % (len(conflicts), )
+        for conflict in conflicts:
+            print '  %s (%s)' % (conflict.name, conflict.kind)
+        choices = ['newest', 'device', 'local', 'review each']
+        answer = self.resolve_conflict('Keep which version of these notes?', choices)
+        for conflict in conflicts:
+            if answer == 'review each':
+                conflict.resolution = self.resolve_conflict(conflict.describe(), ['device', 'local'])
+            elif answer == 'newest':
+                conflict.resolution = conflict.newest()
+            else:
+                conflict.resolution = answer
+
     def get_username(self):
         return raw_input('Username: ')
 
@@ -1284,6 +2695,10 @@ class TrunkSyncSimpleUi(TrunkSyncBaseUi):
 class TrunkSyncEasyUi(TrunkSyncBaseUi):
     """EasyGui interface to trunksync"""
 
+    def __init__(self):
+        global easygui
+        import easygui
+
     def inform_sync_start(self):
         return easygui.ccbox('Starting synchronization with Trunk Notes. ' +
                              'You will be asked to resolve any conflicts before synchronization starts',
@@ -1323,6 +2738,36 @@ class TrunkSyncEasyUi(TrunkSyncBaseUi):
                                     )
         return chosen_d
 
+    def resolve_conflicts(self, conflicts):
+        """
+        Settle all conflicts with one answer, or with a single list of
+        the notes to take from the device
+        """
+        answer = (easygui.buttonbox('%d notes have been changed on your mobile device and locally:\n\n' % (len(conflicts), ) +
+                                    '\n'.join(conflict.name for conflict in conflicts) +
+                                    '\n\nKeep which version of these notes?',
+                                    'Trunk Sync',
+                                    ('Newest', 'Device', 'Local', 'Choose'),
+                                   ) or '').lower()
+        if not answer:
+            # The dialog was closed. Nothing has been changed yet, so
+            # stop here rather than sync with the conflicts unsettled
+            self.message('Operation cancelled.')
+            sys.exit(1)
+        if answer == 'choose':
+            from_device = easygui.multchoicebox('Select the notes to take from your mobile device. ' +
+                                                'The local version of all other notes will be kept.',
+                                                'Trunk Sync',
+                                                [conflict.name for conflict in conflicts],
+                                               ) or []
+        for conflict in conflicts:
+            if answer == 'choose':
+                conflict.resolution = conflict.name in from_device and 'device' or 'local'
+            elif answer == 'newest':
+                conflict.resolution = conflict.newest()
+            else:
+                conflict.resolution = answer
+
     def confirm_sync_mode(self):
         ok_to_continue = True
         if settings.sync_mode == 'default':
@@ -1387,10 +2832,38 @@ def main(args=None):
         help="sync mode, one of 'sync' [default], 'backup' (copy device->local), 'restore' (copy local->device), 'wipelocal' (remove all local sync info and data [CAUTION!])")
     parser.add_option("-n", "--dry-run", dest="dryrun", action="store_true",
         help="Print lists of changed files, and quit")
+    parser.add_option("-d", "--discovery", dest="discovery", choices=['auto', 'dnssd', 'mdns'],
+        help="how to find devices: 'auto' [default], 'dnssd' (system Bonjour library) or 'mdns' (built-in multicast DNS)")
+    parser.add_option("-x", "--conflicts", dest="conflict_policy", choices=list(ConflictPolicy.CHOICES),
+        help="how to settle notes changed on both sides: 'ask' [default], 'newest', 'device' or 'local'")
+    parser.add_option("--conflict-rule", dest="conflict_rules", action="append", metavar="PATTERN=CHOICE",
+        help="settle conflicts for notes whose local folder or title matches PATTERN with CHOICE (one of the --conflicts values); may be repeated, first match wins")
+    parser.add_option("-s", "--snapshot", dest="snapshot", metavar="WHEN",
+        help="with --mode restore, put the device back as it was at the last sync at or before WHEN (UTC, YYYY-MM-DD[ HH:MM[:SS]], or a snapshot name), uploading only the notes which differ")
+    parser.add_option("--no-merge", dest="merge", action="store_false", default=True,
+        help="Never merge notes changed on both sides, even where the changes don't overlap")
+    parser.add_option("--no-delta", dest="delta", action="store_false", default=True,
+        help="Always send whole notes to the device, even where it accepts edits to long notes")
+    parser.add_option("--concurrency", dest="concurrency", type=int, default=8,
+        help="Most requests to have in flight to the device at once, while it keeps up [8]")
+    parser.add_option("--retries", dest="retries", type=int, default=4,
+        help="Tries at each request to the device before giving up [4]")
+    parser.add_option("--max-pause", dest="max_pause", type=float, default=600,
+        help="Seconds to wait for a device which has stopped responding [600]")
+    parser.add_option("--deadline", dest="deadline", type=float, metavar="SECONDS",
+        help="Stop starting changes this many seconds into the run, and save how far the sync got so the next run carries on from there (for unattended runs)")
+    parser.add_option("--no-pipeline", dest="pipeline", action="store_false", default=True,
+        help="Wait for each response from the device before sending the next request")
+    parser.add_option("--no-compress", dest="compress", action="store_false", default=True,
+        help="Never compress notes sent to the device")
     if args is None:
         args = sys.argv[1:]
 
     options, args = parser.parse_args(args)
+    if options.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+
+    logging.basicConfig(level=logging.DEBUG)
 
     if options.quiet:
         logging.disable(logging.DEBUG)